@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from transformers import BartTokenizer
+from transformers.tokenization_gpt2 import bytes_to_unicode
+
+
+GRAPHS = [
+    ("<H> neural network <R> USED-FOR <T> image classification", "we use a neural network to classify images ."),
+    ("<H> parser <R> EVALUATE-FOR <T> treebank", "the parser is evaluated on a treebank ."),
+    (
+        "<H> method <R> USED-FOR <T> machine translation <H> method <R> COMPARE <T> phrase-based system",
+        "our method for machine translation outperforms a phrase-based system .",
+    ),
+    ("<H> kernel <R> PART-OF <T> svm", "the kernel is part of the svm ."),
+    (
+        "<H> features <R> USED-FOR <T> classifier <H> classifier <R> USED-FOR <T> sentiment analysis",
+        "the features are used by a classifier for sentiment analysis .",
+    ),
+    ("<H> corpus <R> FEATURE-OF <T> speech", "the corpus contains speech ."),
+    ("<H> model <R> HYPONYM-OF <T> language model", "the model is a language model ."),
+]
+
+
+@pytest.fixture(scope="session")
+def tokenizer(tmp_path_factory):
+    """A byte-level BART tokenizer with no merges and the graph tokens, built offline."""
+    save_dir = tmp_path_factory.mktemp("tokenizer")
+    vocab = ["<s>", "<pad>", "</s>", "<unk>"] + sorted(set(bytes_to_unicode().values())) + ["<mask>"]
+    with open(save_dir / "vocab.json", "w") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(save_dir / "merges.txt", "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = BartTokenizer(str(save_dir / "vocab.json"), str(save_dir / "merges.txt"))
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<H>", "<R>", "<T>"]})
+    return tokenizer
+
+
+def write_split(data_dir, type_path, pairs, trailing_newline=True):
+    for ext, lines in [("source", [src for src, _ in pairs]), ("target", [tgt for _, tgt in pairs])]:
+        text = "\n".join(lines) + ("\n" if trailing_newline else "")
+        data_dir.joinpath(f"{type_path}.{ext}").write_text(text, encoding="utf-8")
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """A data dir with a train split of GRAPHS."""
+    write_split(tmp_path, "train", GRAPHS)
+    return tmp_path
@@ -2,45 +2,61 @@
 
 import argparse
 import glob
+import inspect
 import logging
 import os
 import sys
 import time
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 
 from pytorch_lightning.utilities import rank_zero_info
 
 from callbacks import Seq2SeqLoggingCallback, get_checkpoint_callback, get_early_stopping_callback
-from transformers import MBartTokenizer, T5ForConditionalGeneration
+from transformers import BartTokenizer, MBartTokenizer, T5ForConditionalGeneration
 
 from transformers.modeling_bart import shift_tokens_right
+from graph2text_common import (
+    T5_PREFIX,
+    LengthModel,
+    fast_batch_decode,
+    graph_size_token_ids,
+    load_graph2text_tokenizer,
+)
 from utils import (
     ROUGE_KEYS,
+    BinarizedSeq2SeqDataset,
     LegacySeq2SeqDataset,
+    LineOffsetReader,
     Seq2SeqDataset,
+    StreamingSeq2SeqDataset,
+    all_gather_objects,
     assert_all_frozen,
     calculate_bleu,
     calculate_rouge,
+    find_tokenizer_mismatch,
     flatten_list,
     freeze_embeds,
     freeze_params,
     get_git_info,
     label_smoothed_nll_loss,
     lmap,
+    parse_corpora,
     pickle_save,
     save_git_info,
     save_json,
     use_task_specific_params,
+    write_lines_atomic,
 )
 
 from utils_graph2text import convert_text, eval_meteor, eval_bleu, eval_chrf, eval_meteor_test_webnlg, eval_chrf_test_webnlg
+from utils_graph2text import format_bleu
 
 # need the parent dir module
 sys.path.insert(2, str(Path(__file__).resolve().parents[1]))
@@ -49,6 +65,9 @@ from lightning_base import BaseTransformer, add_generic_args, generic_train  # n
 
 logger = logging.getLogger(__name__)
 
+# persistent_workers and prefetch_factor arrived in torch 1.7
+DATALOADER_HAS_PERSISTENT_WORKERS = "persistent_workers" in inspect.signature(DataLoader).parameters
+
 
 class SummarizationModule(BaseTransformer):
     mode = "summarization"
@@ -57,13 +76,13 @@ class SummarizationModule(BaseTransformer):
     default_val_metric = "rouge2"
 
     def __init__(self, hparams, **kwargs):
-        if hparams.sortish_sampler and hparams.gpus > 1:
+        if hparams.sortish_sampler and hparams.max_tokens_per_batch is not None:
+            raise ValueError("--sortish_sampler and --max_tokens_per_batch may not be used simultaneously")
+        # Lightning cannot put its DistributedSampler in a DataLoader with a batch_sampler: get_dataloader shards
+        # every loader itself instead (see distributed_sampler)
+        uses_own_sampler = hparams.max_tokens_per_batch is not None or hparams.eval_max_tokens is not None
+        if (hparams.sortish_sampler or uses_own_sampler) and hparams.gpus > 1:
             hparams.replace_sampler_ddp = False
-        elif hparams.max_tokens_per_batch is not None:
-            if hparams.gpus > 1:
-                raise NotImplementedError("Dynamic Batch size does not work for multi-gpu training")
-            if hparams.sortish_sampler:
-                raise ValueError("--sortish_sampler and --max_tokens_per_batch may not be used simultaneously")
 
         super().__init__(hparams, num_labels=None, mode=self.mode, **kwargs)
         #use_task_specific_params(self.model, "summarization")
@@ -77,11 +96,12 @@ class SummarizationModule(BaseTransformer):
         self.vocab_size = self.config.tgt_vocab_size if self.model_type == "fsmt" else self.config.vocab_size
 
         if 't5' in hparams.model_name_or_path:
-            self.model.config.prefix = 'translate Graph to English: '
+            self.model.config.prefix = T5_PREFIX
         self.dataset_kwargs: dict = dict(
             data_dir=self.hparams.data_dir,
             max_source_length=self.hparams.max_source_length,
             prefix=self.model.config.prefix or "",
+            pad_to_multiple_of=self.hparams.pad_to_multiple_of,
         )
         n_observations_per_split = {
             "train": self.hparams.n_train,
@@ -105,20 +125,54 @@ class SummarizationModule(BaseTransformer):
 
         self.hparams.git_sha = get_git_info()["repo_sha"]
         self.num_workers = hparams.num_workers
+        self.dataloader_cache: Dict[str, DataLoader] = {}
         self.decoder_start_token_id = None  # default to config
         if self.model.config.decoder_start_token_id is None and isinstance(self.tokenizer, MBartTokenizer):
             self.decoder_start_token_id = self.tokenizer.lang_code_to_id[hparams.tgt_lang]
             self.model.config.decoder_start_token_id = self.decoder_start_token_id
-        self.dataset_class = (
-            Seq2SeqDataset if hasattr(self.tokenizer, "prepare_seq2seq_batch") else LegacySeq2SeqDataset
-        )
+        if self.hparams.binarize:
+            self.dataset_class = BinarizedSeq2SeqDataset
+        else:
+            self.dataset_class = (
+                Seq2SeqDataset if hasattr(self.tokenizer, "prepare_seq2seq_batch") else LegacySeq2SeqDataset
+            )
         self.already_saved_batch = False
         self.eval_beams = self.model.config.num_beams if self.hparams.eval_beams is None else self.hparams.eval_beams
         if self.hparams.eval_max_gen_length is not None:
             self.eval_max_length = self.hparams.eval_max_gen_length
         else:
             self.eval_max_length = self.model.config.max_length
+        length_model = getattr(self.hparams, "length_model", None)
+        self.length_model = LengthModel.load(length_model) if length_model else None
+        self.graph_token_ids = graph_size_token_ids(self.tokenizer)
         self.val_metric = self.default_val_metric if self.hparams.val_metric is None else self.hparams.val_metric
+        if self.hparams.lean_eval and self.val_metric == "loss":
+            raise ValueError("--lean_eval does not compute the loss, choose another --val_metric")
+        if getattr(self.hparams, "fast_tokenizer", False):
+            self.check_fast_tokenizer()
+
+    def check_fast_tokenizer(self, num_lines=1000):
+        """Refuse --fast_tokenizer unless it reproduces the slow tokenizer's ids on the head of train and val."""
+        slow_tokenizer = load_graph2text_tokenizer(
+            self.hparams.tokenizer_name if self.hparams.tokenizer_name else self.hparams.model_name_or_path,
+            cache_dir=self.hparams.cache_dir if self.hparams.cache_dir else None,
+        )
+        slow_kwargs = {"add_prefix_space": True} if isinstance(slow_tokenizer, BartTokenizer) else {}
+        for type_path in ["train", "val"]:
+            for ext, prefix in [(".source", self.dataset_kwargs["prefix"]), (".target", "")]:
+                path = Path(self.hparams.data_dir).joinpath(type_path + ext)
+                if not path.exists():
+                    continue
+                reader = LineOffsetReader(path)
+                lines = [prefix + reader[i] for i in range(min(num_lines, len(reader)))]
+                mismatch = find_tokenizer_mismatch(self.tokenizer, slow_tokenizer, lines, **slow_kwargs)
+                if mismatch is not None:
+                    line, fast_ids, slow_ids = mismatch
+                    raise ValueError(
+                        f"--fast_tokenizer differs from the slow tokenizer on {path}: {line!r}\n"
+                        f"fast: {fast_ids}\nslow: {slow_ids}"
+                    )
+        rank_zero_info("fast tokenizer matches the slow tokenizer on %s lines per file", num_lines)
 
     def save_readable_batch(self, batch: Dict[str, torch.Tensor]) -> Dict[str, List[str]]:
         """A debugging utility"""
@@ -141,11 +195,25 @@ class SummarizationModule(BaseTransformer):
         return self.model(input_ids, **kwargs)
 
     def ids_to_clean_text(self, generated_ids: List[int]):
-        gen_text = self.tokenizer.batch_decode(
-            generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
-        )
+        gen_text = fast_batch_decode(self.tokenizer, generated_ids)
         return lmap(str.strip, gen_text)
 
+    @staticmethod
+    def ordered_outputs(outputs, key) -> list:
+        """Flatten ``x[key]`` over the step outputs in dataset order (eval batches may be length-sorted), once per
+        example (distributed samplers repeat examples so that every rank gets as many)."""
+        values = flatten_list([x[key] for x in outputs])
+        if all("ids" in x for x in outputs):
+            _, first = np.unique(flatten_list([x["ids"] for x in outputs]), return_index=True)
+            values = [values[i] for i in first]
+        return values
+
+    def gather_outputs(self, outputs: List[dict]) -> List[dict]:
+        """The eval step outputs of all ranks, which each generate a shard of the split with several GPUs."""
+        outputs = [{k: v.cpu() if torch.is_tensor(v) else v for k, v in x.items()} for x in outputs]
+        outputs = flatten_list(all_gather_objects(outputs))
+        return [{k: v.to(self.device) if torch.is_tensor(v) else v for k, v in x.items()} for x in outputs]
+
     def _step(self, batch: dict) -> Tuple:
         pad_token_id = self.tokenizer.pad_token_id
         src_ids, src_mask = batch["input_ids"], batch["attention_mask"]
@@ -198,6 +266,7 @@ class SummarizationModule(BaseTransformer):
     def validation_epoch_end(self, outputs, prefix="val") -> Dict:
 
         self.step_count += 1
+        outputs = self.gather_outputs(outputs)
 
         val_outputs_folder = "val_outputs"
         os.system("mkdir -p " + os.path.join(self.hparams.output_dir, val_outputs_folder))
@@ -207,32 +276,26 @@ class SummarizationModule(BaseTransformer):
         output_test_targets_file = os.path.join(self.hparams.output_dir, val_outputs_folder, "validation_targets_" +
                                                     str(self.step_count) + ".txt")
         # write predictions and targets for later rouge evaluation.
-        with open(output_test_predictions_file, "w") as p_writer, open(output_test_targets_file, "w") as t_writer:
-            for output_batch in outputs:
-                p_writer.writelines(s + "\n" for s in output_batch["preds"])
-                t_writer.writelines(s + "\n" for s in output_batch["target"])
-            p_writer.close()
-            t_writer.close()
+        write_lines_atomic(self.ordered_outputs(outputs, "preds"), output_test_predictions_file)
+        write_lines_atomic(self.ordered_outputs(outputs, "target"), output_test_targets_file)
 
+        # every rank tokenizes the same predictions: write through a temporary file, like write_lines_atomic
+        tok_tmp_file = output_test_predictions_file + ".tok." + str(os.getpid()) + ".tmp"
         os.system(
             "java edu.stanford.nlp.process.PTBTokenizer -preserveLines < "
             + output_test_predictions_file + " > "
-            + output_test_predictions_file + ".tok")
+            + tok_tmp_file)
+        os.replace(tok_tmp_file, output_test_predictions_file + ".tok")
 
         bleu_info = eval_bleu(output_test_predictions_file + ".tok", self.hparams.data_dir, prefix)
 
-        rank_zero_info("%s bleu_info: %s", self.step_count, bleu_info)
+        rank_zero_info("%s bleu_info: %s", self.step_count, format_bleu(bleu_info))
 
-        if bleu_info == -1:
-            bleu_info = float(bleu_info)
-        else:
-            bleu_info = float(bleu_info.split(",")[0].split("BLEU = ")[1])
+        bleu_info = bleu_info["bleu"] if bleu_info is not None else -1.0
 
-        losses = {k: torch.stack([x[k] for x in outputs]).mean() for k in self.loss_names}
+        losses = self.mean_losses(outputs)
         loss = losses["loss"]
-        generative_metrics = {
-            k: np.array([x[k] for x in outputs]).mean() for k in self.metric_names + ["gen_time", "gen_len"]
-        }
+        generative_metrics = self.mean_generative_metrics(outputs)
 
         generative_metrics['bleu'] = bleu_info
 
@@ -246,7 +309,7 @@ class SummarizationModule(BaseTransformer):
         all_metrics = {f"{prefix}_avg_{k}": x for k, x in losses.items()}
         all_metrics["step_count"] = self.step_count
         self.metrics[prefix].append(all_metrics)  # callback writes this to self.metrics_save_path
-        preds = flatten_list([x["preds"] for x in outputs])
+        preds = self.ordered_outputs(outputs, "preds")
 
         return {
             "bleu": bleu_info,
@@ -260,6 +323,30 @@ class SummarizationModule(BaseTransformer):
     def calc_generative_metrics(self, preds, target) -> Dict:
         return calculate_rouge(preds, target)
 
+    def mean_losses(self, outputs) -> Dict[str, torch.Tensor]:
+        """Mean of each loss over the batches; NaN with --lean_eval, which skips the teacher-forced pass."""
+        if self.hparams.lean_eval:
+            return {k: torch.tensor(float("nan"), device=self.device) for k in self.loss_names}
+        return {k: torch.stack([x[k] for x in outputs]).mean() for k in self.loss_names}
+
+    def mean_generative_metrics(self, outputs) -> Dict[str, float]:
+        """Batch means of gen_time, gen_len and metric_names; with --lean_eval the metrics come from one corpus-level
+        calc_generative_metrics call instead."""
+        metrics = {k: np.array([x[k] for x in outputs]).mean() for k in ["gen_time", "gen_len"]}
+        if self.hparams.lean_eval:
+            preds, target = self.ordered_outputs(outputs, "preds"), self.ordered_outputs(outputs, "target")
+            metrics.update(self.calc_generative_metrics(preds, target))
+        else:
+            metrics.update({k: np.array([x[k] for x in outputs]).mean() for k in self.metric_names})
+        return metrics
+
+    def batch_max_length(self, batch: dict) -> int:
+        """eval_max_length, lowered to the longest output the length model predicts for the batch."""
+        if self.length_model is None:
+            return self.eval_max_length
+        caps = self.length_model.predict_ids(batch["input_ids"], self.graph_token_ids, batch["attention_mask"])
+        return int(min(caps.max(), self.eval_max_length))
+
     def _generative_step(self, batch: dict, batch_idx=None, dataloader_idx=None) -> dict:
         t0 = time.time()
 
@@ -270,20 +357,24 @@ class SummarizationModule(BaseTransformer):
             use_cache=True,
             decoder_start_token_id=self.decoder_start_token_id,
             num_beams=self.eval_beams,
-            max_length=self.eval_max_length,
+            max_length=self.batch_max_length(batch),
             length_penalty=5.0
         )
         gen_time = (time.time() - t0) / batch["input_ids"].shape[0]
         preds: List[str] = self.ids_to_clean_text(generated_ids)
         target: List[str] = self.ids_to_clean_text(batch["labels"])
-        loss_tensors = self._step(batch)
-        base_metrics = {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
-        rouge: Dict = self.calc_generative_metrics(preds, target)
+        base_metrics, rouge = {}, {}
+        if not self.hparams.lean_eval:
+            loss_tensors = self._step(batch)
+            base_metrics = {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
+            rouge: Dict = self.calc_generative_metrics(preds, target)
         summ_len = np.mean(lmap(len, generated_ids))
         base_metrics.update(gen_time=gen_time, gen_len=summ_len, preds=preds, target=target, **rouge)
 
         if dataloader_idx is not None:
             base_metrics.update(batch_idx=batch_idx, dataloader_idx=dataloader_idx)
+        if "ids" in batch:
+            base_metrics.update(ids=batch["ids"].tolist())
         return base_metrics
 
     def test_step(self, batch, batch_idx, dataloader_idx):
@@ -292,63 +383,152 @@ class SummarizationModule(BaseTransformer):
     def test_epoch_end(self, outputs):
         return self.validation_epoch_end(outputs, prefix="test")
 
+    def prepare_data(self):
+        """Binarize the splits with --binarize. Lightning calls this on one process per node before the DDP processes
+        start, so they only read the caches."""
+        if self.dataset_class is not BinarizedSeq2SeqDataset:
+            return
+        for type_path in self.n_obs:
+            if type_path == "train" and self.hparams.train_corpora:
+                continue
+            if Path(self.hparams.data_dir).joinpath(type_path + ".source").exists():
+                self.get_dataset(type_path)
+
     def get_dataset(self, type_path) -> Seq2SeqDataset:
         n_obs = self.n_obs[type_path]
         max_target_length = self.target_lens[type_path]
+        extra_kwargs = {}
+        if self.dataset_class is BinarizedSeq2SeqDataset:
+            extra_kwargs["cache_prefix"] = self._feature_file(type_path, max_target_length)
         dataset = self.dataset_class(
             self.tokenizer,
             type_path=type_path,
             n_obs=n_obs,
             max_target_length=max_target_length,
+            **extra_kwargs,
             **self.dataset_kwargs,
         )
         return dataset
 
+    def get_streaming_dataset(self) -> StreamingSeq2SeqDataset:
+        return StreamingSeq2SeqDataset(
+            self.tokenizer,
+            parse_corpora(self.hparams.train_corpora),
+            max_source_length=self.hparams.max_source_length,
+            max_target_length=self.target_lens["train"],
+            prefix=self.dataset_kwargs["prefix"],
+            epoch_size=self.hparams.stream_epoch_size,
+            shuffle_buffer_size=self.hparams.shuffle_buffer_size,
+            seed=self.hparams.seed,
+            num_replicas=self.trainer.world_size,
+            rank=self.trainer.global_rank,
+        )
+
     def get_dataloader(self, type_path: str, batch_size: int, shuffle: bool = False) -> DataLoader:
+        if type_path == "train" and self.hparams.train_corpora:
+            dataset = self.get_streaming_dataset()
+            return DataLoader(
+                dataset,
+                batch_size=batch_size,
+                collate_fn=dataset.collate_fn,
+                # persistent workers would keep a stale copy of the dataset, which set_epoch reshuffles
+                **self.dataloader_kwargs(persistent_workers=False),
+            )
+
         dataset = self.get_dataset(type_path)
 
+        if type_path != "train" and self.hparams.eval_max_tokens is not None:
+            batch_sampler = dataset.make_eval_batches(
+                self.hparams.eval_max_tokens,
+                num_beams=self.eval_beams,
+                max_gen_length=self.eval_max_length,
+                distributed=self.hparams.gpus > 1,
+            )
+            return DataLoader(
+                dataset,
+                batch_sampler=batch_sampler,
+                collate_fn=dataset.collate_fn,
+                **self.dataloader_kwargs(),
+            )
+
         if self.hparams.sortish_sampler and type_path != "test":
-            sampler = dataset.make_sortish_sampler(batch_size, distributed=self.hparams.gpus > 1)
+            sampler = dataset.make_sortish_sampler(
+                batch_size, distributed=self.hparams.gpus > 1, seed=self.hparams.seed
+            )
             return DataLoader(
                 dataset,
                 batch_size=batch_size,
                 collate_fn=dataset.collate_fn,
                 shuffle=False,
-                num_workers=self.num_workers,
+                **self.dataloader_kwargs(),
                 sampler=sampler,
             )
 
         elif self.hparams.max_tokens_per_batch is not None and type_path != "test":
             batch_sampler = dataset.make_dynamic_sampler(
-                self.hparams.max_tokens_per_batch, distributed=self.hparams.gpus > 1
+                self.hparams.max_tokens_per_batch,
+                distributed=self.hparams.gpus > 1,
+                shuffle=shuffle,
+                seed=self.hparams.seed,
             )
             return DataLoader(
                 dataset,
                 batch_sampler=batch_sampler,
                 collate_fn=dataset.collate_fn,
                 # shuffle=False,
-                num_workers=self.num_workers,
+                **self.dataloader_kwargs(),
                 # batch_size=None,
             )
         else:
+            sampler = self.distributed_sampler(dataset, shuffle=shuffle)
             return DataLoader(
                 dataset,
                 batch_size=batch_size,
                 collate_fn=dataset.collate_fn,
-                shuffle=shuffle,
-                num_workers=self.num_workers,
-                sampler=None,
+                shuffle=shuffle and sampler is None,
+                **self.dataloader_kwargs(),
+                sampler=sampler,
             )
 
+    def distributed_sampler(self, dataset, shuffle: bool) -> Optional[DistributedSampler]:
+        """The DistributedSampler Lightning would add to a plain DataLoader, when replace_sampler_ddp is off."""
+        if self.hparams.gpus > 1 and not self.hparams.replace_sampler_ddp:
+            return DistributedSampler(dataset, shuffle=shuffle)
+        return None
+
+    def dataloader_kwargs(self, persistent_workers=True) -> dict:
+        """Worker options shared by every DataLoader."""
+        pin_memory = self.hparams.gpus > 0 and not self.hparams.no_pin_memory
+        kwargs = dict(num_workers=self.num_workers, pin_memory=pin_memory)
+        if self.num_workers > 0:
+            if DATALOADER_HAS_PERSISTENT_WORKERS:
+                kwargs["persistent_workers"] = persistent_workers and not self.hparams.no_persistent_workers
+            if self.hparams.prefetch_factor is not None:
+                kwargs["prefetch_factor"] = self.hparams.prefetch_factor
+        return kwargs
+
+    def cached_dataloader(self, type_path: str, batch_size: int, shuffle: bool = False) -> DataLoader:
+        """Build each split's DataLoader once, so that its persistent workers are reused by every epoch."""
+        if type_path not in self.dataloader_cache:
+            self.dataloader_cache[type_path] = self.get_dataloader(type_path, batch_size=batch_size, shuffle=shuffle)
+        return self.dataloader_cache[type_path]
+
+    def on_epoch_start(self):
+        # reshuffle the samplers and streaming dataset, which derive their order from (seed, epoch)
+        for attr in ("sampler", "batch_sampler", "dataset"):
+            sampler = getattr(self.trainer.train_dataloader, attr, None)
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(self.current_epoch)
+
     def train_dataloader(self) -> DataLoader:
-        dataloader = self.get_dataloader("train", batch_size=self.hparams.train_batch_size, shuffle=True)
+        dataloader = self.cached_dataloader("train", batch_size=self.hparams.train_batch_size, shuffle=True)
         return dataloader
 
     def val_dataloader(self) -> DataLoader:
-        return self.get_dataloader("val", batch_size=self.hparams.eval_batch_size)
+        return self.cached_dataloader("val", batch_size=self.hparams.eval_batch_size)
 
     def test_dataloader(self) -> DataLoader:
-        return self.get_dataloader("test", batch_size=self.hparams.eval_batch_size)
+        return self.cached_dataloader("test", batch_size=self.hparams.eval_batch_size)
 
     @staticmethod
     def add_model_specific_args(parser, root_dir):
@@ -385,7 +565,36 @@ class SummarizationModule(BaseTransformer):
         parser.add_argument("--freeze_encoder", action="store_true")
         parser.add_argument("--freeze_embeds", action="store_true")
         parser.add_argument("--sortish_sampler", action="store_true", default=False)
-        parser.add_argument("--max_tokens_per_batch", type=int, default=None)
+        parser.add_argument(
+            "--max_tokens_per_batch",
+            type=int,
+            default=None,
+            help="Batch by a padded-token budget instead of --train_batch_size (needs a .len file, see make_len_file.py)",
+        )
+        parser.add_argument(
+            "--train_corpora",
+            type=str,
+            nargs="+",
+            default=None,
+            help="Stream training data from sharded corpora given as GLOB[:WEIGHT] over .source files "
+            "(e.g. 'data/amr-silver/*.source:0.3'), instead of {data_dir}/train.source",
+        )
+        parser.add_argument(
+            "--stream_epoch_size",
+            type=int,
+            default=None,
+            help="Examples per epoch with --train_corpora. Defaults to the total number of lines of all shards.",
+        )
+        parser.add_argument(
+            "--shuffle_buffer_size", type=int, default=1000, help="Examples kept for local shuffling when streaming"
+        )
+        parser.add_argument(
+            "--binarize",
+            action="store_true",
+            default=False,
+            help="Read token ids from a memory-mapped cache (built by binarize.py or on first use) "
+            "instead of tokenizing every batch.",
+        )
         parser.add_argument("--logger_name", type=str, choices=["default", "wandb", "wandb_shared"], default="default")
         parser.add_argument("--n_train", type=int, default=-1, required=False, help="# examples. -1 means use all.")
         parser.add_argument("--n_val", type=int, default=-1, required=False, help="# examples. -1 means use all.")
@@ -402,6 +611,43 @@ class SummarizationModule(BaseTransformer):
             "--val_metric", type=str, default=None, required=False, choices=["bleu", "rouge2", "loss", None]
         )
         parser.add_argument("--eval_max_gen_length", type=int, default=None, help="never generate more than n tokens")
+        parser.add_argument(
+            "--length_model",
+            type=str,
+            default=None,
+            help="length_model.json written by make_len_file.py --fit_length_model: lowers eval_max_gen_length per "
+            "batch to the longest output predicted for its graphs",
+        )
+        parser.add_argument(
+            "--lean_eval",
+            action="store_true",
+            help="Only generate during validation and test: no teacher-forced loss, and metrics computed once per "
+            "corpus instead of per batch",
+        )
+        parser.add_argument(
+            "--pad_to_multiple_of",
+            type=int,
+            default=None,
+            help="Round the padded batch length up to a multiple of this (legacy and --binarize datasets)",
+        )
+        parser.add_argument(
+            "--no_pin_memory", action="store_true", help="Do not pin batches in page-locked memory when using GPUs"
+        )
+        parser.add_argument(
+            "--no_persistent_workers",
+            action="store_true",
+            help="Restart the DataLoader workers for every epoch and validation run (torch >= 1.7 keeps them)",
+        )
+        parser.add_argument(
+            "--prefetch_factor", type=int, default=None, help="Batches loaded in advance by each worker (torch >= 1.7)"
+        )
+        parser.add_argument(
+            "--eval_max_tokens",
+            type=int,
+            default=None,
+            help="Generate val/test in length-sorted batches of at most this many eval_beams x (source + "
+            "max generation length) tokens instead of --eval_batch_size (needs a .len file, see make_len_file.py)",
+        )
         parser.add_argument("--save_top_k", type=int, default=1, required=False, help="How many checkpoints to save")
         parser.add_argument(
             "--early_stopping_patience",
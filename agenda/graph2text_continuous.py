@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+"""Beam search with continuous (in-flight) batching: finished examples leave the batch at once and pending ones
+take their place, instead of every example of a static batch waiting for its longest output.
+
+    python graph2text_continuous.py generate --model outputs/best_tfmr --input data/agenda/test.source \
+        --output test.hypo --num_beams 3 --max_length 384
+    python graph2text_continuous.py benchmark --model outputs/best_tfmr --input data/agenda/test.source
+
+The decoder runs one step for all the beams in flight, whatever their step. Their self-attention caches are
+left-padded to a common length and masked, and the encoder states and cross-attention caches are right-padded. New
+examples are encoded and take their first step together, then join the batch once --refill_fraction of the
+--max_tokens budget is free. The beam search of each example is the one of transformers 3's model.generate, with its
+own max_length (see --length_model), so without a length model the predictions are those of graph2text.py generate.
+T5 and Bart are supported, with the cache layouts of transformers 3.
+"""
+
+import argparse
+import logging
+import sys
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import BartForConditionalGeneration, T5ForConditionalGeneration
+from transformers.generation_utils import BeamHypotheses
+
+from graph2text import Graph2TextGenerator, add_model_args, fast_batch_decode, load_generator, read_chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+class _T5Decoder:
+    """Encoder and decoder steps of T5. Self-attention biases depend on relative positions only, so left-padding the
+    cache is exact; the cross-attention bias of the first block depends on the query's own position, which is given
+    per row."""
+
+    def __init__(self, model):
+        self.model = model
+        self.cross_attention = model.decoder.block[0].layer[1].EncDecAttention
+
+    def encode(self, input_ids, attention_mask):
+        return self.model.get_encoder()(input_ids, attention_mask=attention_mask)[0]
+
+    @contextmanager
+    def row_positions(self, positions):
+        attention = self.cross_attention
+
+        def compute_bias(qlen, klen):
+            # (rows, n_heads, 1, klen): only the last query position is kept when decoding with a cache
+            relative_position = torch.arange(klen, device=positions.device)[None, :] - positions[:, None]
+            rp_bucket = attention._relative_position_bucket(
+                relative_position, bidirectional=False, num_buckets=attention.relative_attention_num_buckets
+            )
+            return attention.relative_attention_bias(rp_bucket).permute([0, 2, 1]).unsqueeze(2)
+
+        attention.compute_bias = compute_bias
+        try:
+            yield
+        finally:
+            del attention.compute_bias
+
+    def step(self, tokens, positions, encoder_hidden_states, encoder_mask, self_mask, cache):
+        past = None
+        if cache is not None:
+            self_cache, cross_cache = cache
+            past = tuple(tuple(self_cache[i : i + 2] + cross_cache[i : i + 2]) for i in range(0, len(self_cache), 2))
+        with self.row_positions(positions):
+            outputs = self.model(
+                input_ids=None,
+                attention_mask=encoder_mask,
+                encoder_outputs=(encoder_hidden_states,),
+                decoder_input_ids=tokens,
+                decoder_attention_mask=self_mask,
+                past_key_values=past,
+                use_cache=True,
+                return_dict=True,
+            )
+        self_cache = [t for layer in outputs.past_key_values for t in layer[:2]]
+        cross_cache = [t for layer in outputs.past_key_values for t in layer[2:]]
+        return outputs.logits[:, -1], (self_cache, cross_cache)
+
+
+class _BartDecoder:
+    """Encoder and decoder steps of Bart. The decoder is called directly, so that it takes a padding mask for its
+    cache, and each row gets the position embedding of its own step."""
+
+    def __init__(self, model):
+        self.model = model
+        self.decoder = model.model.decoder
+
+    def encode(self, input_ids, attention_mask):
+        return self.model.get_encoder()(input_ids, attention_mask=attention_mask)[0]
+
+    @contextmanager
+    def row_positions(self, positions):
+        embed_positions = self.decoder.embed_positions
+        offset = getattr(embed_positions, "offset", 0)
+        embed_positions.forward = lambda input_ids, use_cache=False: torch.nn.Embedding.forward(
+            embed_positions, positions + offset
+        )[:, None]
+        try:
+            yield
+        finally:
+            del embed_positions.forward
+
+    def step(self, tokens, positions, encoder_hidden_states, encoder_mask, self_mask, cache):
+        past = None
+        if cache is not None:
+            self_cache, cross_cache = cache
+            padding_mask = self_mask[:, :-1].eq(0)
+            past = [
+                {
+                    "self": {"prev_key": k, "prev_value": v, "prev_key_padding_mask": padding_mask},
+                    "encoder_decoder": {"prev_key": ck, "prev_value": cv, "prev_key_padding_mask": None},
+                }
+                for k, v, ck, cv in zip(self_cache[::2], self_cache[1::2], cross_cache[::2], cross_cache[1::2])
+            ]
+        with self.row_positions(positions):
+            hidden_states, next_cache = self.decoder(
+                tokens,
+                encoder_hidden_states,
+                encoder_mask,
+                self_mask[:, -1:].eq(0),
+                None,
+                past_key_values=past,
+                use_cache=True,
+            )[:2]
+        logits = F.linear(hidden_states[:, -1], self.model.model.shared.weight, bias=self.model.final_logits_bias)
+        self_cache = [layer["self"][k] for layer in next_cache for k in ["prev_key", "prev_value"]]
+        cross_cache = [layer["encoder_decoder"][k] for layer in next_cache for k in ["prev_key", "prev_value"]]
+        return logits, (self_cache, cross_cache)
+
+
+def _pad(tensor, length, dim, left=False, value=0):
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    padding = tensor.new_full(shape, value)
+    return torch.cat([padding, tensor] if left else [tensor, padding], dim=dim)
+
+
+class _Example:
+    """The beam search state of one source: its beams, their scores and the finished hypotheses."""
+
+    def __init__(self, index, max_length, hypotheses):
+        self.index = index
+        self.max_length = max_length
+        self.hypotheses = hypotheses
+        self.tokens = None  # (num_beams, cur_len)
+        self.beam_scores = None  # (num_beams,)
+
+    @property
+    def cur_len(self):
+        return self.tokens.shape[1]
+
+
+class _Rows:
+    """The beams in flight, num_beams consecutive rows per example, with their encoder states and decoder cache.
+
+    The self-attention cache and self_mask are left-padded (each row's last column is its last step), the encoder
+    states, encoder_mask and cross-attention cache are right-padded.
+    """
+
+    def __init__(self, examples, encoder_hidden_states, encoder_mask, self_mask, cache):
+        self.examples = examples
+        self.encoder_hidden_states = encoder_hidden_states
+        self.encoder_mask = encoder_mask
+        self.self_mask = self_mask
+        self.cache = cache
+
+    def select(self, examples, rows):
+        """Keep `rows` (in that order) for `examples`, and drop the columns that are padding in every kept row."""
+        rows = torch.tensor(rows, dtype=torch.long, device=self.self_mask.device)
+        self_mask = self.self_mask.index_select(0, rows)
+        encoder_mask = self.encoder_mask.index_select(0, rows)
+        first = int(self_mask.sum(0).nonzero()[0]) if len(rows) else 0
+        length = int(encoder_mask.sum(0).nonzero()[-1]) + 1 if len(rows) else 0
+        self_cache, cross_cache = self.cache
+        self.examples = examples
+        self.self_mask = self_mask[:, first:]
+        self.encoder_mask = encoder_mask[:, :length]
+        self.encoder_hidden_states = self.encoder_hidden_states.index_select(0, rows)[:, :length]
+        self.cache = (
+            [t.index_select(0, rows)[:, :, first:] for t in self_cache],
+            [t.index_select(0, rows)[:, :, :length] for t in cross_cache],
+        )
+
+    def extend(self, other: "_Rows"):
+        """Append the rows of `other`, padding both to common lengths."""
+        steps = max(self.self_mask.shape[1], other.self_mask.shape[1])
+        length = max(self.encoder_mask.shape[1], other.encoder_mask.shape[1])
+        self.examples = self.examples + other.examples
+        self.self_mask = torch.cat([_pad(m, steps, 1, left=True) for m in (self.self_mask, other.self_mask)])
+        self.encoder_mask = torch.cat([_pad(m, length, 1) for m in (self.encoder_mask, other.encoder_mask)])
+        self.encoder_hidden_states = torch.cat(
+            [_pad(h, length, 1) for h in (self.encoder_hidden_states, other.encoder_hidden_states)]
+        )
+        self.cache = (
+            [torch.cat([_pad(t, steps, 2, left=True) for t in pair]) for pair in zip(self.cache[0], other.cache[0])],
+            [torch.cat([_pad(t, length, 2) for t in pair]) for pair in zip(self.cache[1], other.cache[1])],
+        )
+
+
+class ContinuousBeamSearch:
+    """Beam search over a queue of sources, refilling the batch as examples finish.
+
+    Uses the model, tokenizer, generate_kwargs, max_tokens and length model of a Graph2TextGenerator. The beams in
+    flight never cost more than max_tokens, counted like Graph2TextGenerator.batches: num_beams x (source +
+    max_length) per example. ``stats`` counts the decoder forward passes and the beam rows they computed.
+    """
+
+    def __init__(self, generator: Graph2TextGenerator, refill_fraction=0.25):
+        model = generator.model
+        if isinstance(model, T5ForConditionalGeneration):
+            self.decoder = _T5Decoder(model)
+        elif isinstance(model, BartForConditionalGeneration):
+            self.decoder = _BartDecoder(model)
+        else:
+            raise ValueError(f"continuous batching supports T5 and Bart, not {type(model).__name__}")
+        self.generator = generator
+        self.model = model
+        self.refill_fraction = refill_fraction
+        config = model.config
+        kwargs = generator.generate_kwargs
+
+        def setting(name):
+            return getattr(config, name) if kwargs.get(name) is None else kwargs[name]
+
+        self.num_beams = setting("num_beams")
+        if self.num_beams < 2:
+            raise ValueError("continuous batching is for beam search, use graph2text.py generate for greedy decoding")
+        self.length_penalty = setting("length_penalty")
+        self.early_stopping = setting("early_stopping")
+        self.min_length = setting("min_length")
+        self.no_repeat_ngram_size = setting("no_repeat_ngram_size")
+        self.repetition_penalty = setting("repetition_penalty")
+        self.bad_words_ids = setting("bad_words_ids")
+        self.eos_token_id = config.eos_token_id
+        self.pad_token_id = config.pad_token_id
+        if config.decoder_start_token_id is not None:
+            self.decoder_start_token_id = config.decoder_start_token_id
+        else:
+            self.decoder_start_token_id = config.bos_token_id
+        self.vocab_size = config.vocab_size
+        self.stats = dict(forward_passes=0, rows=0)
+
+    def cost(self, input_ids, max_length) -> int:
+        return self.num_beams * (len(input_ids) + max_length)
+
+    def start(self, examples: List[_Example], input_ids: List[List[int]]):
+        """Encode the sources of `examples` and take their first decoder step."""
+        inputs = self.generator.pad(input_ids)
+        device = inputs["input_ids"].device
+        rows = torch.arange(len(examples), device=device).repeat_interleave(self.num_beams)
+        encoder_hidden_states = self.decoder.encode(inputs["input_ids"], inputs["attention_mask"])
+        encoder_hidden_states = encoder_hidden_states.index_select(0, rows)
+        encoder_mask = inputs["attention_mask"].index_select(0, rows)
+        tokens = torch.full((len(rows), 1), self.decoder_start_token_id, dtype=torch.long, device=device)
+        self_mask = torch.ones_like(tokens)
+        for example in examples:
+            example.tokens = tokens[: self.num_beams]
+            example.beam_scores = torch.zeros(self.num_beams, device=device)
+            example.beam_scores[1:] = -1e9  # the beams are identical until the first step
+        logits, cache = self.decoder.step(
+            tokens, torch.zeros_like(rows), encoder_hidden_states, encoder_mask, self_mask, None
+        )
+        return _Rows(examples, encoder_hidden_states, encoder_mask, self_mask, cache), logits
+
+    def step(self, rows: _Rows):
+        tokens = torch.cat([example.tokens[:, -1:] for example in rows.examples])
+        positions = torch.tensor(
+            [example.cur_len - 1 for example in rows.examples], device=tokens.device
+        ).repeat_interleave(self.num_beams)
+        self_mask = torch.cat([rows.self_mask, torch.ones_like(tokens)], dim=1)
+        logits, rows.cache = self.decoder.step(
+            tokens, positions, rows.encoder_hidden_states, rows.encoder_mask, self_mask, rows.cache
+        )
+        rows.self_mask = self_mask
+        return logits
+
+    def advance(self, rows: _Rows, logits, outputs: List[Optional[List[int]]]):
+        """One beam search step for every example of `rows`, as in transformers 3's _generate_beam_search.
+
+        Finished examples write their best hypothesis to outputs and leave `rows`; the rows of the others follow
+        their beams.
+        """
+        num_beams = self.num_beams
+        groups = defaultdict(list)  # the logit adjustments depend on cur_len and max_length
+        for i, example in enumerate(rows.examples):
+            groups[(example.cur_len, example.max_length)].append(i)
+        selected = {}
+        for (cur_len, max_length), indices in groups.items():
+            examples = [rows.examples[i] for i in indices]
+            group_rows = [i * num_beams + b for i in indices for b in range(num_beams)]
+            group_rows = torch.tensor(group_rows, device=logits.device)
+            group_logits = self.model.adjust_logits_during_generation(
+                logits.index_select(0, group_rows), cur_len=cur_len, max_length=max_length
+            )
+            scores = self.model.postprocess_next_token_scores(
+                scores=F.log_softmax(group_logits, dim=-1),
+                input_ids=torch.cat([example.tokens for example in examples]),
+                no_repeat_ngram_size=self.no_repeat_ngram_size,
+                bad_words_ids=self.bad_words_ids,
+                cur_len=cur_len,
+                min_length=self.min_length,
+                max_length=max_length,
+                eos_token_id=self.eos_token_id,
+                repetition_penalty=self.repetition_penalty,
+                batch_size=len(examples),
+                num_beams=num_beams,
+            )
+            beam_scores = torch.cat([example.beam_scores for example in examples])
+            next_scores = (scores + beam_scores[:, None]).view(len(examples), num_beams * self.vocab_size)
+            next_scores, next_tokens = torch.topk(next_scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+            for i, example, example_scores, example_tokens in zip(indices, examples, next_scores, next_tokens):
+                selected[i] = self.select_beams(example, example_scores, example_tokens)
+
+        examples, kept_rows = [], []
+        for i, example in enumerate(rows.examples):
+            beams = selected[i]
+            if beams is not None:
+                scores, tokens, beam_ids = zip(*beams)
+                example.beam_scores = example.beam_scores.new_tensor(scores)
+                beam_ids = list(beam_ids)
+                example.tokens = torch.cat([example.tokens[beam_ids], example.tokens.new_tensor(tokens)[:, None]], 1)
+                if example.cur_len < example.max_length:
+                    examples.append(example)
+                    kept_rows.extend(i * num_beams + b for b in beam_ids)
+                    continue
+                for beam_tokens, score in zip(example.tokens, example.beam_scores.tolist()):
+                    example.hypotheses.add(beam_tokens, score)
+            best = sorted(example.hypotheses.beams, key=lambda x: x[0]).pop()[1]
+            outputs[example.index] = best.tolist() + ([self.eos_token_id] if len(best) < example.max_length else [])
+        rows.select(examples, kept_rows)
+
+    def select_beams(self, example: _Example, next_scores, next_tokens):
+        """The (score, token, beam) of the next beams of `example`, or None once its hypotheses are final."""
+        num_beams = self.num_beams
+        beams = []
+        for rank, (token, score) in enumerate(zip(next_tokens.tolist(), next_scores.tolist())):
+            beam_id, token_id = divmod(token, self.vocab_size)
+            if self.eos_token_id is not None and token_id == self.eos_token_id:
+                if rank >= num_beams:
+                    continue
+                example.hypotheses.add(example.tokens[beam_id].clone(), score)
+            else:
+                beams.append((score, token_id, beam_id))
+            if len(beams) == num_beams:
+                break
+        if example.hypotheses.is_done(max(next_scores.tolist()), example.cur_len):
+            return None
+        return beams
+
+    @torch.no_grad()
+    def generate_lines(self, lines: List[str]) -> List[str]:
+        """Predictions for `lines`, in the same order."""
+        t0 = time.time()
+        input_ids = self.generator.encode(lines)
+        max_lengths = self.generator.max_lengths(input_ids)
+        pending = deque(range(len(lines)))
+        outputs = [None] * len(lines)
+        rows = None
+        budget = 0
+        with self.generator.autocast():
+            while pending or (rows is not None and rows.examples):
+                new_rows = new_logits = None
+                in_flight = rows.examples if rows is not None else []
+                budget = sum(self.cost(input_ids[e.index], e.max_length) for e in in_flight)
+                if pending and (not in_flight or budget <= (1 - self.refill_fraction) * self.generator.max_tokens):
+                    admitted = []
+                    while pending:
+                        cost = self.cost(input_ids[pending[0]], max_lengths[pending[0]])
+                        if (in_flight or admitted) and budget + cost > self.generator.max_tokens:
+                            break
+                        budget += cost
+                        i = pending.popleft()
+                        hypotheses = BeamHypotheses(
+                            self.num_beams, max_lengths[i], self.length_penalty, early_stopping=self.early_stopping
+                        )
+                        admitted.append(_Example(i, max_lengths[i], hypotheses))
+                    if admitted:
+                        new_rows, new_logits = self.start(admitted, [input_ids[e.index] for e in admitted])
+                        self.count(new_logits)
+                if in_flight:
+                    logits = self.step(rows)
+                    self.count(logits)
+                    self.advance(rows, logits, outputs)
+                if new_rows is not None:
+                    self.advance(new_rows, new_logits, outputs)
+                    if rows is None or not rows.examples:
+                        rows = new_rows
+                    elif new_rows.examples:
+                        rows.extend(new_rows)
+        preds = [text.strip() for text in fast_batch_decode(self.generator.tokenizer, outputs)]
+        stats = self.generator.stats
+        stats["examples"] += len(lines)
+        stats["source_tokens"] += sum(len(ids) for ids in input_ids)
+        stats["generated_tokens"] += sum(sum(t != self.pad_token_id for t in ids) for ids in outputs)
+        stats["seconds"] += time.time() - t0
+        return preds
+
+    def count(self, logits):
+        self.stats["forward_passes"] += 1
+        self.stats["rows"] += logits.shape[0]
+
+    def generate(self, lines: Iterable[str], chunk_size=10000) -> Iterator[str]:
+        """Stream predictions in input order, chunk_size lines at a time."""
+        for chunk in read_chunks(lines, chunk_size):
+            yield from self.generate_lines(chunk)
+
+
+def run_generate(args):
+    generator = load_generator(args)
+    search = ContinuousBeamSearch(generator, refill_fraction=args.refill_fraction)
+    for pred in search.generate(args.input, chunk_size=args.chunk_size):
+        args.output.write(pred + "\n")
+    args.output.flush()
+    logger.info(generator.throughput())
+
+
+def run_benchmark(args):
+    """Decode the input with static length-sorted batches (model.generate) and with continuous batching."""
+    lines = next(read_chunks(args.input, args.n_lines or sys.maxsize), [])
+    generator = load_generator(args)
+    rows = []
+    all_preds = []
+    for name in ["static", "continuous"]:
+        generator.stats = dict(examples=0, source_tokens=0, generated_tokens=0, seconds=0.0)
+        if name == "static":
+            all_preds.append(generator.generate_lines(lines))
+        else:
+            search = ContinuousBeamSearch(generator, refill_fraction=args.refill_fraction)
+            all_preds.append(search.generate_lines(lines))
+            logger.info(
+                "continuous: %s decoder passes, %.1f beam rows per pass",
+                search.stats["forward_passes"],
+                search.stats["rows"] / max(search.stats["forward_passes"], 1),
+            )
+        rows.append((name, len(lines) / max(generator.stats["seconds"], 1e-9)))
+        logger.info("%s: %s", name, generator.throughput())
+    mismatches = [i for i, (a, b) in enumerate(zip(*all_preds)) if a != b]
+    for i in mismatches[:5]:
+        logger.info("line %s differs:\n  static:     %s\n  continuous: %s", i + 1, all_preds[0][i], all_preds[1][i])
+    print(f"identical predictions: {len(lines) - len(mismatches)}/{len(lines)}")
+    for name, examples_per_second in rows:
+        print(f"{name}\t{examples_per_second:.2f} examples/s\t{examples_per_second / rows[0][1]:.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Beam search with continuous batching")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    generate_parser = subparsers.add_parser("generate", help="Write a prediction for every line of a .source file")
+    add_model_args(generate_parser)
+    generate_parser.add_argument("--output", type=argparse.FileType("w"), default="-", help="- for stdout")
+    generate_parser.add_argument("--chunk_size", type=int, default=10000, help="Lines read and decoded at a time")
+    generate_parser.set_defaults(func=run_generate)
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Compare the throughput of continuous batching with static length-sorted batches"
+    )
+    add_model_args(benchmark_parser)
+    benchmark_parser.add_argument("--n_lines", type=int, default=None, help="Only decode the first n lines")
+    benchmark_parser.set_defaults(func=run_benchmark)
+    for subparser in [generate_parser, benchmark_parser]:
+        subparser.add_argument(
+            "--refill_fraction",
+            type=float,
+            default=0.25,
+            help="Admit pending examples once this fraction of --max_tokens is free; each refill costs a decoder pass",
+        )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
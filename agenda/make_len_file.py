@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from transformers import BartTokenizer
+
+from graph2text_common import LengthModel, graph_size_token_ids, load_graph2text_tokenizer
+from utils import get_graph2text_prefix, pickle_save
+
+
+SPLITS = ["train", "val", "test"]
+
+_tokenizer = None
+_dataset_kwargs = {}
+_graph_token_ids = []
+
+
+def _init_worker(tokenizer_name, cache_dir, use_fast):
+    global _tokenizer, _dataset_kwargs, _graph_token_ids
+    _tokenizer = load_graph2text_tokenizer(tokenizer_name, cache_dir=cache_dir, use_fast=use_fast)
+    _dataset_kwargs = {"add_prefix_space": True} if isinstance(_tokenizer, BartTokenizer) else {}
+    _graph_token_ids = graph_size_token_ids(_tokenizer)
+
+
+def _token_lens(job):
+    lines, max_length = job
+    # max_length None: the full length, as truncation=True would fall back on the tokenizer's model_max_length
+    truncation = max_length is not None
+    input_ids = _tokenizer(lines, max_length=max_length, truncation=truncation, **_dataset_kwargs)["input_ids"]
+    return [len(ids) for ids in input_ids]
+
+
+def _graph_sizes(job):
+    lines, max_length = job
+    input_ids = _tokenizer(lines, max_length=max_length, truncation=True, **_dataset_kwargs)["input_ids"]
+    return [int(np.isin(ids, _graph_token_ids).sum()) for ids in input_ids]
+
+
+def read_chunks(path, chunk_size, prefix=""):
+    with Path(path).open() as f:
+        while True:
+            lines = [prefix + x.rstrip("\n") for x in itertools.islice(f, chunk_size)]
+            if not lines:
+                return
+            yield lines
+
+
+def tokenized_lens(pool, path, max_length, chunk_size, prefix=""):
+    """Token length of every line of `path`, tokenized in chunks by the worker pool (order is preserved), truncated
+    to max_length unless it is None."""
+    jobs = ((lines, max_length) for lines in read_chunks(path, chunk_size, prefix=prefix))
+    return list(itertools.chain.from_iterable(pool.imap(_token_lens, jobs)))
+
+
+def fit_length_model(pool, args, prefix="") -> LengthModel:
+    """Fit a LengthModel on the source token counts, graph sizes and target lengths of the train split."""
+    data_dir = Path(args.data_dir)
+    source, target = data_dir.joinpath("train.source"), data_dir.joinpath("train.target")
+    src_lens = tokenized_lens(pool, source, args.max_source_length, args.chunk_size, prefix=prefix)
+    jobs = ((lines, args.max_source_length) for lines in read_chunks(source, args.chunk_size, prefix=prefix))
+    graph_sizes = list(itertools.chain.from_iterable(pool.imap(_graph_sizes, jobs)))
+    # untruncated, as the caps must fit the real outputs; + 1: generate's max_length also counts the decoder start
+    gen_lens = np.array(tokenized_lens(pool, target, None, args.chunk_size)) + 1
+    model = LengthModel.fit(src_lens, graph_sizes, gen_lens, quantile=args.length_quantile, slack=args.length_slack)
+    caps = model.predict(src_lens, graph_sizes)
+    print(
+        f"length model: coef {model.coef.round(3).tolist()}, margin {model.margin:.1f}, "
+        f"{(gen_lens <= caps).mean():.2%} of train targets within their cap, mean cap {caps.mean():.1f} tokens"
+    )
+    return model
+
+
+def main(args):
+    """Write {split}.len with true subword lengths so the samplers bucket on tokens, not characters."""
+    tokenizer_name = args.tokenizer_name if args.tokenizer_name else args.model_name_or_path
+    cache_dir = args.cache_dir or None
+    prefix = get_graph2text_prefix(args.model_name_or_path, cache_dir=cache_dir)
+
+    initargs = (tokenizer_name, cache_dir, args.fast_tokenizer)
+    with Pool(args.num_workers, initializer=_init_worker, initargs=initargs) as pool:
+        for type_path in args.type_paths:
+            data_dir = Path(args.data_dir)
+            src_lens = tokenized_lens(
+                pool, data_dir.joinpath(type_path + ".source"), args.max_source_length, args.chunk_size, prefix=prefix
+            )
+            if args.consider_target:
+                tgt_lens = tokenized_lens(
+                    pool, data_dir.joinpath(type_path + ".target"), args.max_target_length, args.chunk_size
+                )
+                assert len(src_lens) == len(tgt_lens), f"{type_path}.source and {type_path}.target differ in length"
+                lens = [max(s, t) for s, t in zip(src_lens, tgt_lens)]
+            else:
+                lens = src_lens
+            pickle_save(lens, data_dir.joinpath(type_path + ".len"))
+            print(f"{type_path}: {len(lens)} examples, max {max(lens)} tokens")
+        if args.fit_length_model:
+            fit_length_model(pool, args, prefix=prefix).save(Path(args.data_dir).joinpath("length_model.json"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--tokenizer_name", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default="")
+    parser.add_argument("--fast_tokenizer", action="store_true", help="Tokenize with the Rust tokenizer")
+    parser.add_argument("--type_paths", type=str, nargs="+", default=SPLITS)
+    parser.add_argument("--max_source_length", type=int, default=1024)
+    parser.add_argument("--max_target_length", type=int, default=56)
+    parser.add_argument(
+        "--consider_target",
+        action="store_true",
+        help="Store max(source, target) token length per example instead of the source length only.",
+    )
+    parser.add_argument(
+        "--fit_length_model",
+        action="store_true",
+        help="Also fit the output length caps of --length_model on the untruncated train targets and write them to "
+        "data_dir/length_model.json.",
+    )
+    parser.add_argument(
+        "--length_quantile", type=float, default=1.0, help="Quantile of the train residuals added to the caps"
+    )
+    parser.add_argument("--length_slack", type=float, default=1.0, help="Multiplies the margin of the caps")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Tokenizer processes")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Lines sent to a worker at a time")
+    main(parser.parse_args())
@@ -0,0 +1,204 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from conftest import GRAPHS, write_split
+from utils import (
+    AbstractSeq2SeqDataset,
+    BinarizedSeq2SeqDataset,
+    LineOffsetReader,
+    Seq2SeqDataset,
+    StreamingSeq2SeqDataset,
+    binarize_split,
+    binarized_cache_prefix,
+    parse_corpora,
+)
+
+
+MAX_LEN = 48  # truncates the longest graphs and texts
+
+
+def test_binarized_dataset_matches_tokenizer(tokenizer, data_dir):
+    cache_prefix = str(data_dir / "cached_train")
+    binarized = BinarizedSeq2SeqDataset(tokenizer, data_dir, MAX_LEN, MAX_LEN, cache_prefix=cache_prefix)
+    text = Seq2SeqDataset(tokenizer, data_dir, MAX_LEN, MAX_LEN)
+    assert len(binarized) == len(GRAPHS)
+    assert binarized.used_char_len is False
+
+    for i, (src, tgt) in enumerate(GRAPHS):
+        expected = tokenizer.prepare_seq2seq_batch(
+            [src], tgt_texts=[tgt], max_length=MAX_LEN, max_target_length=MAX_LEN, padding=False,
+            return_tensors=None, add_prefix_space=True,
+        )
+        item = binarized[i]
+        assert item["input_ids"].tolist() == expected["input_ids"][0]
+        assert item["labels"].tolist() == expected["labels"][0]
+        assert item["id"] == i
+        assert binarized.src_lens[i] == len(expected["input_ids"][0])
+        assert binarized.tgt_lens[i] == len(expected["labels"][0])
+    assert max(binarized.src_lens) == MAX_LEN
+
+    indices = [2, 0, 4]
+    batch = binarized.collate_fn([binarized[i] for i in indices])
+    expected = text.collate_fn([text[i] for i in indices])
+    assert set(batch) == set(expected)
+    for key in expected:
+        assert torch.equal(batch[key], expected[key]), key
+
+
+def test_binarized_cache_is_built_once(tokenizer, data_dir):
+    cache_prefix = str(data_dir / "cached_train")
+    src_file, tgt_file = data_dir / "train.source", data_dir / "train.target"
+    num_examples = binarize_split(tokenizer, src_file, tgt_file, cache_prefix, 64, 64, add_prefix_space=True)
+    assert num_examples == len(GRAPHS)
+    assert not [name for name in os.listdir(data_dir) if name.endswith(".tmp")]
+    mtime = os.path.getmtime(f"{cache_prefix}.json")
+
+    dataset = BinarizedSeq2SeqDataset(tokenizer, data_dir, 64, 64, n_obs=3, cache_prefix=cache_prefix)
+    assert os.path.getmtime(f"{cache_prefix}.json") == mtime
+    assert len(dataset) == 3
+    src_ids = tokenizer([src for src, _ in GRAPHS], max_length=64, truncation=True, add_prefix_space=True)["input_ids"]
+    assert np.memmap(f"{cache_prefix}.src.idx", dtype=np.int64, mode="r")[-1] == sum(len(x) for x in src_ids)
+
+
+def test_binarized_dataset_pickles_without_memmaps(tokenizer, data_dir):
+    dataset = BinarizedSeq2SeqDataset(tokenizer, data_dir, 64, 64, cache_prefix=str(data_dir / "cached_train"))
+    dataset[0]  # open the memmaps, as the main process does before forking workers
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy._memmaps is None
+    for i in range(len(dataset)):
+        assert copy[i]["input_ids"].tolist() == dataset[i]["input_ids"].tolist()
+        assert copy[i]["labels"].tolist() == dataset[i]["labels"].tolist()
+
+
+def test_binarized_cache_prefix_depends_on_tokenization(tokenizer, data_dir):
+    def cache_prefix(prefix="", max_source_length=64):
+        return binarized_cache_prefix(data_dir, "train", "t5-small", tokenizer, prefix, max_source_length, 64)
+
+    assert cache_prefix() == cache_prefix()
+    assert cache_prefix() != cache_prefix(prefix="translate Graph to English: ")
+    assert cache_prefix() != cache_prefix(max_source_length=32)
+
+
+LINES = [
+    "<H> Alan_Bean <R> occupation <T> Test_pilot",
+    "",
+    "Ajoblanco est d\u2019Espagne \u00e0 100 %",  # multi-byte characters
+    "x" * 50,
+    "last",
+]
+
+
+@pytest.mark.parametrize("trailing_newline", [True, False])
+@pytest.mark.parametrize("chunk_size", [1 << 24, 7])
+def test_line_offset_reader_reads_every_line(tmp_path, trailing_newline, chunk_size):
+    path = tmp_path / "train.source"
+    path.write_text("\n".join(LINES) + ("\n" if trailing_newline else ""), encoding="utf-8")
+    reader = LineOffsetReader(path, chunk_size=chunk_size)
+    assert len(reader) == len(LINES)
+    assert [reader[i] for i in range(len(reader))] == LINES
+    # byte lengths, with the newline, as used for the samplers' character lengths
+    expected_lens = [len(line.encode("utf-8")) + 1 for line in LINES]
+    if not trailing_newline:
+        expected_lens[-1] -= 1
+    assert AbstractSeq2SeqDataset.get_char_lens(path) == expected_lens
+
+
+def test_line_offset_reader_reuses_its_index(tmp_path, monkeypatch):
+    path = tmp_path / "train.source"
+    path.write_text("\n".join(LINES) + "\n", encoding="utf-8")
+    LineOffsetReader(path)
+    assert os.path.exists(f"{path}.offsets")
+
+    def build_offsets(self):
+        raise AssertionError("rebuilt an up-to-date index")
+
+    with monkeypatch.context() as m:
+        m.setattr(LineOffsetReader, "build_offsets", build_offsets)
+        reader = LineOffsetReader(path)
+    assert isinstance(reader.offsets, np.memmap)
+    assert reader[2] == LINES[2]
+
+    # a changed file gets a new index
+    path.write_text("\n".join(LINES + ["one more"]) + "\n", encoding="utf-8")
+    os.utime(path, (os.path.getmtime(f"{path}.offsets") + 1,) * 2)
+    reader = LineOffsetReader(path)
+    assert len(reader) == len(LINES) + 1
+    assert reader[len(LINES)] == "one more"
+
+
+def test_line_offset_reader_pickles_without_its_mmap(tmp_path):
+    path = tmp_path / "train.source"
+    path.write_text("\n".join(LINES) + "\n", encoding="utf-8")
+    reader = LineOffsetReader(path)
+    reader[0]  # open the mmap, as the main process does before forking workers
+    copy = pickle.loads(pickle.dumps(reader))
+    assert copy._mmap is None
+    assert [copy[i] for i in range(len(copy))] == LINES
+
+
+def write_shards(corpus_dir, name, num_shards, num_lines):
+    """Shards {name}{k}.source/.target whose lines name the shard and line, e.g. "a2-7" and "A2-7"."""
+    corpus_dir.mkdir(exist_ok=True)
+    for k in range(num_shards):
+        pairs = [(f"{name}{k}-{i}", f"{name.upper()}{k}-{i}") for i in range(num_lines)]
+        write_split(corpus_dir, f"{name}{k}", pairs)
+    return str(corpus_dir / f"{name}*.source")
+
+
+def stream(tokenizer, corpora, num_replicas=1, epoch=0, num_workers=0, **kwargs) -> list:
+    """The (source, target) pairs of every rank, in rank order."""
+    per_rank = []
+    for rank in range(num_replicas):
+        dataset = StreamingSeq2SeqDataset(
+            tokenizer, corpora, 64, 64, shuffle_buffer_size=4, seed=1, num_replicas=num_replicas, rank=rank, **kwargs
+        )
+        dataset.set_epoch(epoch)
+        loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+        per_rank.append([(x["src_texts"], x["tgt_texts"]) for x in loader])
+    return per_rank
+
+
+@pytest.mark.parametrize("num_shards", [4, 1])
+def test_streaming_dataset_splits_shards_between_readers(tokenizer, tmp_path, num_shards):
+    corpora = [(write_shards(tmp_path / "a", "a", num_shards, 12), 1.0)]
+    lines = [f"a{k}-{i}" for k in range(num_shards) for i in range(12)]
+
+    for num_replicas, num_workers in [(1, 0), (2, 0), (2, 2)]:
+        per_rank = stream(tokenizer, corpora, num_replicas=num_replicas, num_workers=num_workers)
+        assert all(tgt == src.upper() for x in per_rank for src, tgt in x)
+        # an epoch of all the lines, each read once by exactly one reader
+        assert sorted(src for x in per_rank for src, _ in x) == sorted(lines)
+
+    per_rank = stream(tokenizer, corpora, num_replicas=2)
+    assert stream(tokenizer, corpora, num_replicas=2) == per_rank
+    reshuffled = stream(tokenizer, corpora, num_replicas=2, epoch=1)
+    assert reshuffled != per_rank
+    assert sorted(reshuffled[0] + reshuffled[1]) == sorted(per_rank[0] + per_rank[1])
+
+
+def test_streaming_dataset_mixes_corpora_by_weight(tokenizer, tmp_path):
+    corpora = [(write_shards(tmp_path / "a", "a", 2, 50), 3.0), (write_shards(tmp_path / "b", "b", 1, 10), 1.0)]
+    (examples,) = stream(tokenizer, corpora, epoch_size=400)
+    assert len(examples) == 400
+    from_a = sum(src.startswith("a") for src, _ in examples)
+    assert 260 < from_a < 340
+    # the small corpus is restarted when it runs out
+    assert len(examples) - from_a > 10
+    assert {src for src, _ in examples if src.startswith("b")} == {f"b0-{i}" for i in range(10)}
+
+    batch = StreamingSeq2SeqDataset(tokenizer, corpora, 64, 64).collate_fn(
+        [{"src_texts": src, "tgt_texts": tgt} for src, tgt in examples[:3]]
+    )
+    assert batch["input_ids"].shape[0] == batch["labels"].shape[0] == 3
+
+
+def test_parse_corpora():
+    assert parse_corpora(["data/silver/*.source:0.3", "data/gold/train.source"]) == [
+        ("data/silver/*.source", 0.3),
+        ("data/gold/train.source", 1.0),
+    ]
@@ -0,0 +1,94 @@
+import argparse
+import json
+
+import numpy as np
+import pytest
+
+import make_len_file
+from conftest import GRAPHS, write_split
+from graph2text_common import LengthModel, graph_size_token_ids, load_graph2text_tokenizer
+from transformers import BartConfig
+from utils import pad_token_ids, pickle_load
+
+
+@pytest.fixture
+def lengths():
+    rng = np.random.RandomState(0)
+    src_lens = rng.randint(10, 200, size=500)
+    graph_sizes = rng.randint(1, 8, size=500)
+    gen_lens = np.maximum(2, (0.4 * src_lens + 3 * graph_sizes + rng.normal(0, 5, size=500)).astype(int))
+    return src_lens, graph_sizes, gen_lens
+
+
+def test_length_model_caps_training_targets(lengths):
+    src_lens, graph_sizes, gen_lens = lengths
+    model = LengthModel.fit(src_lens, graph_sizes, gen_lens)
+    caps = model.predict(src_lens, graph_sizes)
+    assert (caps >= gen_lens).all()
+    assert caps.dtype == np.int64
+    np.testing.assert_allclose(model.coef, [0, 0.4, 3], atol=1)
+    assert model.predict([0], [0])[0] >= model.min_length == gen_lens.min()
+
+    loose = LengthModel.fit(src_lens, graph_sizes, gen_lens, quantile=0.9)
+    assert 0.85 < (loose.predict(src_lens, graph_sizes) >= gen_lens).mean() < 0.95
+    assert (LengthModel.fit(src_lens, graph_sizes, gen_lens, slack=2.0).predict(src_lens, graph_sizes) >= caps).all()
+
+
+def test_length_model_save_load(lengths, tmp_path):
+    model = LengthModel.fit(*lengths)
+    model.save(tmp_path / "length_model.json")
+    loaded = LengthModel.load(tmp_path / "length_model.json")
+    assert loaded.coef.tolist() == model.coef.tolist()
+    assert (loaded.margin, loaded.min_length) == (model.margin, model.min_length)
+    np.testing.assert_array_equal(loaded.predict(*lengths[:2]), model.predict(*lengths[:2]))
+
+
+def test_length_model_predict_ids_ignores_padding(tokenizer):
+    model = LengthModel([1.0, 0.5, 4.0], 2.0)
+    graph_token_ids = graph_size_token_ids(tokenizer)
+    input_ids = tokenizer([src for src, _ in GRAPHS], add_prefix_space=True)["input_ids"]
+    graph_sizes = [np.isin(ids, graph_token_ids).sum() for ids in input_ids]
+    assert min(graph_sizes) > 0
+    expected = model.predict([len(ids) for ids in input_ids], graph_sizes)
+
+    np.testing.assert_array_equal(model.predict_ids(input_ids, graph_token_ids), expected)
+    padded, attention_mask = pad_token_ids(input_ids, tokenizer.pad_token_id, pad_to_multiple_of=64)
+    np.testing.assert_array_equal(model.predict_ids(padded, graph_token_ids, attention_mask), expected)
+
+
+def test_make_len_file_fits_untruncated_targets(tokenizer, tmp_path):
+    model_dir, data_dir = tmp_path / "model", tmp_path / "data"
+    model_dir.mkdir()
+    tokenizer.save_vocabulary(str(model_dir))
+    BartConfig(vocab_size=len(tokenizer)).save_pretrained(str(model_dir))
+    # the tokenizer make_len_file loads, with all of load_graph2text_tokenizer's graph tokens
+    tokenizer = load_graph2text_tokenizer(str(model_dir))
+    data_dir.mkdir()
+    write_split(data_dir, "train", GRAPHS)
+    args = argparse.Namespace(
+        data_dir=str(data_dir),
+        model_name_or_path=str(model_dir),
+        tokenizer_name=None,
+        cache_dir="",
+        fast_tokenizer=False,
+        type_paths=["train"],
+        max_source_length=64,
+        max_target_length=8,
+        consider_target=False,
+        fit_length_model=True,
+        length_quantile=1.0,
+        length_slack=1.0,
+        num_workers=2,
+        chunk_size=3,
+    )
+    make_len_file.main(args)
+
+    src_ids = tokenizer([src for src, _ in GRAPHS], max_length=64, truncation=True, add_prefix_space=True)["input_ids"]
+    assert pickle_load(data_dir / "train.len") == [len(ids) for ids in src_ids]
+    with open(data_dir / "length_model.json") as f:
+        assert set(json.load(f)) == {"coef", "margin", "min_length"}
+    model = LengthModel.load(data_dir / "length_model.json")
+    # the caps fit the whole targets, plus the decoder start token, not the targets cut to max_target_length
+    gen_lens = [len(ids) + 1 for ids in tokenizer([tgt for _, tgt in GRAPHS], add_prefix_space=True)["input_ids"]]
+    assert min(gen_lens) > args.max_target_length + 1
+    assert (model.predict_ids(src_ids, graph_size_token_ids(tokenizer)) >= gen_lens).all()
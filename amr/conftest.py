@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from transformers import BartTokenizer
+from transformers.tokenization_gpt2 import bytes_to_unicode
+
+
+GRAPHS = [
+    ("( want-01 :ARG0 ( boy ) :ARG1 ( go-02 :ARG0 boy ) )", "the boy wants to go ."),
+    ("( sing-01 :ARG0 ( girl ) :time ( yesterday ) )", "the girl sang yesterday ."),
+    (
+        "( say-01 :ARG0 ( person :wiki - :name ( name :op1 obama ) ) :ARG1 ( win-01 :ARG0 ( team :mod ( our ) ) ) )",
+        "obama said that our team won .",
+    ),
+    ("( rain-01 :location ( city :wiki - :name ( name :op1 london ) ) )", "it rains in london ."),
+    (
+        "( possible-01 :ARG1 ( recommend-01 :ARG0 ( i ) :ARG1 ( book :quant 2 ) :ARG2 ( you ) ) :polarity - )",
+        "i can not recommend two books to you .",
+    ),
+    ("( tall :domain ( tree :mod ( old ) ) )", "the old tree is tall ."),
+    ("( eat-01 :ARG0 ( cat ) :ARG1 ( fish ) :manner ( quick ) )", "the cat eats the fish quickly ."),
+]
+
+
+@pytest.fixture(scope="session")
+def tokenizer(tmp_path_factory):
+    """A byte-level BART tokenizer with no merges and some AMR relations, built offline."""
+    save_dir = tmp_path_factory.mktemp("tokenizer")
+    vocab = ["<s>", "<pad>", "</s>", "<unk>"] + sorted(set(bytes_to_unicode().values())) + ["<mask>"]
+    with open(save_dir / "vocab.json", "w") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(save_dir / "merges.txt", "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = BartTokenizer(str(save_dir / "vocab.json"), str(save_dir / "merges.txt"))
+    relations = [":ARG0", ":ARG1", ":ARG2", ":mod", ":time", ":location"]
+    tokenizer.add_special_tokens({"additional_special_tokens": relations})
+    return tokenizer
+
+
+def write_split(data_dir, type_path, pairs, trailing_newline=True):
+    for ext, lines in [("source", [src for src, _ in pairs]), ("target", [tgt for _, tgt in pairs])]:
+        text = "\n".join(lines) + ("\n" if trailing_newline else "")
+        data_dir.joinpath(f"{type_path}.{ext}").write_text(text, encoding="utf-8")
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """A data dir with a train split of GRAPHS."""
+    write_split(tmp_path, "train", GRAPHS)
+    return tmp_path
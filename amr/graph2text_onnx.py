@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+"""Export a graph-to-text model to ONNX (or TorchScript) and generate from the exported graphs on CPU.
+
+    python graph2text_onnx.py export --model outputs/best_tfmr --output_dir outputs/onnx
+    python graph2text_onnx.py benchmark --model outputs/best_tfmr --onnx_dir outputs/onnx \
+        --input data/amr/val.source
+    python graph2text.py generate --model outputs/onnx --input data/amr/test.source --output test.hypo
+
+The model is split into three graphs: the encoder, decoder_init for the first decoding step, which also returns the
+cross-attention keys and values, and decoder for the next steps, which takes and returns the cached keys and values.
+OnnxSeq2SeqLM runs them behind the interface that model.generate needs, so the beam search is transformers' own and
+gives the outputs of the PyTorch model. The export directory also holds the config and the tokenizer (with the graph
+tokens), so graph2text.py loads it like a best_tfmr directory.
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+import transformers
+from transformers import AutoConfig
+from transformers.generation_utils import GenerationMixin
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
+
+from graph2text import Graph2TextGenerator, read_chunks
+
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+ONNX_CONFIG_NAME = "graph2text_onnx.json"
+GRAPHS = ["encoder", "decoder_init", "decoder"]
+FORMATS = {"onnx": ".onnx", "torchscript": ".pt"}
+# torch >= 2.5 exports through torch.export unless dynamo=False
+TORCH_ONNX_HAS_DYNAMO = "dynamo" in inspect.signature(torch.onnx.export).parameters
+
+
+def flatten_past(past) -> Tuple[List[torch.Tensor], object]:
+    """The tensors of a decoder cache and its structure, which unflatten_past rebuilds the cache from.
+
+    The cache is nested tuples (T5: four tensors per layer), lists and dicts (Bart: a dict of dicts per layer) of
+    tensors and Nones. The structure is json serializable, so that it is saved with the exported graphs.
+    """
+    tensors = []
+
+    def structure(x):
+        if isinstance(x, torch.Tensor):
+            tensors.append(x)
+            return "tensor"
+        if x is None:
+            return None
+        if isinstance(x, dict):
+            return {"dict": [[k, structure(v)] for k, v in x.items()]}
+        return {type(x).__name__: [structure(v) for v in x]}
+
+    return tensors, structure(past)
+
+
+def unflatten_past(tensors, structure):
+    tensors = iter(tensors)
+
+    def build(s):
+        if s == "tensor":
+            return next(tensors)
+        if s is None:
+            return None
+        ((kind, items),) = s.items()
+        if kind == "dict":
+            return {k: build(v) for k, v in items}
+        values = [build(v) for v in items]
+        return tuple(values) if kind == "tuple" else values
+
+    return build(structure)
+
+
+class _EncoderGraph(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids, attention_mask=attention_mask)[0]
+
+
+class _DecoderGraph(torch.nn.Module):
+    """One decoding step: the logits of the last position and the flattened cache. Without past tensors it is the
+    first step. decoder_input_ids holds all the tokens so far, as in model.generate."""
+
+    def __init__(self, model, past_structure=None):
+        super().__init__()
+        self.model = model
+        self.past_structure = past_structure
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, attention_mask, *past_tensors):
+        past = unflatten_past(past_tensors, self.past_structure) if past_tensors else None
+        outputs = self.model(
+            input_ids=None,
+            attention_mask=attention_mask,
+            encoder_outputs=(encoder_hidden_states,),
+            decoder_input_ids=decoder_input_ids,
+            past_key_values=past,
+            use_cache=True,
+            return_dict=True,
+        )
+        present, _ = flatten_past(outputs.past_key_values)
+        return (outputs.logits[:, -1:],) + tuple(present)
+
+
+def _seq_axis(tensor) -> int:
+    # (batch, heads, length, head_dim) keys and values, (batch, length) padding masks
+    return 2 if tensor.dim() == 4 else 1
+
+
+def export_graphs(model, output_dir, export_format="onnx", opset_version=12, batch_size=2, source_length=13) -> dict:
+    """Trace the encoder, decoder_init and decoder graphs of `model` into output_dir, with dynamic batch and lengths.
+
+    Returns the export config, which records the names of the inputs and outputs of each graph and the structure
+    of the cache.
+    """
+    model = model.cpu().eval()
+    config = model.config
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    input_ids = torch.randint(3, config.vocab_size, (batch_size, source_length))  # no special tokens
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1:, source_length - 4 :] = 0  # padded rows
+    decoder_input_ids = torch.full((batch_size, 1), config.decoder_start_token_id, dtype=torch.long)
+    graphs = {}
+    with torch.no_grad():
+        encoder = _EncoderGraph(model)
+        encoder_hidden_states = encoder(input_ids, attention_mask)
+        graphs["encoder"] = dict(
+            module=encoder,
+            inputs={"input_ids": input_ids, "attention_mask": attention_mask},
+            outputs=["encoder_hidden_states"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "source"},
+                "attention_mask": {0: "batch", 1: "source"},
+                "encoder_hidden_states": {0: "batch", 1: "source"},
+            },
+        )
+
+        decoder_kwargs = dict(
+            input_ids=None, attention_mask=attention_mask, encoder_outputs=(encoder_hidden_states,), use_cache=True
+        )
+        outputs = model(decoder_input_ids=decoder_input_ids, return_dict=True, **decoder_kwargs)
+        past, past_structure = flatten_past(outputs.past_key_values)
+        decoder_inputs = {
+            "decoder_input_ids": decoder_input_ids,
+            "encoder_hidden_states": encoder_hidden_states,
+            "attention_mask": attention_mask,
+        }
+        decoder_axes = {
+            "decoder_input_ids": {0: "batch", 1: "target"},
+            "encoder_hidden_states": {0: "batch", 1: "source"},
+            "attention_mask": {0: "batch", 1: "source"},
+            "logits": {0: "batch"},
+        }
+        graphs["decoder_init"] = dict(
+            module=_DecoderGraph(model),
+            inputs=decoder_inputs,
+            outputs=["logits"] + [f"present_{i}" for i in range(len(past))],
+            dynamic_axes=dict(
+                decoder_axes,
+                **{f"present_{i}": {0: "batch", _seq_axis(t): f"present_{i}_length"} for i, t in enumerate(past)},
+            ),
+        )
+
+        # a cache longer than one step, so that its length is not traced as a constant
+        for _ in range(2):
+            next_tokens = outputs.logits[:, -1].argmax(-1, keepdim=True)
+            decoder_input_ids = torch.cat([decoder_input_ids, next_tokens], dim=-1)
+            outputs = model(
+                decoder_input_ids=decoder_input_ids,
+                past_key_values=unflatten_past(past, past_structure),
+                return_dict=True,
+                **decoder_kwargs,
+            )
+            past, structure = flatten_past(outputs.past_key_values)
+            assert structure == past_structure, "the cache of the first and the next decoding steps differ"
+        next_tokens = outputs.logits[:, -1].argmax(-1, keepdim=True)
+        decoder_inputs = dict(decoder_inputs, decoder_input_ids=torch.cat([decoder_input_ids, next_tokens], dim=-1))
+        decoder_inputs.update((f"past_{i}", t) for i, t in enumerate(past))
+        graphs["decoder"] = dict(
+            module=_DecoderGraph(model, past_structure),
+            inputs=decoder_inputs,
+            outputs=["logits"] + [f"present_{i}" for i in range(len(past))],
+            dynamic_axes=dict(
+                decoder_axes,
+                **{f"past_{i}": {0: "batch", _seq_axis(t): f"past_{i}_length"} for i, t in enumerate(past)},
+                **{f"present_{i}": {0: "batch", _seq_axis(t): f"present_{i}_length"} for i, t in enumerate(past)},
+            ),
+        )
+
+        for name, graph in graphs.items():
+            path = output_dir.joinpath(name + FORMATS[export_format])
+            args = tuple(graph["inputs"].values())
+            if export_format == "torchscript":
+                torch.jit.trace(graph["module"], args, check_trace=False).save(str(path))
+            else:
+                export_kwargs = {"dynamo": False} if TORCH_ONNX_HAS_DYNAMO else {}
+                torch.onnx.export(
+                    graph["module"],
+                    args,
+                    str(path),
+                    input_names=list(graph["inputs"]),
+                    output_names=graph["outputs"],
+                    dynamic_axes=graph["dynamic_axes"],
+                    opset_version=opset_version,
+                    do_constant_folding=True,
+                    **export_kwargs,
+                )
+            logger.info("Exported %s", path)
+
+    return {
+        "format": export_format,
+        "model_class": model.__class__.__name__,
+        "past_structure": past_structure,
+        "graphs": {name: {"inputs": list(g["inputs"]), "outputs": g["outputs"]} for name, g in graphs.items()},
+    }
+
+
+class _OnnxRuntimeGraph:
+    def __init__(self, path, num_threads):
+        if onnxruntime is None:
+            raise ImportError("Running exported ONNX graphs needs onnxruntime: pip install onnxruntime")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        # the exporter drops inputs that a graph does not use, e.g. encoder_hidden_states of decoder for Bart
+        self.input_names = {x.name for x in self.session.get_inputs()}
+
+    def __call__(self, feeds: Dict[str, torch.Tensor]) -> List[torch.Tensor]:
+        inputs = {k: v.numpy() for k, v in feeds.items() if k in self.input_names}
+        return [torch.from_numpy(x) for x in self.session.run(None, inputs)]
+
+
+class _TorchScriptGraph:
+    def __init__(self, path, input_names):
+        self.module = torch.jit.load(str(path), map_location="cpu")
+        self.input_names = input_names
+
+    def __call__(self, feeds: Dict[str, torch.Tensor]) -> List[torch.Tensor]:
+        outputs = self.module(*[feeds[k] for k in self.input_names])
+        return list(outputs) if isinstance(outputs, (tuple, list)) else [outputs]
+
+
+class OnnxSeq2SeqLM(GenerationMixin):
+    """The graphs written by export_graphs, with the methods model.generate calls on a seq2seq model.
+
+    The graphs run with ONNX Runtime (or TorchScript) on CPU; the cache between steps is the flat list of tensors
+    of the decoder graph. The sessions are opened on first use with torch.get_num_threads() threads, so that a
+    Graph2TextWorkerPool worker opens its own with its own thread count.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with self.path.joinpath(ONNX_CONFIG_NAME).open() as f:
+            self.export_config = json.load(f)
+        self.config = AutoConfig.from_pretrained(str(path))
+        self.model_class = getattr(transformers, self.export_config["model_class"])
+        self._graphs = None
+
+    @property
+    def graphs(self):
+        if self._graphs is None:
+            export_format = self.export_config["format"]
+            self._graphs = {}
+            for name in GRAPHS:
+                path = self.path.joinpath(name + FORMATS[export_format])
+                if export_format == "torchscript":
+                    self._graphs[name] = _TorchScriptGraph(path, self.export_config["graphs"][name]["inputs"])
+                else:
+                    self._graphs[name] = _OnnxRuntimeGraph(path, torch.get_num_threads())
+        return self._graphs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_graphs"] = None  # sessions are not picklable: each process opens its own
+        return state
+
+    def to(self, device):
+        if torch.device(device).type != "cpu":
+            raise ValueError("Exported graphs run on CPU, use --device cpu")
+        return self
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        return self
+
+    def parameters(self):
+        # model.generate takes its device from the first parameter
+        return iter([torch.zeros(0)])
+
+    def get_output_embeddings(self):
+        # model.generate only checks that there is a language modeling head
+        return self.graphs["decoder"]
+
+    def get_encoder(self):
+        return self.encode
+
+    def encode(self, input_ids, attention_mask=None, **kwargs) -> BaseModelOutput:
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        (last_hidden_state,) = self.graphs["encoder"]({"input_ids": input_ids, "attention_mask": attention_mask})
+        return BaseModelOutput(last_hidden_state=last_hidden_state)
+
+    def prepare_inputs_for_generation(self, input_ids, past=None, attention_mask=None, encoder_outputs=None, **kwargs):
+        return {
+            "decoder_input_ids": input_ids,
+            "past": past,
+            "attention_mask": attention_mask,
+            "encoder_outputs": encoder_outputs,
+        }
+
+    def __call__(self, decoder_input_ids, past, attention_mask, encoder_outputs, **kwargs) -> Seq2SeqLMOutput:
+        feeds = {
+            "decoder_input_ids": decoder_input_ids,
+            "encoder_hidden_states": encoder_outputs[0],
+            "attention_mask": attention_mask,
+        }
+        if past is None:
+            logits, *present = self.graphs["decoder_init"](feeds)
+        else:
+            feeds.update((f"past_{i}", t) for i, t in enumerate(past))
+            logits, *present = self.graphs["decoder"](feeds)
+        return Seq2SeqLMOutput(logits=logits, past_key_values=present)
+
+    @staticmethod
+    def _reorder_cache(past, beam_idx):
+        return [t.index_select(0, beam_idx) for t in past]
+
+    # the model's own logit adjustments, e.g. Bart forcing eos at max_length
+    def adjust_logits_during_generation(self, logits, **kwargs):
+        return self.model_class.adjust_logits_during_generation(self, logits, **kwargs)
+
+    def _force_token_ids_generation(self, scores, token_id):
+        return self.model_class._force_token_ids_generation(self, scores, token_id)
+
+
+def run_export(args):
+    generator = Graph2TextGenerator.from_pretrained(
+        args.model, cache_dir=args.cache_dir, use_fast=args.fast_tokenizer, device="cpu"
+    )
+    export_config = export_graphs(
+        generator.model, args.output_dir, export_format=args.format, opset_version=args.opset_version
+    )
+    with Path(args.output_dir).joinpath(ONNX_CONFIG_NAME).open("w") as f:
+        json.dump(export_config, f, indent=4)
+    generator.model.config.save_pretrained(args.output_dir)
+    generator.tokenizer.save_pretrained(args.output_dir)
+
+
+def run_benchmark(args):
+    """Decode the input with the PyTorch model and with the exported graphs; report matches and speed."""
+    with open(args.input) as f:
+        lines = next(read_chunks(f, args.n_lines or sys.maxsize), [])
+    generate_kwargs = dict(num_beams=args.num_beams, max_length=args.max_length, max_tokens=args.max_tokens)
+    rows = []
+    all_preds = []
+    for name, path in [("pytorch", args.model), ("exported", args.onnx_dir)]:
+        generator = Graph2TextGenerator.from_pretrained(
+            path, cache_dir=args.cache_dir, device="cpu", **generate_kwargs
+        )
+        all_preds.append(generator.generate_lines(lines))
+        rows.append((name, len(lines) / max(generator.stats["seconds"], 1e-9)))
+        logger.info("%s: %s", name, generator.throughput())
+    mismatches = [i for i, (a, b) in enumerate(zip(*all_preds)) if a != b]
+    for i in mismatches[:5]:
+        logger.info("line %s differs:\n  pytorch:  %s\n  exported: %s", i + 1, all_preds[0][i], all_preds[1][i])
+    print(f"identical predictions: {len(lines) - len(mismatches)}/{len(lines)}")
+    for name, examples_per_second in rows:
+        print(f"{name}\t{examples_per_second:.2f} examples/s\t{examples_per_second / rows[0][1]:.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export graph-to-text models and benchmark the exported graphs")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser("export", help="Write the encoder, decoder_init and decoder graphs")
+    export_parser.add_argument("--model", type=str, required=True, help="best_tfmr directory or Lightning .ckpt")
+    export_parser.add_argument("--output_dir", type=str, required=True)
+    export_parser.add_argument("--format", type=str, default="onnx", choices=list(FORMATS))
+    export_parser.add_argument(
+        "--opset_version", type=int, default=12, help="T5 needs >= 12 (int64 Min in its relative position buckets)"
+    )
+    export_parser.add_argument("--cache_dir", type=str, default=None)
+    export_parser.add_argument("--fast_tokenizer", action="store_true")
+    export_parser.set_defaults(func=run_export)
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Check that the exported graphs give the predictions of the model, and compare speed"
+    )
+    benchmark_parser.add_argument("--model", type=str, required=True, help="best_tfmr directory or Lightning .ckpt")
+    benchmark_parser.add_argument("--onnx_dir", type=str, required=True, help="output_dir of export")
+    benchmark_parser.add_argument("--input", type=str, required=True, help=".source file, e.g. val.source")
+    benchmark_parser.add_argument("--n_lines", type=int, default=None, help="Only decode the first n lines")
+    benchmark_parser.add_argument("--num_beams", type=int, default=None, help="Defaults to the model config's")
+    benchmark_parser.add_argument("--max_length", type=int, default=None, help="never generate more than n tokens")
+    benchmark_parser.add_argument("--max_tokens", type=int, default=20000)
+    benchmark_parser.add_argument("--cache_dir", type=str, default=None)
+    benchmark_parser.set_defaults(func=run_benchmark)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
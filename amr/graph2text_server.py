@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""HTTP inference server that decodes the graphs of concurrent requests together.
+
+    python graph2text_server.py --model outputs/best_tfmr --port 8080 --max_wait_ms 10
+
+    curl -s localhost:8080/generate -d '{"graphs": ["...", "..."]}'
+    {"texts": ["...", "..."], "latency_ms": 212.4}
+
+POST /generate takes a JSON object with one of "graph" (a linearized graph, as in the .source files), "graphs" (a
+list of them), "amr" (an AMR in Penman notation) or "amrs" (a list of them). Penman input needs parsimonious and nltk.
+GET /health reports the number of queued graphs, and the metrics of the result cache.
+
+Requests are queued. MicroBatcher waits at most --max_wait_ms after the first queued graph for others to join (less
+if they already fill --max_tokens), then decodes everything queued in length-sorted batches of at most --max_tokens
+(see Graph2TextGenerator.batches). Graphs beyond --max_queue are refused with 503.
+
+With --cache_size or --cache_path, graphs are decoded in their canonical form (see graph2text_cache.py), and a graph
+that was decoded before, or is being decoded for another request, skips beam search.
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from graph2text import Graph2TextGenerator, PRECISIONS, load_generator
+from graph2text_cache import GraphCache, canonical_graph
+
+
+logger = logging.getLogger(__name__)
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+
+SENSE_PATTERN = re.compile("-[0-9][0-9]$")
+
+
+def linearize_amr(penman: str) -> str:
+    """The linearized graph of data/preproc_amr.py --mode LIN: without variables, senses, quotes and alignments, and
+    with re-entrancies replaced by their concept, so the variable names of the Penman string do not matter."""
+    if not isinstance(penman, str):
+        raise ValueError("an AMR must be a Penman string")
+    from data.amr import AMR, Var  # needs parsimonious and nltk, which only Penman input does
+
+    try:
+        graph = AMR(penman)
+    except Exception as e:  # AMRSyntaxError, AMRError
+        raise ValueError(f"invalid AMR: {e}")
+    v2c = graph.var2concept()
+    nodes = []
+    for token in penman.split():
+        if token.startswith("("):
+            nodes.append("(")
+            continue
+        if token == "/":
+            continue
+        node = token.strip(")").split("~")[0]
+        if not token.startswith(":"):
+            if Var(node) in v2c:
+                node = v2c[Var(node)]._name
+            elif SENSE_PATTERN.search(node):
+                node = node[:-3]
+            elif node[0] == '"' and node[-1] == '"':
+                node = node[1:-1]
+        nodes.append(node)
+        nodes.extend(")" * token.count(")"))
+    return " ".join(nodes)
+
+
+def request_graphs(payload) -> List[str]:
+    """The linearized graphs of a /generate request; ValueError if it has none."""
+    if not isinstance(payload, dict):
+        raise ValueError("expected a JSON object")
+    if "graph" in payload:
+        graphs = [payload["graph"]]
+    elif "graphs" in payload:
+        graphs = payload["graphs"]
+    elif "amr" in payload:
+        graphs = [linearize_amr(payload["amr"])]
+    elif "amrs" in payload:
+        graphs = [linearize_amr(amr) for amr in payload["amrs"]]
+    else:
+        raise ValueError('expected one of "graph", "graphs", "amr" or "amrs"')
+    if not isinstance(graphs, list) or not all(isinstance(g, str) and g.strip() for g in graphs):
+        raise ValueError("graphs must be non-empty strings")
+    return graphs
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MicroBatcher:
+    """Queue graphs from concurrent requests and decode them in micro-batches on one worker thread."""
+
+    def __init__(self, generator: Graph2TextGenerator, max_wait=0.01, max_queue=1024, cache: GraphCache = None):
+        self.generator = generator
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.cache = cache
+        self.decoding = {}  # canonical graph: future, for the graphs of other requests to wait for
+        self.coalesced = 0  # graphs that waited for the decoding of another request
+        self.pending = []  # (input_ids, future) of the graphs that wait for the next micro-batch
+        self.pending_tokens = 0
+        self.queued = 0  # graphs not answered yet, pending or being decoded
+        self.arrived = asyncio.Event()
+        # model.generate is blocking, and one call at a time uses the threads best
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def cost(self, input_ids, max_length) -> int:
+        """The share of max_tokens a graph takes, as in Graph2TextGenerator.batches."""
+        return self.generator.generate_kwargs["num_beams"] * (len(input_ids) + max_length)
+
+    async def generate(self, graphs: List[str]) -> List[str]:
+        loop = asyncio.get_event_loop()
+        if self.cache is not None:
+            graphs = [canonical_graph(graph) for graph in graphs]
+        futures = {}  # one per distinct graph; None until queued
+        for graph in graphs:
+            if graph in futures:
+                continue
+            futures[graph] = None
+            if self.cache is None:
+                continue
+            text = self.cache.get(graph)
+            if text is not None:
+                futures[graph] = loop.create_future()
+                futures[graph].set_result(text)
+            elif graph in self.decoding:
+                futures[graph] = self.decoding[graph]
+                self.coalesced += 1
+        new_graphs = [graph for graph, future in futures.items() if future is None]
+        if self.queued + len(new_graphs) > self.max_queue:
+            raise QueueFull(f"{self.queued} graphs queued, the limit is {self.max_queue}")
+        if new_graphs:
+            input_ids = self.generator.encode(new_graphs)
+            for graph, ids, max_length in zip(new_graphs, input_ids, self.generator.max_lengths(input_ids)):
+                future = futures[graph] = loop.create_future()
+                self.pending.append((ids, future))
+                self.pending_tokens += self.cost(ids, max_length)
+                if self.cache is not None:
+                    self.decoding[graph] = future
+                    future.add_done_callback(functools.partial(self.finish, graph))
+            self.queued += len(new_graphs)
+            self.arrived.set()
+        # shielded: a client that goes away must not cancel the graphs other requests wait for
+        texts = dict(zip(futures, await asyncio.gather(*[asyncio.shield(f) for f in futures.values()])))
+        return [texts[graph] for graph in graphs]
+
+    def finish(self, graph, future):
+        del self.decoding[graph]
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(graph, future.result())
+
+    async def wait_for_batch(self):
+        """Wait for a first graph, then up to max_wait for more, unless the queued graphs already fill a batch."""
+        await self.arrived.wait()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.max_wait
+        while self.pending_tokens < self.generator.max_tokens and loop.time() < deadline:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.wait_for_batch()
+            items, self.pending, self.pending_tokens = self.pending, [], 0
+            self.arrived.clear()
+            input_ids = [ids for ids, _ in items]
+            for batch in self.generator.batches(input_ids):
+                try:
+                    texts = await loop.run_in_executor(
+                        self.executor, self.generator.generate_batch, [input_ids[i] for i in batch]
+                    )
+                except Exception as e:  # answer the requests instead of stopping the server
+                    logger.exception("generate failed")
+                    texts = [e] * len(batch)
+                for i, text in zip(batch, texts):
+                    future = items[i][1]
+                    if not future.done():  # the client may have gone
+                        if isinstance(text, Exception):
+                            future.set_exception(text)
+                        else:
+                            future.set_result(text)
+                self.queued -= len(batch)
+
+
+class Graph2TextServer:
+    """A minimal HTTP/1.1 server on asyncio streams, so that serving needs no web framework."""
+
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+
+    async def handle(self, method, path, body):
+        if path == "/health":
+            health = {"status": "ok", "queued": self.batcher.queued}
+            if self.batcher.cache is not None:
+                health["cache"] = dict(self.batcher.cache.metrics(), coalesced=self.batcher.coalesced)
+            return 200, health
+        if path != "/generate":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        t0 = time.time()
+        try:
+            graphs = request_graphs(json.loads(body.decode("utf-8")))
+        except (ValueError, TypeError) as e:  # json.JSONDecodeError is a ValueError
+            return 400, {"error": str(e)}
+        try:
+            texts = await self.batcher.generate(graphs)
+        except QueueFull as e:
+            return 503, {"error": str(e)}
+        return 200, {"texts": texts, "latency_ms": round(1000 * (time.time() - t0), 1)}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, payload = await self.handle(method, path.split("?")[0], body)
+                except Exception as e:
+                    status, payload = 500, {"error": repr(e)}
+                data = json.dumps(payload).encode("utf-8")
+                head = (
+                    f"HTTP/1.1 {status} {HTTP_STATUS.get(status, 'Internal Server Error')}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n"
+                )
+                writer.write(head.encode("latin-1") + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def cache_namespace(args, generator: Graph2TextGenerator) -> str:
+    """The model file and the generation settings, so that a cache file is never read with another model."""
+    settings = dict(
+        generator.generate_kwargs,
+        model=os.path.abspath(args.model),
+        modified=os.path.getmtime(args.model),
+        precision=args.precision,
+        max_source_length=generator.max_source_length,
+        length_model=args.length_model and os.path.abspath(args.length_model),
+    )
+    return json.dumps(settings, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a graph-to-text model over HTTP with micro-batching")
+    parser.add_argument("--model", type=str, required=True, help="best_tfmr directory, Lightning .ckpt or ONNX export")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max_wait_ms", type=float, default=10.0, help="How long a graph may wait for a batch")
+    parser.add_argument(
+        "--max_tokens", type=int, default=20000, help="Budget of num_beams x (source + max_length) tokens per batch"
+    )
+    parser.add_argument("--max_queue", type=int, default=1024, help="Graphs queued before requests are refused")
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--fast_tokenizer", action="store_true")
+    parser.add_argument("--device", type=str, default=None, help="Defaults to cuda when available")
+    parser.add_argument("--precision", type=str, default="fp32", choices=PRECISIONS)
+    parser.add_argument(
+        "--max_source_length", type=int, default=None, help="Defaults to the checkpoint's, else 1024"
+    )
+    parser.add_argument("--num_beams", type=int, default=None, help="Defaults to the model config's")
+    parser.add_argument("--max_length", type=int, default=None, help="never generate more than n tokens")
+    parser.add_argument("--length_penalty", type=float, default=None)
+    parser.add_argument(
+        "--length_model",
+        type=str,
+        default=None,
+        help="length_model.json written by make_len_file.py --fit_length_model: lowers max_length per example",
+    )
+    parser.add_argument("--cache_size", type=int, default=0, help="Texts of recent graphs kept in memory, 0: no cache")
+    parser.add_argument(
+        "--cache_path", type=str, default=None, help="sqlite file that keeps the texts of all graphs across restarts"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    generator = load_generator(args)
+    cache = None
+    if args.cache_size > 0 or args.cache_path:
+        cache = GraphCache(args.cache_size, args.cache_path, namespace=cache_namespace(args, generator))
+    loop = asyncio.get_event_loop()
+    batcher = MicroBatcher(generator, max_wait=args.max_wait_ms / 1000, max_queue=args.max_queue, cache=cache)
+    server = Graph2TextServer(batcher)
+    loop.create_task(batcher.run())
+    loop.run_until_complete(asyncio.start_server(server.handle_connection, args.host, args.port))
+    logger.info("Serving %s on http://%s:%s", args.model, args.host, args.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,6 @@ from transformers import (
     AutoModelForSequenceClassification,
     AutoModelForTokenClassification,
     AutoModelWithLMHead,
-    AutoTokenizer,
     PretrainedConfig,
     PreTrainedTokenizer,
 )
@@ -30,6 +29,8 @@ from transformers.optimization import (
     get_polynomial_decay_schedule_with_warmup,
 get_constant_schedule_with_warmup
 )
+from graph2text_common import load_graph2text_tokenizer
+from utils import binarized_cache_prefix
 
 logger = logging.getLogger(__name__)
 
@@ -98,38 +99,11 @@ class BaseTransformer(pl.LightningModule):
                 setattr(self.config, p, getattr(self.hparams, p))
 
         if tokenizer is None:
-            self.tokenizer = AutoTokenizer.from_pretrained(
+            self.tokenizer = load_graph2text_tokenizer(
                 self.hparams.tokenizer_name if self.hparams.tokenizer_name else self.hparams.model_name_or_path,
                 cache_dir=cache_dir,
+                use_fast=getattr(self.hparams, "fast_tokenizer", False),
             )
-            new_tokens = [':wiki', ':ARG5', ':time-of', ':age', ':duration', ':year', ':mod', ':ARG1-of', ':manner-of',
-                          ':snt7', ':year2', ':op5', ':subset-of', ':dayperiod', ':quant', ':season', ':subevent',
-                          ':op9', ':accompanier', ':op6', ':li', ':direction-of', ':op13', ':op11', ':op4',
-                          ':condition', ':op16', ':condition-of', ':ARG8', ':domain', ':time', ':weekday', ':ARG2',
-                          ':poss', ':beneficiary-of', ':prep-by', ':snt2', ':prep-in', ':snt8', ':concession-of',
-                          ':topic-of', ':scale', ':snt6', ':ARG3', ':prep-for', ':s', ':medium', ':op2', ':prep-on',
-                          ':beneficiary', ':snt11', ':op7', ':prep-as', ':ARG2-of', ':frequency-of', ':ARG7', ':unit',
-                          ':op1', ':path', ':value', ':degree-of', ':direction', ':poss-of', ':ord', ':month', ':op10',
-                          ':quarter', ':op14', ':prep-under', ':snt3', ':prep-against', ':ARG6', ':location',
-                          ':destination', ':consist-of', ':purpose', ':degree', ':extent', ':snt1', ':extent-of',
-                          ':domain-of', ':op8', ':conj-as-if', ':prep-from', ':ord-of', ':snt10', ':snt9',
-                          ':duration-of', ':ARG5-of', ':topic', ':calendar', ':prep-at', ':polite', ':accompanier-of',
-                          ':example', ':prep-out-of', ':day', ':name-of', ':prep-amid', ':prep-into', ':concession',
-                          ':part', ':destination-of', ':ARG9', ':ARG0', ':op1-of', ':op19', ':century', ':prep-among',
-                          ':example-of', ':instrument', ':source', ':op17', ':medium-of', ':prep-with', ':compared-to',
-                          ':quant-of', ':prep-in-addition-to', ':purpose-of', ':instrument-of', ':snt5', ':frequency',
-                          ':timezone', ':op3', ':prep-toward', ':ARG3-of', ':prep-on-behalf-of', ':prep-without',
-                          ':name', ':op15', ':prep-along-with', ':ARG4', ':mode', ':prep-to', ':decade', ':ARG4-of',
-                          ':subevent-of', ':age-of', ':op12', ':polarity', ':range', ':snt4', ':P', ':part-of',
-                          ':location-of', ':manner', ':ARG0-of', ':op18', ':source-of', ':op20', ':era', ':ARG1',
-                          ':path-of']
-            new_tokens_vocab = {}
-            new_tokens_vocab['additional_special_tokens'] = []
-            for idx, t in enumerate(new_tokens):
-                new_tokens_vocab['additional_special_tokens'].append(t)
-            num_added_toks = self.tokenizer.add_special_tokens(new_tokens_vocab)
-            self.tokenizer.unique_no_split_tokens.sort(key=lambda x: -len(x))
-            rank_zero_info('We have added %s tokens', num_added_toks)
         else:
             self.tokenizer: PreTrainedTokenizer = tokenizer
         self.model_type = MODEL_MODES[mode]
@@ -225,14 +199,16 @@ class BaseTransformer(pl.LightningModule):
     def test_dataloader(self):
         return self.get_dataloader("test", self.hparams.eval_batch_size, shuffle=False)
 
-    def _feature_file(self, mode):
-        return os.path.join(
+    def _feature_file(self, mode, max_target_length=None):
+        """Path prefix of the binarized cache of split `mode` (see utils.binarize_split)."""
+        return binarized_cache_prefix(
             self.hparams.data_dir,
-            "cached_{}_{}_{}".format(
-                mode,
-                list(filter(None, self.hparams.model_name_or_path.split("/"))).pop(),
-                str(self.hparams.max_seq_length),
-            ),
+            mode,
+            self.hparams.model_name_or_path,
+            self.tokenizer,
+            prefix=self.model.config.prefix or "",
+            max_source_length=self.hparams.max_source_length,
+            max_target_length=max_target_length or self.hparams.max_target_length,
         )
 
     def get_progress_bar_dict(self):
@@ -269,6 +245,11 @@ class BaseTransformer(pl.LightningModule):
             type=str,
             help="Pretrained tokenizer name or path if not the same as model_name",
         )
+        parser.add_argument(
+            "--fast_tokenizer",
+            action="store_true",
+            help="Use the Rust tokenizer. Training refuses to start if it gives other ids than the slow one.",
+        )
         parser.add_argument(
             "--cache_dir",
             default="",
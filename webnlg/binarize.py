@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import argparse
+from pathlib import Path
+
+from transformers import BartTokenizer
+
+from graph2text_common import load_graph2text_tokenizer
+from utils import binarize_split, binarized_cache_prefix, get_graph2text_prefix
+
+
+SPLITS = ["train", "val", "test_both", "test_seen", "test_unseen"]
+
+
+def main(args):
+    """Tokenize each split once into the cache that finetune.py --binarize memory-maps."""
+    tokenizer_name = args.tokenizer_name if args.tokenizer_name else args.model_name_or_path
+    tokenizer = load_graph2text_tokenizer(tokenizer_name, cache_dir=args.cache_dir or None, use_fast=args.fast_tokenizer)
+    prefix = get_graph2text_prefix(args.model_name_or_path, cache_dir=args.cache_dir or None)
+    dataset_kwargs = {"add_prefix_space": True} if isinstance(tokenizer, BartTokenizer) else {}
+
+    for type_path in args.type_paths:
+        if type_path == "train":
+            max_target_length = args.max_target_length
+        elif type_path == "val":
+            max_target_length = args.val_max_target_length
+        else:
+            max_target_length = args.test_max_target_length
+        cache_prefix = binarized_cache_prefix(
+            args.data_dir,
+            type_path,
+            args.model_name_or_path,
+            tokenizer,
+            prefix=prefix,
+            max_source_length=args.max_source_length,
+            max_target_length=max_target_length,
+        )
+        num_examples = binarize_split(
+            tokenizer,
+            Path(args.data_dir).joinpath(type_path + ".source"),
+            Path(args.data_dir).joinpath(type_path + ".target"),
+            cache_prefix,
+            args.max_source_length,
+            max_target_length,
+            prefix=prefix,
+            **dataset_kwargs,
+        )
+        print(f"{type_path}: wrote {num_examples} examples to {cache_prefix}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--tokenizer_name", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default="")
+    parser.add_argument("--fast_tokenizer", action="store_true", help="Tokenize with the Rust tokenizer")
+    parser.add_argument("--type_paths", type=str, nargs="+", default=SPLITS)
+    parser.add_argument("--max_source_length", type=int, default=1024)
+    parser.add_argument("--max_target_length", type=int, default=56)
+    parser.add_argument("--val_max_target_length", type=int, default=142)
+    parser.add_argument("--test_max_target_length", type=int, default=142)
+    main(parser.parse_args())
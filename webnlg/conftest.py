@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from transformers import BartTokenizer
+from transformers.tokenization_gpt2 import bytes_to_unicode
+
+
+GRAPHS = [
+    ("<H> Alan_Bean <R> occupation <T> Test_pilot", "Alan Bean was a test pilot."),
+    ("<H> Aarhus_Airport <R> city_served <T> Aarhus", "Aarhus Airport serves the city of Aarhus."),
+    (
+        "<H> Alan_Bean <R> birth_place <T> Wheeler,_Texas <H> Alan_Bean <R> nationality <T> United_States",
+        "Alan Bean, an American, was born in Wheeler, Texas.",
+    ),
+    ("<H> Ajoblanco <R> country <T> Spain", "Ajoblanco is from Spain."),
+    (
+        "<H> Abilene,_Texas <R> is_part_of <T> Jones_County,_Texas <H> Abilene,_Texas <R> country <T> United_States",
+        "Abilene is part of Jones County, Texas, in the United States.",
+    ),
+    ("<H> Amatriciana_sauce <R> ingredient <T> Tomato", "Tomato is an ingredient of amatriciana sauce."),
+    ("<H> Bakewell_pudding <R> region <T> Derbyshire_Dales", "Bakewell pudding comes from the Derbyshire Dales."),
+]
+
+
+@pytest.fixture(scope="session")
+def tokenizer(tmp_path_factory):
+    """A byte-level BART tokenizer with no merges and the graph tokens, built offline."""
+    save_dir = tmp_path_factory.mktemp("tokenizer")
+    vocab = ["<s>", "<pad>", "</s>", "<unk>"] + sorted(set(bytes_to_unicode().values())) + ["<mask>"]
+    with open(save_dir / "vocab.json", "w") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(save_dir / "merges.txt", "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = BartTokenizer(str(save_dir / "vocab.json"), str(save_dir / "merges.txt"))
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<H>", "<R>", "<T>"]})
+    return tokenizer
+
+
+def write_split(data_dir, type_path, pairs, trailing_newline=True):
+    for ext, lines in [("source", [src for src, _ in pairs]), ("target", [tgt for _, tgt in pairs])]:
+        text = "\n".join(lines) + ("\n" if trailing_newline else "")
+        data_dir.joinpath(f"{type_path}.{ext}").write_text(text, encoding="utf-8")
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """A data dir with a train split of GRAPHS."""
+    write_split(tmp_path, "train", GRAPHS)
+    return tmp_path
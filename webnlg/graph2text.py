@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+"""Graph-to-text inference without pytorch_lightning.
+
+    python graph2text.py generate --model outputs/best_tfmr --input data/webnlg/test_both.source --output test.hypo
+
+--model is a best_tfmr directory (see BaseTransformer.on_save_checkpoint) or a Lightning .ckpt. The sweep command
+decodes a file with every combination of --num_beams, --length_penalty and --max_length, encoding each batch once.
+
+On CPU, generate --num_workers N decodes shards of the file in N processes that share the model weights, and scaling
+reports the throughput of several worker counts. --precision int8/bf16 trades accuracy for CPU speed; precision_eval
+measures how much.
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import pickle
+import sys
+import time
+import types
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+import numpy as np
+import torch
+from sacrebleu import corpus_bleu
+from transformers import AutoConfig, AutoModelForSeq2SeqLM, BartTokenizer
+from transformers.modeling_outputs import BaseModelOutput
+
+from graph2text_common import (
+    T5_PREFIX,
+    LengthModel,
+    fast_batch_decode,
+    graph_size_token_ids,
+    load_graph2text_tokenizer,
+)
+from utils_graph2text import eval_chrf, eval_meteor
+
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ["fp32", "int8", "bf16"]
+# model.generate arguments that SummarizationModule._generative_step uses for this dataset
+GENERATE_KWARGS = {"length_penalty": 1.0}
+
+
+class _LightningObject(dict):
+    pass
+
+
+class _LightningUnpickler(pickle.Unpickler):
+    """Load pytorch_lightning classes in a checkpoint (AttributeDict hparams) as plain dicts, without importing it."""
+
+    def find_class(self, module, name):
+        if module.split(".")[0] == "pytorch_lightning":
+            return _LightningObject
+        return super().find_class(module, name)
+
+
+lightning_pickle = types.ModuleType("lightning_pickle")
+lightning_pickle.Unpickler = _LightningUnpickler
+lightning_pickle.load = pickle.load
+
+
+def load_lightning_checkpoint(path) -> dict:
+    return torch.load(path, map_location="cpu", pickle_module=lightning_pickle)
+
+
+class _PrecomputedEncoder(torch.nn.Module):
+    """Stands in for model.get_encoder() inside generate, returning encoder states computed beforehand."""
+
+    def __init__(self, last_hidden_state):
+        super().__init__()
+        self.last_hidden_state = last_hidden_state
+
+    def forward(self, *args, **kwargs):
+        # a new output per call: generate replaces its states with copies expanded for the beams
+        return BaseModelOutput(last_hidden_state=self.last_hidden_state)
+
+
+class Graph2TextGenerator:
+    """Generate from a trained graph-to-text model in length-sorted, token-budget batches, keeping input order."""
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        prefix="",
+        max_source_length=1024,
+        max_tokens=20000,
+        device=None,
+        precision="fp32",
+        length_model=None,
+        **generate_kwargs
+    ):
+        """precision="int8" quantizes the weights of the Linear layers to int8 and their activations at run time
+        (torch.quantization.quantize_dynamic); "bf16" runs the model under CPU bf16 autocast. Both are CPU only.
+
+        With a LengthModel, each example gets its predicted length as max_length (never above generate_kwargs'), and a
+        batch decodes up to the longest cap of its examples."""
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}, got {precision}")
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() and precision == "fp32" else "cpu"
+        self.device = torch.device(device)
+        if precision != "fp32" and self.device.type != "cpu":
+            raise ValueError(f"precision {precision} is a CPU inference mode, use --device cpu")
+        if precision == "bf16" and not hasattr(torch, "autocast"):
+            raise ValueError("precision bf16 needs CPU autocast, which arrived in torch 1.10")
+        self.precision = precision
+        self.model = model.to(self.device).eval()
+        if precision == "int8":
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.max_source_length = max_source_length
+        self.max_tokens = max_tokens
+        self.length_model = length_model
+        self.graph_token_ids = graph_size_token_ids(tokenizer)
+        self.generate_kwargs = dict(GENERATE_KWARGS, **{k: v for k, v in generate_kwargs.items() if v is not None})
+        self.generate_kwargs.setdefault("num_beams", model.config.num_beams)
+        self.generate_kwargs.setdefault("max_length", model.config.max_length)
+        self.encode_kwargs = {"add_prefix_space": True} if isinstance(tokenizer, BartTokenizer) else {}
+        self.stats = dict(examples=0, source_tokens=0, generated_tokens=0, seconds=0.0)
+
+    @classmethod
+    def from_pretrained(cls, path, cache_dir=None, use_fast=False, max_source_length=None, **kwargs):
+        """Load a best_tfmr directory, or a Lightning .ckpt on top of the config of the model it was trained from, or
+        the output_dir of graph2text_onnx.py export."""
+        if Path(path).joinpath("graph2text_onnx.json").exists():
+            from graph2text_onnx import OnnxSeq2SeqLM  # needs onnxruntime, which only exported models do
+
+            tokenizer = load_graph2text_tokenizer(path, use_fast=use_fast)
+            model = OnnxSeq2SeqLM(path)
+        elif Path(path).is_dir():
+            tokenizer = load_graph2text_tokenizer(path, use_fast=use_fast)
+            model = AutoModelForSeq2SeqLM.from_pretrained(path)
+        else:
+            checkpoint = load_lightning_checkpoint(path)
+            hparams = checkpoint.get("hyper_parameters", checkpoint.get("hparams", {}))
+            if not isinstance(hparams, dict):
+                hparams = vars(hparams)
+            name = hparams["model_name_or_path"]
+            cache_dir = cache_dir or hparams.get("cache_dir") or None
+            tokenizer = load_graph2text_tokenizer(
+                hparams.get("tokenizer_name") or name, cache_dir=cache_dir, use_fast=use_fast
+            )
+            config = AutoConfig.from_pretrained(hparams.get("config_name") or name, cache_dir=cache_dir)
+            if "t5" in name:
+                config.prefix = T5_PREFIX
+            # no pretrained weights: the checkpoint overwrites all of them
+            model = AutoModelForSeq2SeqLM.from_config(config)
+            model.resize_token_embeddings(len(tokenizer))
+            state_dict = checkpoint["state_dict"]
+            model.load_state_dict({k[len("model.") :]: v for k, v in state_dict.items() if k.startswith("model.")})
+            if max_source_length is None:
+                max_source_length = hparams.get("max_source_length")
+        if max_source_length is None:
+            max_source_length = 1024
+        return cls(model, tokenizer, prefix=model.config.prefix or "", max_source_length=max_source_length, **kwargs)
+
+    def max_lengths(self, input_ids: List[List[int]]) -> List[int]:
+        """The max_length of each example: generate_kwargs', or lower if the length model predicts a shorter output."""
+        max_length = self.generate_kwargs["max_length"]
+        if self.length_model is None:
+            return [max_length] * len(input_ids)
+        return np.minimum(self.length_model.predict_ids(input_ids, self.graph_token_ids), max_length).tolist()
+
+    def batches(self, input_ids: List[List[int]], num_beams=None, max_length=None) -> List[List[int]]:
+        """Longest-first batches of indices whose num_beams * (source + max_length) tokens fit max_tokens.
+
+        max_length defaults to the per-example max_lengths; a batch costs its longest source and its longest cap.
+        """
+        num_beams = num_beams or self.generate_kwargs["num_beams"]
+        max_lengths = [max_length] * len(input_ids) if max_length else self.max_lengths(input_ids)
+        batches = []
+        batch_max_length = 0
+        for i in sorted(range(len(input_ids)), key=lambda i: -len(input_ids[i])):
+            if batches:
+                batch = batches[-1]
+                gen_length = max(batch_max_length, max_lengths[i])
+                if num_beams * (len(input_ids[batch[0]]) + gen_length) * (len(batch) + 1) <= self.max_tokens:
+                    batch.append(i)
+                    batch_max_length = gen_length
+                    continue
+            batches.append([i])
+            batch_max_length = max_lengths[i]
+        return batches
+
+    def encode(self, lines: List[str]) -> List[List[int]]:
+        return self.tokenizer(
+            [self.prefix + line for line in lines],
+            max_length=self.max_source_length,
+            truncation=True,
+            **self.encode_kwargs,
+        )["input_ids"]
+
+    def pad(self, input_ids: List[List[int]]) -> Dict[str, torch.Tensor]:
+        inputs = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+        return {k: inputs[k].to(self.device) for k in ["input_ids", "attention_mask"]}
+
+    @contextmanager
+    def precomputed_encoder(self, last_hidden_state):
+        """Make model.generate use `last_hidden_state` instead of running the encoder (transformers 3 always does)."""
+        self.model.get_encoder = lambda: _PrecomputedEncoder(last_hidden_state)
+        try:
+            yield
+        finally:
+            del self.model.get_encoder
+
+    def autocast(self):
+        if self.precision == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return ExitStack()  # no-op, contextlib.nullcontext needs python 3.7
+
+    @torch.no_grad()
+    def generate_lines(self, lines: List[str]) -> List[str]:
+        """Predictions for `lines`, in the same order."""
+        t0 = time.time()
+        input_ids = self.encode(lines)
+        preds = [None] * len(lines)
+        for batch in self.batches(input_ids):
+            for i, text in zip(batch, self.generate_batch([input_ids[i] for i in batch])):
+                preds[i] = text
+        self.stats["examples"] += len(lines)
+        self.stats["source_tokens"] += sum(len(ids) for ids in input_ids)
+        self.stats["seconds"] += time.time() - t0
+        return preds
+
+    @torch.no_grad()
+    def generate_batch(self, input_ids: List[List[int]]) -> List[str]:
+        """Predictions for one batch of encoded sources."""
+        inputs = self.pad(input_ids)
+        generate_kwargs = dict(self.generate_kwargs, max_length=max(self.max_lengths(input_ids)))
+        with self.autocast():
+            generated_ids = self.model.generate(
+                inputs["input_ids"], attention_mask=inputs["attention_mask"], use_cache=True, **generate_kwargs
+            )
+        self.stats["generated_tokens"] += int(generated_ids.ne(self.tokenizer.pad_token_id).sum())
+        return [text.strip() for text in fast_batch_decode(self.tokenizer, generated_ids)]
+
+    @torch.no_grad()
+    def sweep_lines(self, lines: List[str], configs: List[dict]) -> List[List[str]]:
+        """Predictions for `lines` with each of `configs` (generate arguments overriding generate_kwargs).
+
+        The encoder runs once per batch and its states are reused by the decoding of every config, so a grid search
+        costs one encoding of the data. The batches fit max_tokens for the largest num_beams and max_length.
+        Decoding time and generated tokens per config are added to ``sweep_stats``.
+        """
+        configs = [dict(self.generate_kwargs, **config) for config in configs]
+        self.sweep_stats = [dict(generated_tokens=0, seconds=0.0) for _ in configs]
+        t0 = time.time()
+        input_ids = self.encode(lines)
+        preds = [[None] * len(lines) for _ in configs]
+        num_beams = max(config["num_beams"] for config in configs)
+        max_length = max(config["max_length"] for config in configs)
+        for batch in self.batches(input_ids, num_beams=num_beams, max_length=max_length):
+            inputs = self.pad([input_ids[i] for i in batch])
+            encoder = self.model.get_encoder()
+            with self.autocast():
+                last_hidden_state = encoder(inputs["input_ids"], attention_mask=inputs["attention_mask"])[0]
+            for config, config_preds, stats in zip(configs, preds, self.sweep_stats):
+                t1 = time.time()
+                with self.precomputed_encoder(last_hidden_state), self.autocast():
+                    generated_ids = self.model.generate(
+                        inputs["input_ids"], attention_mask=inputs["attention_mask"], use_cache=True, **config
+                    )
+                for i, text in zip(batch, fast_batch_decode(self.tokenizer, generated_ids)):
+                    config_preds[i] = text.strip()
+                stats["generated_tokens"] += int(generated_ids.ne(self.tokenizer.pad_token_id).sum())
+                stats["seconds"] += time.time() - t1
+        self.stats["examples"] += len(lines)
+        self.stats["source_tokens"] += sum(len(ids) for ids in input_ids)
+        self.stats["seconds"] += time.time() - t0
+        return preds
+
+    def generate(self, lines: Iterable[str], chunk_size=10000) -> Iterator[str]:
+        """Stream predictions in input order, sorting by length within chunks of chunk_size lines."""
+        for chunk in read_chunks(lines, chunk_size):
+            yield from self.generate_lines(chunk)
+
+    def throughput(self) -> str:
+        seconds = max(self.stats["seconds"], 1e-9)
+        return (
+            f"{self.stats['examples']} examples in {seconds:.1f}s: {self.stats['examples'] / seconds:.2f} examples/s, "
+            f"{self.stats['source_tokens'] / seconds:.0f} source tokens/s, "
+            f"{self.stats['generated_tokens'] / seconds:.0f} generated tokens/s"
+        )
+
+
+def read_chunks(lines: Iterable[str], chunk_size) -> Iterator[List[str]]:
+    lines = iter(lines)
+    while True:
+        chunk = [line.rstrip("\n") for line in itertools.islice(lines, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+_worker_generator = None
+
+
+def _init_worker(generator, num_threads):
+    global _worker_generator
+    torch.set_num_threads(num_threads)
+    _worker_generator = generator
+
+
+def _worker_ready(_):
+    return _worker_generator is not None
+
+
+def _generate_shard(lines):
+    _worker_generator.stats = dict.fromkeys(_worker_generator.stats, 0)
+    return _worker_generator.generate_lines(lines), _worker_generator.stats
+
+
+class Graph2TextWorkerPool:
+    """Graph2TextGenerator.generate on CPU in several processes, each with its own intra-op thread count.
+
+    Beam search on small batches keeps few threads busy, so N processes with a few threads each scale better than
+    one process with all of them. The model is moved to shared memory once and handed to the workers, which map the
+    same weights instead of loading copies. Shards of shard_size lines are decoded in parallel and the predictions
+    are yielded in input order.
+    """
+
+    def __init__(self, generator: Graph2TextGenerator, num_workers, threads_per_worker=None, shard_size=256):
+        if generator.device.type != "cpu":
+            raise ValueError("Graph2TextWorkerPool decodes on CPU, use --device cpu")
+        self.generator = generator
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(os.cpu_count() // num_workers, 1)
+        self.shard_size = shard_size
+        t0 = time.time()
+        generator.model.share_memory()
+        # spawn: forking a process that already started OpenMP threads can deadlock
+        context = torch.multiprocessing.get_context("spawn")
+        self.pool = context.Pool(
+            num_workers, initializer=_init_worker, initargs=(generator, self.threads_per_worker)
+        )
+        assert all(self.pool.map(_worker_ready, range(num_workers), chunksize=1))
+        self.startup_seconds = time.time() - t0
+
+    def generate(self, lines: Iterable[str]) -> Iterator[str]:
+        t0 = time.time()
+        for preds, stats in self.pool.imap(_generate_shard, read_chunks(lines, self.shard_size)):
+            for k in ["examples", "source_tokens", "generated_tokens"]:
+                self.generator.stats[k] += stats[k]
+            yield from preds
+        self.generator.stats["seconds"] += time.time() - t0
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_model_args(parser):
+    parser.add_argument("--model", type=str, required=True, help="best_tfmr directory or Lightning .ckpt")
+    parser.add_argument("--input", type=argparse.FileType("r"), default="-", help=".source file, - for stdin")
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--fast_tokenizer", action="store_true")
+    parser.add_argument("--device", type=str, default=None, help="Defaults to cuda when available")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="int8: dynamic quantization of the Linear layers, bf16: autocast (CPU only)",
+    )
+    parser.add_argument(
+        "--max_source_length", type=int, default=None, help="Defaults to the checkpoint's, else 1024"
+    )
+    parser.add_argument("--num_beams", type=int, default=None, help="Defaults to the model config's")
+    parser.add_argument("--max_length", type=int, default=None, help="never generate more than n tokens")
+    parser.add_argument("--length_penalty", type=float, default=None)
+    parser.add_argument(
+        "--length_model",
+        type=str,
+        default=None,
+        help="length_model.json written by make_len_file.py --fit_length_model: lowers max_length per example",
+    )
+    parser.add_argument(
+        "--max_tokens", type=int, default=20000, help="Budget of num_beams x (source + max_length) tokens per batch"
+    )
+    parser.add_argument(
+        "--threads_per_worker", type=int, default=None, help="Intra-op threads per process, default cpu_count/workers"
+    )
+    parser.add_argument("--shard_size", type=int, default=256, help="Lines decoded by a worker at a time")
+
+
+def add_generate_args(parser):
+    add_model_args(parser)
+    parser.add_argument("--output", type=argparse.FileType("w"), default="-", help="- for stdout")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Lines read and length-sorted at a time")
+    parser.add_argument("--num_workers", type=int, default=1, help="Decoding processes (CPU only)")
+
+
+def load_generator(args, precision=None) -> Graph2TextGenerator:
+    return Graph2TextGenerator.from_pretrained(
+        args.model,
+        cache_dir=args.cache_dir,
+        use_fast=args.fast_tokenizer,
+        max_source_length=args.max_source_length,
+        max_tokens=args.max_tokens,
+        device=args.device,
+        precision=precision or args.precision,
+        num_beams=args.num_beams,
+        max_length=args.max_length,
+        length_penalty=args.length_penalty,
+        length_model=LengthModel.load(args.length_model) if args.length_model else None,
+    )
+
+
+def run_generate(args):
+    generator = load_generator(args)
+    if args.num_workers > 1:
+        with Graph2TextWorkerPool(generator, args.num_workers, args.threads_per_worker, args.shard_size) as pool:
+            for pred in pool.generate(args.input):
+                args.output.write(pred + "\n")
+    else:
+        for pred in generator.generate(args.input, chunk_size=args.chunk_size):
+            args.output.write(pred + "\n")
+    args.output.flush()
+    logger.info(generator.throughput())
+
+
+def run_scaling(args):
+    """Decode the input with each worker count and print throughput, speedup and efficiency per worker count."""
+    generator = load_generator(args)
+    lines = [line.rstrip("\n") for line in itertools.islice(args.input, args.n_lines)]
+    rows = []
+    reference_preds = None
+    for num_workers in args.workers:
+        generator.stats = dict.fromkeys(generator.stats, 0)
+        with Graph2TextWorkerPool(generator, num_workers, args.threads_per_worker, args.shard_size) as pool:
+            preds = list(pool.generate(lines))
+            startup_seconds = pool.startup_seconds
+            threads = pool.threads_per_worker
+        if reference_preds is None:
+            reference_preds = preds
+        elif preds != reference_preds:
+            changed = sum(pred != reference for pred, reference in zip(preds, reference_preds))
+            logger.warning("%s workers changed %s predictions", num_workers, changed)
+        rows.append(
+            dict(
+                workers=num_workers,
+                threads_per_worker=threads,
+                startup_seconds=startup_seconds,
+                seconds=generator.stats["seconds"],
+                examples_per_second=len(lines) / max(generator.stats["seconds"], 1e-9),
+            )
+        )
+    base = rows[0]
+    print("workers\tthreads_per_worker\tstartup_s\tdecode_s\texamples/s\tspeedup\tefficiency")
+    for row in rows:
+        speedup = row["examples_per_second"] / base["examples_per_second"]
+        efficiency = speedup / (row["workers"] / base["workers"])
+        print(
+            f"{row['workers']}\t{row['threads_per_worker']}\t{row['startup_seconds']:.1f}\t{row['seconds']:.1f}\t"
+            f"{row['examples_per_second']:.2f}\t{speedup:.2f}\t{efficiency:.2f}"
+        )
+
+
+def _parse_score(text, field):
+    """A float out of the report of eval_meteor, NaN if the tool did not run."""
+    try:
+        return float(text.split()[field])
+    except (AttributeError, IndexError, ValueError):
+        return float("nan")
+
+
+def score_predictions(preds: List[str], pred_file, ref_file) -> Dict[str, float]:
+    """sacrebleu BLEU, chrF++ (as utils/chrf++.py) and METEOR (meteor-1.5.jar) of `preds`, written to pred_file."""
+    with open(pred_file, "w") as f:
+        f.writelines(pred + "\n" for pred in preds)
+    with open(ref_file) as f:
+        refs = [line.rstrip("\n") for line in f]
+    try:
+        meteor = _parse_score(eval_meteor(ref_file, pred_file), -1)
+    except IndexError:  # java is missing: empty report
+        meteor = float("nan")
+    chrf = eval_chrf(ref_file, pred_file)
+    return {
+        "bleu": corpus_bleu(preds, [refs]).score,
+        "chrf++": chrf["chrf"] if chrf is not None else float("nan"),
+        "meteor": meteor,
+    }
+
+
+def run_precision_eval(args):
+    """Decode the input in fp32 and in each of --precisions, and print their scores and speed relative to fp32."""
+    lines = [line.rstrip("\n") for line in itertools.islice(args.input, args.n_lines)]
+    os.makedirs(args.output_dir, exist_ok=True)
+    rows = []
+    for precision in ["fp32"] + [p for p in args.precisions if p != "fp32"]:
+        generator = load_generator(args, precision=precision)
+        preds = generator.generate_lines(lines)
+        pred_file = os.path.join(args.output_dir, f"predictions_{precision}.txt")
+        row = dict(precision=precision, **score_predictions(preds, pred_file, args.reference))
+        row["examples_per_second"] = len(lines) / max(generator.stats["seconds"], 1e-9)
+        logger.info("%s: %s", precision, generator.throughput())
+        rows.append(row)
+        del generator
+
+    base = rows[0]
+    columns = ["bleu", "chrf++", "meteor"]
+    header = ["precision"] + columns + [f"{k}_delta" for k in columns] + ["examples/s", "speedup"]
+    lines_out = ["\t".join(header)]
+    for row in rows:
+        values = [row["precision"]] + [f"{row[k]:.2f}" for k in columns]
+        values += [f"{row[k] - base[k]:+.2f}" for k in columns]
+        speedup = row["examples_per_second"] / base["examples_per_second"]
+        values += [f"{row['examples_per_second']:.2f}", f"{speedup:.2f}"]
+        lines_out.append("\t".join(values))
+    with open(os.path.join(args.output_dir, "precision_eval.tsv"), "w") as f:
+        f.writelines(line + "\n" for line in lines_out)
+    print("\n".join(lines_out))
+
+
+def add_sweep_args(parser):
+    parser.add_argument("--model", type=str, required=True, help="best_tfmr directory or Lightning .ckpt")
+    parser.add_argument("--input", type=str, required=True, help=".source file")
+    parser.add_argument(
+        "--reference", type=str, nargs="*", default=[], help="Reference file(s) to score each config with sacrebleu"
+    )
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--fast_tokenizer", action="store_true")
+    parser.add_argument("--device", type=str, default=None, help="Defaults to cuda when available")
+    parser.add_argument(
+        "--max_source_length", type=int, default=None, help="Defaults to the checkpoint's, else 1024"
+    )
+    parser.add_argument("--num_beams", type=int, nargs="+", default=[None], help="Defaults to the model config's")
+    parser.add_argument("--max_length", type=int, nargs="+", default=[None], help="Defaults to the model config's")
+    parser.add_argument("--length_penalty", type=float, nargs="+", default=[GENERATE_KWARGS["length_penalty"]])
+    parser.add_argument(
+        "--max_tokens", type=int, default=20000, help="Budget of num_beams x (source + max_length) tokens per batch"
+    )
+
+
+def run_sweep(args):
+    """Write predictions_{config}.txt for every decoding config, and one row per config to sweep.tsv."""
+    generator = Graph2TextGenerator.from_pretrained(
+        args.model,
+        cache_dir=args.cache_dir,
+        use_fast=args.fast_tokenizer,
+        max_source_length=args.max_source_length,
+        max_tokens=args.max_tokens,
+        device=args.device,
+    )
+    configs = [
+        {k: v for k, v in zip(["num_beams", "length_penalty", "max_length"], values) if v is not None}
+        for values in itertools.product(args.num_beams, args.length_penalty, args.max_length)
+    ]
+    configs = [dict(generator.generate_kwargs, **config) for config in configs]
+    with open(args.input) as f:
+        lines = [line.rstrip("\n") for line in f]
+    refs = []
+    for path in args.reference:
+        with open(path) as f:
+            refs.append([line.rstrip("\n") for line in f])
+    all_preds = generator.sweep_lines(lines, configs)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    columns = ["num_beams", "length_penalty", "max_length", "bleu", "gen_len", "seconds", "file"]
+    rows = []
+    for config, preds, stats in zip(configs, all_preds, generator.sweep_stats):
+        name = f"beams{config['num_beams']}_lp{config['length_penalty']}_len{config['max_length']}"
+        pred_file = os.path.join(args.output_dir, f"predictions_{name}.txt")
+        with open(pred_file, "w") as f:
+            f.writelines(pred + "\n" for pred in preds)
+        row = dict(
+            config,
+            bleu=round(corpus_bleu(preds, refs).score, 4) if refs else "",
+            gen_len=round(stats["generated_tokens"] / max(len(preds), 1), 2),
+            seconds=round(stats["seconds"], 2),
+            file=pred_file,
+        )
+        logger.info("%s", row)
+        rows.append(row)
+    with open(os.path.join(args.output_dir, "sweep.tsv"), "w") as f:
+        f.write("\t".join(columns) + "\n")
+        f.writelines("\t".join(str(row[k]) for k in columns) + "\n" for row in rows)
+    logger.info(generator.throughput())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Graph-to-text inference without pytorch_lightning")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    generate_parser = subparsers.add_parser("generate", help="Write a prediction for every line of a .source file")
+    add_generate_args(generate_parser)
+    generate_parser.set_defaults(func=run_generate)
+    sweep_parser = subparsers.add_parser(
+        "sweep", help="Decode a .source file with a grid of decoding configs, encoding each batch once"
+    )
+    add_sweep_args(sweep_parser)
+    sweep_parser.set_defaults(func=run_sweep)
+    scaling_parser = subparsers.add_parser(
+        "scaling", help="Measure CPU decoding throughput and scaling efficiency for several worker counts"
+    )
+    add_model_args(scaling_parser)
+    scaling_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    scaling_parser.add_argument("--n_lines", type=int, default=None, help="Only decode the first n lines")
+    scaling_parser.set_defaults(func=run_scaling, device="cpu")
+    precision_parser = subparsers.add_parser(
+        "precision_eval", help="Compare the scores and speed of int8/bf16 CPU inference with fp32 on a split"
+    )
+    add_model_args(precision_parser)
+    precision_parser.add_argument("--reference", type=str, required=True, help="Reference file, e.g. val.target")
+    precision_parser.add_argument("--output_dir", type=str, required=True)
+    precision_parser.add_argument("--precisions", type=str, nargs="+", choices=PRECISIONS, default=["int8", "bf16"])
+    precision_parser.add_argument("--n_lines", type=int, default=None, help="Only decode the first n lines")
+    precision_parser.set_defaults(func=run_precision_eval, device="cpu")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
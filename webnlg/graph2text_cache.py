@@ -0,0 +1,87 @@
+"""Cache of generated texts keyed on a canonical form of the input graph, for graph2text_server.py.
+
+The same graph often comes back with its triples in another order. canonical_graph sorts the <H> subject <R>
+predicate <T> object triples of a linearized graph (normalized as in data/generate_input_webnlg.py's process_triples),
+so that every order shares one entry, and the server decodes that canonical form: a graph gets the same text
+whether it was cached or not.
+
+GraphCache keeps the most recently used texts in memory and, with a path, every text in an sqlite file that
+survives restarts. Entries belong to a namespace, which should identify the model and the generation settings.
+"""
+
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+def canonical_graph(graph: str) -> str:
+    """The linearized graph with its triples sorted, and whitespace normalized."""
+    tokens = graph.split()
+    head, triples = [], []
+    for token in tokens:
+        if token == "<H>":
+            triples.append([])
+        (triples[-1] if triples else head).append(token)
+    return " ".join(head + sorted(" ".join(triple) for triple in triples))
+
+
+class GraphCache:
+    """LRU cache of the texts of max_size graphs, backed by an optional sqlite store at `path`."""
+
+    def __init__(self, max_size=10000, path=None, namespace=""):
+        self.max_size = max_size
+        self.namespace = namespace
+        self.entries = OrderedDict()
+        self.stats = dict(hits=0, disk_hits=0, misses=0, evictions=0)
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, isolation_level=None)  # autocommit
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS texts "
+                "(namespace TEXT, graph TEXT, text TEXT, PRIMARY KEY (namespace, graph))"
+            )
+
+    def get(self, graph: str) -> Optional[str]:
+        text = self.entries.get(graph)
+        if text is not None:
+            self.entries.move_to_end(graph)
+            self.stats["hits"] += 1
+            return text
+        if self.db is not None:
+            row = self.db.execute(
+                "SELECT text FROM texts WHERE namespace = ? AND graph = ?", (self.namespace, graph)
+            ).fetchone()
+            if row is not None:
+                self.stats["disk_hits"] += 1
+                self._remember(graph, row[0])
+                return row[0]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, graph: str, text: str):
+        self._remember(graph, text)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO texts VALUES (?, ?, ?)", (self.namespace, graph, text))
+
+    def _remember(self, graph, text):
+        if self.max_size <= 0:
+            return
+        self.entries[graph] = text
+        self.entries.move_to_end(graph)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def metrics(self) -> Dict[str, float]:
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        return dict(
+            self.stats,
+            size=len(self.entries),
+            max_size=self.max_size,
+            hit_rate=(self.stats["hits"] + self.stats["disk_hits"]) / max(lookups, 1),
+        )
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
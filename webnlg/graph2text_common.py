@@ -0,0 +1,121 @@
+"""Tokenizer setup, decoding and the length model shared by training (finetune.py) and inference (graph2text.py).
+
+Kept free of pytorch_lightning so that graph2text.py and its servers can import it without the training stack.
+"""
+
+import json
+import logging
+from typing import List
+
+import numpy as np
+import torch
+from tokenizers import AddedToken
+from transformers import AutoTokenizer, BartTokenizerFast, PreTrainedTokenizer, PreTrainedTokenizerFast
+
+
+logger = logging.getLogger(__name__)
+
+T5_PREFIX = "translate Graph to English: "
+
+
+class GraphBartTokenizerFast(BartTokenizerFast):
+    """BartTokenizerFast that matches the slow BartTokenizer called with add_prefix_space=True.
+
+    The slow tokenizer adds one space at the start of the text and strips the whitespace around the graph
+    tokens, so a word right after ``<H>`` gets no leading space. ByteLevel(add_prefix_space=True) would add one
+    after every graph token instead, so the space is prepended here and the graph tokens are added with
+    lstrip/rstrip (see load_graph2text_tokenizer).
+    """
+
+    def _batch_encode_plus(self, batch_text_or_text_pairs, *args, **kwargs):
+        batch_text_or_text_pairs = [
+            " " + x if isinstance(x, str) else tuple(" " + t for t in x) for x in batch_text_or_text_pairs
+        ]
+        return super()._batch_encode_plus(batch_text_or_text_pairs, *args, **kwargs)
+
+
+def load_graph2text_tokenizer(tokenizer_name, cache_dir=None, use_fast=False) -> PreTrainedTokenizer:
+    """Load a pretrained tokenizer and add the graph tokens as additional special tokens.
+
+    With use_fast the Rust tokenizer is returned, set up to give the same ids as the slow one: the graph
+    tokens strip the whitespace around them like the slow tokenizer does, and Bart gets GraphBartTokenizerFast.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, cache_dir=cache_dir, use_fast=use_fast)
+    if isinstance(tokenizer, BartTokenizerFast):
+        tokenizer = GraphBartTokenizerFast.from_pretrained(tokenizer_name, cache_dir=cache_dir)
+    new_tokens = ['<H>', '<R>', '<T>']
+    new_tokens_vocab = {}
+    new_tokens_vocab['additional_special_tokens'] = []
+    for idx, t in enumerate(new_tokens):
+        if isinstance(tokenizer, PreTrainedTokenizerFast):
+            t = AddedToken(t, lstrip=True, rstrip=True)
+        new_tokens_vocab['additional_special_tokens'].append(t)
+    num_added_toks = tokenizer.add_special_tokens(new_tokens_vocab)
+    logger.info('We have added %s tokens', num_added_toks)
+    return tokenizer
+
+
+def fast_batch_decode(tokenizer, sequences) -> List[str]:
+    """batch_decode(skip_special_tokens=True, clean_up_tokenization_spaces=True), in one Rust call if possible."""
+    if isinstance(sequences, torch.Tensor):
+        sequences = sequences.tolist()
+    if isinstance(tokenizer, PreTrainedTokenizerFast):
+        texts = tokenizer._tokenizer.decode_batch(sequences, skip_special_tokens=True)
+        return [tokenizer.clean_up_tokenization(text) for text in texts]
+    return tokenizer.batch_decode(sequences, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+
+def graph_size_token_ids(tokenizer) -> List[int]:
+    """Ids of the tokens that LengthModel counts as the size of a graph: <H>, one per triple."""
+    return tokenizer.convert_tokens_to_ids(["<H>"])
+
+
+class LengthModel:
+    """Cap on the generated length of an example, linear in its source tokens and graph size.
+
+    Fitted by least squares on a training split. The margin above the fit is the `quantile` of the training residuals
+    (times `slack`), so with quantile=1.0 no training target is longer than its cap. Lengths count the decoder start
+    token and eos, like generate's max_length.
+    """
+
+    def __init__(self, coef, margin, min_length=2):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.margin = float(margin)
+        self.min_length = min_length
+
+    @classmethod
+    def fit(cls, src_lens, graph_sizes, gen_lens, quantile=1.0, slack=1.0) -> "LengthModel":
+        features = cls.features(src_lens, graph_sizes)
+        gen_lens = np.asarray(gen_lens, dtype=np.float64)
+        coef = np.linalg.lstsq(features, gen_lens, rcond=None)[0]
+        margin = np.quantile(gen_lens - features @ coef, quantile) * slack
+        return cls(coef, margin, min_length=int(gen_lens.min()))
+
+    @staticmethod
+    def features(src_lens, graph_sizes) -> np.ndarray:
+        src_lens = np.asarray(src_lens, dtype=np.float64)
+        return np.stack([np.ones_like(src_lens), src_lens, np.asarray(graph_sizes, dtype=np.float64)], axis=1)
+
+    def predict(self, src_lens, graph_sizes) -> np.ndarray:
+        caps = np.ceil(self.features(src_lens, graph_sizes) @ self.coef + self.margin)
+        return np.maximum(caps, self.min_length).astype(np.int64)
+
+    def predict_ids(self, input_ids, graph_token_ids, attention_mask=None) -> np.ndarray:
+        """Caps for unpadded id lists, or for padded input_ids tensors with their attention_mask."""
+        if attention_mask is not None:
+            input_ids, attention_mask = input_ids.cpu().numpy(), attention_mask.cpu().numpy()
+            src_lens = attention_mask.sum(1)
+            graph_sizes = (np.isin(input_ids, graph_token_ids) & (attention_mask == 1)).sum(1)
+        else:
+            src_lens = [len(ids) for ids in input_ids]
+            graph_sizes = [int(np.isin(ids, graph_token_ids).sum()) for ids in input_ids]
+        return self.predict(src_lens, graph_sizes)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"coef": self.coef.tolist(), "margin": self.margin, "min_length": self.min_length}, f, indent=4)
+
+    @classmethod
+    def load(cls, path) -> "LengthModel":
+        with open(path) as f:
+            return cls(**json.load(f))
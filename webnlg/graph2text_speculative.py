@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""Greedy speculative decoding: a small fine-tuned draft model proposes --num_draft_tokens tokens, the model scores
+them all in one decoder pass, and keeps the ones it would have generated itself, plus its own next token.
+
+    python graph2text_speculative.py generate --model webnlg-t5-large.ckpt --draft_model webnlg-t5-small.ckpt \
+        --input data/webnlg/test_both.source --output test_both.hypo --max_length 384
+    python graph2text_speculative.py benchmark --model webnlg-t5-large.ckpt --draft_model webnlg-t5-small.ckpt \
+        --input data/webnlg/val.source
+
+Every kept token is the argmax of the model, after the same min_length, no_repeat_ngram_size, bad_words_ids and
+repetition_penalty as `generate`, so the predictions are those of greedy decoding with the model alone
+(graph2text.py generate --num_beams 1). `benchmark` checks it, with the model's settings and with CONSTRAINED_KWARGS,
+and reports the acceptance rate of the draft tokens and the speedup. Both models must use the same tokenizer: T5
+drafts for T5 models, Bart for Bart. Graphs are decoded one at a time, as speculative decoding lowers the latency of a
+graph rather than the cost of a batch.
+T5 and Bart are supported, with the cache layouts of transformers 3.
+"""
+
+import argparse
+import logging
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List
+
+import torch
+import torch.nn.functional as F
+from transformers import BartForConditionalGeneration, T5ForConditionalGeneration
+
+from graph2text import Graph2TextGenerator, add_model_args, fast_batch_decode, load_generator, read_chunks
+
+
+logger = logging.getLogger(__name__)
+
+# the generate arguments that postprocess_next_token_scores applies to the logits before greedy's argmax
+POSTPROCESS_KWARGS = ["min_length", "no_repeat_ngram_size", "bad_words_ids", "repetition_penalty"]
+# non-default values of them, for benchmark's second equivalence check
+CONSTRAINED_KWARGS = {"min_length": 10, "no_repeat_ngram_size": 3, "repetition_penalty": 1.2}
+
+
+class _T5Decoder:
+    """Decoder passes of T5 over several new tokens at once. Transformers 3's T5Stack takes one token at a time with a
+    cache, so the blocks are called here, with the position biases of the new tokens."""
+
+    def __init__(self, model):
+        self.model = model
+        self.decoder = model.decoder
+        self.self_attention = self.decoder.block[0].layer[0].SelfAttention
+        self.cross_attention = self.decoder.block[0].layer[1].EncDecAttention
+
+    def encode(self, input_ids):
+        return self.model.get_encoder()(input_ids)[0]
+
+    @staticmethod
+    def cache_length(cache):
+        return cache[0][0].shape[2] if cache is not None else 0
+
+    def step(self, tokens, encoder_hidden_states, cache):
+        """The logits after each of `tokens` (1, n_tokens) and the cache extended with them."""
+        past_length = self.cache_length(cache)
+        length = past_length + tokens.shape[1]
+        future = torch.arange(length)[None, :] > torch.arange(past_length, length)[:, None]
+        position_bias = self.self_attention.compute_bias(length, length)[:, :, past_length:]
+        position_bias = position_bias.masked_fill(future.to(position_bias.device), -10000.0)
+        cross_position_bias = self.cross_attention.compute_bias(length, encoder_hidden_states.shape[1])
+        cross_position_bias = cross_position_bias[:, :, past_length:]
+        hidden_states = self.decoder.dropout(self.decoder.embed_tokens(tokens))
+        next_cache = []
+        for block, past in zip(self.decoder.block, cache or [None] * len(self.decoder.block)):
+            hidden_states, present = block(
+                hidden_states,
+                position_bias=position_bias,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_decoder_position_bias=cross_position_bias,
+                past_key_value_state=past,
+                use_cache=True,
+            )[:2]
+            next_cache.append(present)
+        hidden_states = self.decoder.dropout(self.decoder.final_layer_norm(hidden_states))
+        return self.model.lm_head(hidden_states * (self.model.model_dim ** -0.5)), next_cache
+
+    @staticmethod
+    def truncate(cache, length):
+        return [(k[:, :, :length], v[:, :, :length], ck, cv) for k, v, ck, cv in cache]
+
+
+class _BartDecoder:
+    """Decoder passes of Bart over several new tokens at once. The decoder is called without use_cache, which would
+    keep the last token only; it still reads and updates the layer states it is given."""
+
+    def __init__(self, model):
+        self.model = model
+        self.decoder = model.model.decoder
+
+    def encode(self, input_ids):
+        return self.model.get_encoder()(input_ids)[0]
+
+    @staticmethod
+    def cache_length(cache):
+        return cache[0]["self"]["prev_key"].shape[2] if cache is not None else 0
+
+    @contextmanager
+    def positions(self, start, end):
+        embed_positions = self.decoder.embed_positions
+        offset = getattr(embed_positions, "offset", 0)
+        embed_positions.forward = lambda input_ids, use_cache=False: torch.nn.Embedding.forward(
+            embed_positions, torch.arange(start + offset, end + offset, device=input_ids.device)
+        )
+        try:
+            yield
+        finally:
+            del embed_positions.forward
+
+    def step(self, tokens, encoder_hidden_states, cache):
+        """The logits after each of `tokens` (1, n_tokens) and the cache extended with them."""
+        past_length = self.cache_length(cache)
+        length = past_length + tokens.shape[1]
+        future = torch.arange(length)[None, :] > torch.arange(past_length, length)[:, None]
+        causal_mask = torch.zeros(future.shape).masked_fill(future, float("-inf")).to(tokens.device)
+        if cache is None:
+            cache = [{} for _ in self.decoder.layers]
+        with self.positions(past_length, length):
+            hidden_states = self.decoder(
+                tokens, encoder_hidden_states, None, None, causal_mask, past_key_values=cache
+            )[0]
+        return F.linear(hidden_states, self.model.model.shared.weight, bias=self.model.final_logits_bias), cache
+
+    @staticmethod
+    def truncate(cache, length):
+        truncated = []
+        for layer in cache:
+            state = dict(layer["self"], prev_key=layer["self"]["prev_key"][:, :, :length])
+            state["prev_value"] = state["prev_value"][:, :, :length]
+            truncated.append(dict(layer, self=state))
+        return truncated
+
+
+def _decoder(model):
+    if isinstance(model, T5ForConditionalGeneration):
+        return _T5Decoder(model)
+    if isinstance(model, BartForConditionalGeneration):
+        return _BartDecoder(model)
+    raise ValueError(f"speculative decoding supports T5 and Bart, not {type(model).__name__}")
+
+
+class SpeculativeDecoder:
+    """Greedy decoding with `generator`'s model, sped up by the proposals of `draft`'s model.
+
+    Uses the tokenizer, max_length and length model of `generator`. ``stats`` counts the generated tokens, the
+    proposed and accepted draft tokens and the decoder passes of both models.
+    """
+
+    def __init__(self, generator: Graph2TextGenerator, draft: Graph2TextGenerator, num_draft_tokens=4):
+        if generator.generate_kwargs["num_beams"] != 1:
+            raise ValueError("speculative decoding is greedy, use --num_beams 1")
+        if draft.tokenizer.get_vocab() != generator.tokenizer.get_vocab():
+            raise ValueError("the draft model must use the tokenizer of the model")
+        if num_draft_tokens < 1:
+            raise ValueError("num_draft_tokens must be at least 1")
+        self.generator = generator
+        self.draft = draft
+        self.decoder = _decoder(generator.model)
+        self.draft_decoder = _decoder(draft.model)
+        self.num_draft_tokens = num_draft_tokens
+        config = generator.model.config
+        self.eos_token_id = config.eos_token_id
+        if config.decoder_start_token_id is not None:
+            self.decoder_start_token_id = config.decoder_start_token_id
+        else:
+            self.decoder_start_token_id = config.bos_token_id
+        self.stats = Counter()
+
+    def generation_settings(self):
+        """The POSTPROCESS_KWARGS of the generator's generate_kwargs, or else of the model config, as in generate."""
+        config = self.generator.model.config
+        kwargs = self.generator.generate_kwargs
+        return {k: kwargs[k] if kwargs.get(k) is not None else getattr(config, k) for k in POSTPROCESS_KWARGS}
+
+    def next_tokens(self, model, logits, prefix: List[int], continuation: List[int], settings) -> List[int]:
+        """Greedy's token after prefix + continuation[:i], for each row i of `logits` (n, vocab_size): the argmax once
+        `settings` are applied by postprocess_next_token_scores, as in transformers' _generate_no_beam_search."""
+        if not (
+            settings["min_length"] > 0
+            or settings["no_repeat_ngram_size"] > 0
+            or settings["bad_words_ids"]
+            or settings["repetition_penalty"] != 1.0
+        ):
+            return logits.argmax(-1).tolist()
+        tokens = []
+        for i in range(logits.shape[0]):
+            input_ids = torch.tensor([prefix + continuation[:i]], device=logits.device)
+            scores = model.postprocess_next_token_scores(
+                scores=logits[i : i + 1],
+                input_ids=input_ids,
+                cur_len=input_ids.shape[1],
+                max_length=None,  # unused by postprocess_next_token_scores
+                eos_token_id=self.eos_token_id,
+                batch_size=1,
+                num_beams=1,
+                **settings,
+            )
+            tokens.append(int(scores[0].argmax()))
+        return tokens
+
+    def propose(self, tokens: List[int], encoder_hidden_states, cache, n_tokens, settings):
+        """Up to n_tokens greedy draft tokens after `tokens`, and the draft cache, which lacks the last of them."""
+        device = encoder_hidden_states.device
+        proposal = []
+        new_tokens = tokens[self.draft_decoder.cache_length(cache) :]
+        while len(proposal) < n_tokens:
+            tokens_tensor = torch.tensor([new_tokens], device=device)
+            logits, cache = self.draft_decoder.step(tokens_tensor, encoder_hidden_states, cache)
+            self.stats["draft_passes"] += 1
+            # the model's settings keep the proposals to tokens it can accept
+            new_tokens = self.next_tokens(self.draft.model, logits[0, -1:], tokens + proposal, [], settings)
+            proposal += new_tokens
+            if new_tokens[0] == self.eos_token_id:
+                break
+        return proposal, cache
+
+    @torch.no_grad()
+    def generate_ids(self, input_ids: List[int], draft_input_ids: List[int], max_length) -> List[int]:
+        """The greedy output of the model for one encoded source, starting with the decoder start token."""
+        device = self.generator.device
+        encoder_hidden_states = self.decoder.encode(torch.tensor([input_ids], device=device))
+        draft_hidden_states = self.draft_decoder.encode(torch.tensor([draft_input_ids], device=self.draft.device))
+        settings = self.generation_settings()
+        tokens = [self.decoder_start_token_id]
+        cache = draft_cache = None
+        while len(tokens) < max_length:
+            # the model adds one token of its own, which must fit max_length too
+            n_tokens = min(self.num_draft_tokens, max_length - len(tokens) - 1)
+            proposal = []
+            if n_tokens > 0:
+                proposal, draft_cache = self.propose(tokens, draft_hidden_states, draft_cache, n_tokens, settings)
+            new_tokens = tokens[self.decoder.cache_length(cache) :] + proposal
+            logits, cache = self.decoder.step(torch.tensor([new_tokens], device=device), encoder_hidden_states, cache)
+            self.stats["target_passes"] += 1
+            # predictions[i] is the model's token after proposal[:i]
+            predictions = self.next_tokens(
+                self.generator.model, logits[0, -len(proposal) - 1 :], tokens, proposal, settings
+            )
+            accepted = 0
+            while accepted < len(proposal) and proposal[accepted] == predictions[accepted]:
+                accepted += 1
+            self.stats["proposed"] += len(proposal)
+            self.stats["accepted"] += accepted
+            new_tokens = proposal[:accepted] + [predictions[accepted]]
+            if self.eos_token_id in new_tokens:
+                tokens += new_tokens[: new_tokens.index(self.eos_token_id) + 1]
+                break
+            tokens += new_tokens
+            # neither cache has the last token yet; the draft's may also hold rejected proposals
+            cache = self.decoder.truncate(cache, len(tokens) - 1)
+            draft_length = min(self.draft_decoder.cache_length(draft_cache), len(tokens) - 1)
+            if draft_cache is not None:
+                draft_cache = self.draft_decoder.truncate(draft_cache, draft_length)
+        return tokens
+
+    def generate_lines(self, lines: List[str]) -> List[str]:
+        """Predictions for `lines`, in the same order."""
+        t0 = time.time()
+        input_ids = self.generator.encode(lines)
+        draft_input_ids = self.draft.encode(lines)
+        outputs = []
+        with self.generator.autocast():
+            for ids, draft_ids, max_length in zip(input_ids, draft_input_ids, self.generator.max_lengths(input_ids)):
+                outputs.append(self.generate_ids(ids, draft_ids, max_length))
+                self.stats["generated"] += len(outputs[-1]) - 1
+        stats = self.generator.stats
+        stats["examples"] += len(lines)
+        stats["source_tokens"] += sum(len(ids) for ids in input_ids)
+        stats["generated_tokens"] += sum(len(ids) for ids in outputs)
+        stats["seconds"] += time.time() - t0
+        return [text.strip() for text in fast_batch_decode(self.generator.tokenizer, outputs)]
+
+    def generate(self, lines: Iterable[str], chunk_size=10000) -> Iterator[str]:
+        """Stream predictions in input order, chunk_size lines at a time."""
+        for chunk in read_chunks(lines, chunk_size):
+            yield from self.generate_lines(chunk)
+
+    def report(self) -> str:
+        stats = self.stats
+        return (
+            f"draft acceptance {stats['accepted'] / max(stats['proposed'], 1):.1%} "
+            f"({stats['accepted']}/{stats['proposed']}), "
+            f"{stats['generated'] / max(stats['target_passes'], 1):.2f} tokens per model pass, "
+            f"{stats['draft_passes'] / max(stats['target_passes'], 1):.2f} draft passes per model pass"
+        )
+
+
+def load_draft(args) -> Graph2TextGenerator:
+    return Graph2TextGenerator.from_pretrained(
+        args.draft_model,
+        cache_dir=args.cache_dir,
+        use_fast=args.fast_tokenizer,
+        max_source_length=args.max_source_length,
+        device=args.device,
+        precision=args.precision,
+        num_beams=1,
+    )
+
+
+def run_generate(args):
+    generator = load_generator(args)
+    decoder = SpeculativeDecoder(generator, load_draft(args), num_draft_tokens=args.num_draft_tokens)
+    for pred in decoder.generate(args.input, chunk_size=args.chunk_size):
+        args.output.write(pred + "\n")
+    args.output.flush()
+    logger.info(generator.throughput())
+    logger.info(decoder.report())
+
+
+def compare(generator, decoder, lines):
+    """Decode `lines` greedily with the model alone and with speculative decoding, one graph at a time. Returns the
+    examples per second of each, and the number of identical predictions."""
+    rows = []
+    all_preds = []
+    for name in ["greedy", "speculative"]:
+        generator.stats = dict(examples=0, source_tokens=0, generated_tokens=0, seconds=0.0)
+        if name == "greedy":
+            t0 = time.time()
+            all_preds.append([generator.generate_batch([ids])[0] for ids in generator.encode(lines)])
+            generator.stats["seconds"] = time.time() - t0
+        else:
+            all_preds.append(decoder.generate_lines(lines))
+            logger.info("speculative: %s", decoder.report())
+        rows.append((name, len(lines) / max(generator.stats["seconds"], 1e-9)))
+    mismatches = [i for i, (a, b) in enumerate(zip(*all_preds)) if a != b]
+    for i in mismatches[:5]:
+        logger.info("line %s differs:\n  greedy:      %s\n  speculative: %s", i + 1, all_preds[0][i], all_preds[1][i])
+    return rows, len(lines) - len(mismatches)
+
+
+def run_benchmark(args):
+    """Compare speculative decoding with greedy decoding, with the model's settings, then with CONSTRAINED_KWARGS."""
+    lines = next(read_chunks(args.input, args.n_lines or sys.maxsize), [])
+    generator = load_generator(args)
+    decoder = SpeculativeDecoder(generator, load_draft(args), num_draft_tokens=args.num_draft_tokens)
+    rows, identical = compare(generator, decoder, lines)
+    print(f"identical predictions: {identical}/{len(lines)}")
+    print(f"draft acceptance: {decoder.stats['accepted'] / max(decoder.stats['proposed'], 1):.1%}")
+    for name, examples_per_second in rows:
+        print(f"{name}\t{examples_per_second:.2f} examples/s\t{examples_per_second / rows[0][1]:.2f}x")
+
+    generate_kwargs = generator.generate_kwargs
+    generator.generate_kwargs = dict(generate_kwargs, **CONSTRAINED_KWARGS)
+    _, identical = compare(generator, decoder, lines)
+    generator.generate_kwargs = generate_kwargs
+    settings = ", ".join(f"{k}={v}" for k, v in CONSTRAINED_KWARGS.items())
+    print(f"identical predictions with {settings}: {identical}/{len(lines)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Greedy speculative decoding with a small draft model")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    generate_parser = subparsers.add_parser("generate", help="Write a prediction for every line of a .source file")
+    add_model_args(generate_parser)
+    generate_parser.add_argument("--output", type=argparse.FileType("w"), default="-", help="- for stdout")
+    generate_parser.add_argument("--chunk_size", type=int, default=10000, help="Lines read and decoded at a time")
+    generate_parser.set_defaults(func=run_generate)
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="Compare speculative decoding with greedy decoding by the model alone"
+    )
+    add_model_args(benchmark_parser)
+    benchmark_parser.add_argument("--n_lines", type=int, default=None, help="Only decode the first n lines")
+    benchmark_parser.set_defaults(func=run_benchmark)
+    for subparser in [generate_parser, benchmark_parser]:
+        subparser.add_argument(
+            "--draft_model", type=str, required=True, help="Smaller model fine-tuned on the same data, same tokenizer"
+        )
+        subparser.add_argument("--num_draft_tokens", type=int, default=4, help="Draft tokens verified per model pass")
+        subparser.set_defaults(num_beams=1)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,6 @@ from transformers import (
     AutoModelForSequenceClassification,
     AutoModelForTokenClassification,
     AutoModelWithLMHead,
-    AutoTokenizer,
     PretrainedConfig,
     PreTrainedTokenizer,
 )
@@ -29,6 +28,8 @@ from transformers.optimization import (
     get_linear_schedule_with_warmup,
     get_polynomial_decay_schedule_with_warmup,
 )
+from graph2text_common import load_graph2text_tokenizer
+from utils import binarized_cache_prefix
 
 logger = logging.getLogger(__name__)
 
@@ -96,17 +97,11 @@ class BaseTransformer(pl.LightningModule):
                 setattr(self.config, p, getattr(self.hparams, p))
 
         if tokenizer is None:
-            self.tokenizer = AutoTokenizer.from_pretrained(
+            self.tokenizer = load_graph2text_tokenizer(
                 self.hparams.tokenizer_name if self.hparams.tokenizer_name else self.hparams.model_name_or_path,
                 cache_dir=cache_dir,
+                use_fast=getattr(self.hparams, "fast_tokenizer", False),
             )
-            new_tokens = ['<H>', '<R>', '<T>']
-            new_tokens_vocab = {}
-            new_tokens_vocab['additional_special_tokens'] = []
-            for idx, t in enumerate(new_tokens):
-                new_tokens_vocab['additional_special_tokens'].append(t)
-            num_added_toks = self.tokenizer.add_special_tokens(new_tokens_vocab)
-            rank_zero_info('We have added %s tokens', num_added_toks)
         else:
             self.tokenizer: PreTrainedTokenizer = tokenizer
         self.model_type = MODEL_MODES[mode]
@@ -198,14 +193,16 @@ class BaseTransformer(pl.LightningModule):
     def test_dataloader(self):
         return self.get_dataloader("test", self.hparams.eval_batch_size, shuffle=False)
 
-    def _feature_file(self, mode):
-        return os.path.join(
+    def _feature_file(self, mode, max_target_length=None):
+        """Path prefix of the binarized cache of split `mode` (see utils.binarize_split)."""
+        return binarized_cache_prefix(
             self.hparams.data_dir,
-            "cached_{}_{}_{}".format(
-                mode,
-                list(filter(None, self.hparams.model_name_or_path.split("/"))).pop(),
-                str(self.hparams.max_seq_length),
-            ),
+            mode,
+            self.hparams.model_name_or_path,
+            self.tokenizer,
+            prefix=self.model.config.prefix or "",
+            max_source_length=self.hparams.max_source_length,
+            max_target_length=max_target_length or self.hparams.max_target_length,
         )
 
     def get_progress_bar_dict(self):
@@ -242,6 +239,11 @@ class BaseTransformer(pl.LightningModule):
             type=str,
             help="Pretrained tokenizer name or path if not the same as model_name",
         )
+        parser.add_argument(
+            "--fast_tokenizer",
+            action="store_true",
+            help="Use the Rust tokenizer. Training refuses to start if it gives other ids than the slow one.",
+        )
         parser.add_argument(
             "--cache_dir",
             default="",
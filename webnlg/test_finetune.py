@@ -0,0 +1,97 @@
+import argparse
+import os
+
+import numpy as np
+import pytest
+import pytorch_lightning as pl
+import torch
+
+from conftest import GRAPHS, write_split
+from finetune import Graph2TextModule
+from transformers import BartConfig, BartForConditionalGeneration
+
+
+SPLITS = {
+    "test_both": GRAPHS,
+    "test_seen": [GRAPHS[i] for i in [0, 2, 4, 6]],
+    "test_unseen": [GRAPHS[i] for i in [1, 3, 5]],
+}
+
+
+def make_module(tokenizer, data_dir, output_dir, *args) -> Graph2TextModule:
+    parser = argparse.ArgumentParser()
+    parser = pl.Trainer.add_argparse_args(parser)
+    parser = Graph2TextModule.add_model_specific_args(parser, os.getcwd())
+    hparams = parser.parse_args(
+        ["--task", "graph2text", "--model_name_or_path", "tiny-bart"]
+        + ["--data_dir", str(data_dir), "--output_dir", str(output_dir)]
+        + ["--max_source_length", "64", "--test_max_target_length", "64", "--eval_max_gen_length", "12"]
+        + ["--eval_batch_size", "2", "--eval_beams", "2", "--gpus", "0", "--num_workers", "0"]
+        + list(args)
+    )
+    output_dir.mkdir()  # as main does
+    torch.manual_seed(0)
+    # large weights make the outputs depend on the graph, and the eos bias ends them at different lengths
+    config = BartConfig(
+        init_std=1.0,
+        vocab_size=len(tokenizer),
+        d_model=16,
+        encoder_layers=1,
+        decoder_layers=1,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=32,
+        decoder_ffn_dim=32,
+        max_position_embeddings=128,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        decoder_start_token_id=tokenizer.eos_token_id,
+    )
+    model = BartForConditionalGeneration(config).eval()
+    model.final_logits_bias[0, tokenizer.eos_token_id] = 15.0
+    return Graph2TextModule(hparams, config=config, tokenizer=tokenizer, model=model)
+
+
+@pytest.mark.parametrize(
+    "args", [[], ["--label_smoothing", "0.1"], ["--binarize", "--eval_max_tokens", "256"], ["--lean_eval"]]
+)
+def test_split_test_outputs_match_each_split_on_its_own(tokenizer, tmp_path, args):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for split, pairs in SPLITS.items():
+        write_split(data_dir, split, pairs)
+    module = make_module(tokenizer, data_dir, tmp_path / "output", *args)
+
+    with torch.no_grad():
+        test_loader = module.test_dataloader()
+        outputs = [module.test_step(batch, batch_idx) for batch_idx, batch in enumerate(test_loader)]
+        regrouped = module.split_test_outputs(outputs)
+        standalone = []
+        for dataloader_idx, split in enumerate(module.test_splits):
+            loader = module.get_dataloader(split, batch_size=module.hparams.eval_batch_size)
+            standalone.append(
+                [module._generative_step(batch, batch_idx, dataloader_idx) for batch_idx, batch in enumerate(loader)]
+            )
+    # the union of the splits, each example generated once
+    assert len(test_loader.dataset) == len(GRAPHS) and sum(len(x["preds"]) for x in outputs) == len(GRAPHS)
+
+    assert len({x["gen_len"] for split_outputs in standalone for x in split_outputs}) > 1
+    assert len(set(module.ordered_outputs(outputs, "preds"))) > 1
+
+    assert len(regrouped) == len(standalone) == len(SPLITS)
+    for split_outputs, expected_outputs in zip(regrouped, standalone):
+        assert len(split_outputs) == len(expected_outputs)
+        for output, expected in zip(split_outputs, expected_outputs):
+            for key in ["preds", "target", "ids", "gen_len", "dataloader_idx"]:
+                assert output[key] == expected[key], key
+            if module.hparams.lean_eval:
+                assert "loss" not in output
+            else:
+                assert torch.allclose(output["loss"], expected["loss"], atol=1e-5)
+                # per-batch metrics, computed on the split's own batches
+                for key in module.metric_names:
+                    assert output[key] == expected[key], key
+        assert module.ordered_outputs(split_outputs, "preds") == module.ordered_outputs(expected_outputs, "preds")
+        mean_loss, expected_mean_loss = module.mean_losses(split_outputs), module.mean_losses(expected_outputs)
+        assert np.isclose(mean_loss["loss"], expected_mean_loss["loss"], atol=1e-5, equal_nan=True)
@@ -0,0 +1,166 @@
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from conftest import write_split
+from utils import (
+    BinarizedSeq2SeqDataset,
+    DistributedSortishSampler,
+    DynamicBatchSampler,
+    SortishSampler,
+    all_gather_objects,
+    token_budget_batches,
+)
+
+
+NUM_REPLICAS = 3
+
+
+def rank_batches(make_sampler, epoch=0) -> list:
+    """The batches of every rank, in rank order."""
+    batches = []
+    for rank in range(NUM_REPLICAS):
+        sampler = make_sampler(rank)
+        sampler.set_epoch(epoch)
+        batches.append(list(sampler))
+        assert len(batches[-1]) == len(sampler)
+    return batches
+
+
+class LengthsDataset:
+    def __init__(self, src_lens):
+        self.src_lens = src_lens
+
+    def __len__(self):
+        return len(self.src_lens)
+
+
+@pytest.fixture
+def src_lens():
+    return np.random.RandomState(0).randint(1, 100, size=503)
+
+
+def test_sortish_sampler_reshuffles_every_epoch(src_lens):
+    sampler = SortishSampler(src_lens, 8, seed=1)
+    order = list(sampler)
+    assert sorted(order) == list(range(len(src_lens)))
+    # the batch with the longest example goes first
+    assert src_lens[order[:8]].max() == src_lens.max()
+    assert list(sampler) == order
+
+    sampler.set_epoch(1)
+    assert sorted(sampler) == sorted(order)
+    assert list(sampler) != order
+    # (seed, epoch) pairs, unlike seed + epoch, give each pair its own order
+    other = SortishSampler(src_lens, 8, seed=0)
+    other.set_epoch(2)
+    assert list(other) != list(sampler)
+
+    assert list(SortishSampler(src_lens, 8, shuffle=False)) == np.argsort(-src_lens).tolist()
+
+
+def test_distributed_sortish_sampler_shards_examples(src_lens):
+    dataset = LengthsDataset(src_lens)
+
+    def make_sampler(rank):
+        return DistributedSortishSampler(dataset, 8, num_replicas=NUM_REPLICAS, rank=rank, seed=1)
+
+    per_rank = rank_batches(make_sampler)
+    assert len({len(x) for x in per_rank}) == 1
+    counts = Counter(i for x in per_rank for i in x)
+    # every example once, plus the first few again so that all ranks get the same number
+    assert set(counts) == set(range(len(src_lens)))
+    num_extra = len(per_rank[0]) * NUM_REPLICAS - len(src_lens)
+    assert sorted(i for i, n in counts.items() if n > 1) == list(range(num_extra))
+    assert max(counts.values()) == 2
+
+    assert rank_batches(make_sampler) == per_rank
+    reshuffled = rank_batches(make_sampler, epoch=1)
+    assert [sorted(x) for x in reshuffled] == [sorted(x) for x in per_rank]
+    assert all(new != old for new, old in zip(reshuffled, per_rank))
+
+    without_extra = [
+        list(DistributedSortishSampler(dataset, 8, num_replicas=NUM_REPLICAS, rank=rank, add_extra_examples=False))
+        for rank in range(NUM_REPLICAS)
+    ]
+    assert sorted(i for x in without_extra for i in x) == list(range(len(src_lens)))
+
+
+def test_dynamic_batch_sampler_shards_batches(src_lens):
+    batches = token_budget_batches(src_lens, 512, required_batch_size_multiple=4)
+    batch_tokens = [src_lens[batch].max() * len(batch) for batch in batches]
+
+    def make_sampler(rank):
+        return DynamicBatchSampler(batches, batch_tokens, num_replicas=NUM_REPLICAS, rank=rank, seed=1)
+
+    per_rank = rank_batches(make_sampler)
+    assert len({len(x) for x in per_rank}) == 1
+    counts = Counter(tuple(batch) for x in per_rank for batch in x)
+    # every batch once, plus the few repeats that give all ranks the same number of batches
+    assert set(counts) == {tuple(batch) for batch in batches}
+    assert sum(counts.values()) - len(batches) == len(per_rank[0]) * NUM_REPLICAS - len(batches) < NUM_REPLICAS
+    # the largest batches go first, to run out of memory at the first step if at all
+    first_tokens = sorted(src_lens[x[0]].max() * len(x[0]) for x in per_rank)
+    assert first_tokens == sorted(batch_tokens)[-NUM_REPLICAS:]
+
+    assert rank_batches(make_sampler) == per_rank
+    reshuffled = rank_batches(make_sampler, epoch=1)
+    assert reshuffled != per_rank
+    assert [x[0] for x in reshuffled] == [x[0] for x in per_rank]
+    assert sorted(map(sorted, reshuffled)) == sorted(map(sorted, per_rank))
+
+
+def test_make_eval_batches_covers_every_example_once(tokenizer, tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    pairs = [(" ".join(["a"] * rng.randint(1, 30)), " ".join(["b"] * rng.randint(1, 30))) for _ in range(101)]
+    write_split(tmp_path, "val", pairs)
+    dataset = BinarizedSeq2SeqDataset(tokenizer, tmp_path, 48, 48, type_path="val")
+
+    batches = dataset.make_eval_batches(1024, num_beams=2, max_gen_length=32)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(pairs)))
+    src_lens = np.minimum(dataset.src_lens, 48)
+    for batch in batches:
+        assert src_lens[batch[0]] == max(src_lens[batch])
+        assert len(batch) == 1 or 2 * (src_lens[batch[0]] + 32) * len(batch) <= 1024
+
+    monkeypatch.setattr(dist, "get_world_size", lambda: NUM_REPLICAS)
+    per_rank = []
+    for rank in range(NUM_REPLICAS):
+        monkeypatch.setattr(dist, "get_rank", lambda: rank)
+        per_rank.append(list(dataset.make_eval_batches(1024, num_beams=2, max_gen_length=32, distributed=True)))
+    assert len({len(x) for x in per_rank}) == 1
+    assert sorted(set(tuple(batch) for x in per_rank for batch in x)) == sorted(tuple(batch) for batch in batches)
+
+
+def gather_on_rank(rank, init_file, results):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", world_size=NUM_REPLICAS, rank=rank)
+    # payloads of different sizes, with tensors
+    gathered = all_gather_objects({"rank": rank, "preds": ["x" * (10 * rank)], "loss": torch.tensor([rank / 2])})
+    # tensors would go through the queue as shared memory, which is gone once this process exits
+    results.put((rank, [dict(x, loss=x["loss"].tolist()) for x in gathered]))
+    dist.destroy_process_group()
+
+
+def test_all_gather_objects_across_ranks(tmp_path):
+    assert all_gather_objects({"rank": 0}) == [{"rank": 0}]
+
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    init_file = os.path.join(tmp_path, "init")
+    processes = [ctx.Process(target=gather_on_rank, args=(rank, init_file, results)) for rank in range(NUM_REPLICAS)]
+    for process in processes:
+        process.start()
+    gathered = dict(results.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    for rank in range(NUM_REPLICAS):
+        assert [x["rank"] for x in gathered[rank]] == list(range(NUM_REPLICAS))
+        assert [x["preds"] for x in gathered[rank]] == [["x" * (10 * r)] for r in range(NUM_REPLICAS)]
+        assert [x["loss"] for x in gathered[rank]] == [[r / 2] for r in range(NUM_REPLICAS)]
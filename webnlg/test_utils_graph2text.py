@@ -0,0 +1,142 @@
+import os
+
+import pytest
+
+import utils_graph2text
+from utils_graph2text import chrf, eval_chrf, format_bleu, format_chrf, multi_bleu
+
+
+HYPOTHESES = [
+    "Alan Bean was a test pilot .",
+    "aarhus airport serves the city of aarhus .",
+    "Alan Bean , an American , was born in Wheeler , Texas .",
+    "ajoblanco comes from spain .",
+    "abilene is part of jones county in texas , united states .",
+    "tomato",
+]
+REFERENCES = [
+    [
+        "alan bean was a test pilot .",
+        "aarhus airport serves the city of aarhus .",
+        "alan bean , an american , was born in wheeler , texas .",
+        "ajoblanco is from spain .",
+        "abilene , texas is part of jones county , texas in the united states .",
+        "tomato is an ingredient of amatriciana sauce .",
+    ],
+    [
+        "alan bean worked as a test pilot .",
+        "the city of aarhus is served by aarhus airport .",
+        "american alan bean was born in wheeler , texas .",
+        "ajoblanco originates from spain .",
+        "abilene is in jones county , texas , united states .",
+        "amatriciana sauce contains tomato .",
+    ],
+    [
+        "test pilot alan bean .",
+        "aarhus is served by aarhus airport .",
+        "alan bean was born in wheeler , texas and is american .",
+        "ajoblanco is a dish from spain .",
+        "abilene is part of jones county in texas .",
+        "tomato is used in amatriciana sauce .",
+    ],
+]
+
+
+def write_lines(path, lines, trailing_newline=True):
+    path.write_text("\n".join(lines) + ("\n" if trailing_newline else ""), encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture
+def bleu_files(tmp_path):
+    """The hypothesis file and the reference files of `multi-bleu.perl -lc ref ref2 ref3 < hyp`."""
+    refs = [
+        write_lines(tmp_path / name, lines)
+        for name, lines in zip(["test.target_eval", "test.target2_eval", "test.target3_eval"], REFERENCES)
+    ]
+    return write_lines(tmp_path / "hyp.txt", HYPOTHESES), refs
+
+
+def test_multi_bleu_matches_multi_bleu_perl(bleu_files, tmp_path):
+    # the expected values are the report lines of data/multi-bleu.perl on the same files
+    hyp_file, refs = bleu_files
+    score = multi_bleu(hyp_file, *refs)
+    assert format_bleu(score) == "BLEU = 86.79, 97.8/95.0/91.4/86.7 (BP=0.937, ratio=0.939, hyp_len=46, ref_len=49)"
+    assert score["bleu"] == pytest.approx(86.79, abs=0.005)
+    assert multi_bleu(HYPOTHESES, *refs) == score
+
+    # perl's chop drops the last character of a file without a final newline: "tomato" becomes "tomat"
+    hyp_file = write_lines(tmp_path / "hyp_no_newline.txt", HYPOTHESES, trailing_newline=False)
+    assert (
+        format_bleu(multi_bleu(hyp_file, *refs))
+        == "BLEU = 86.30, 95.7/95.0/91.4/86.7 (BP=0.937, ratio=0.939, hyp_len=46, ref_len=49)"
+    )
+
+    # without -lc, against one reference
+    assert (
+        format_bleu(multi_bleu(HYPOTHESES, refs[0], lowercase=False))
+        == "BLEU = 41.73, 82.6/57.5/45.7/33.3 (BP=0.805, ratio=0.821, hyp_len=46, ref_len=56)"
+    )
+
+
+def test_multi_bleu_references(bleu_files, tmp_path):
+    hyp_file, refs = bleu_files
+    # missing extra references are skipped, like multi-bleu.perl does
+    assert multi_bleu(hyp_file, refs[0], str(tmp_path / "missing")) == multi_bleu(hyp_file, refs[0])
+    with pytest.raises(FileNotFoundError):
+        multi_bleu(hyp_file, str(tmp_path / "missing"))
+
+    # the cached reference counts are dropped when a reference file changes
+    score, cased_score = multi_bleu(hyp_file, *refs), multi_bleu(hyp_file, *refs, lowercase=False)
+    write_lines(tmp_path / "test.target_eval", [line.upper() for line in REFERENCES[0]])
+    os.utime(refs[0], (os.path.getmtime(refs[0]) + 1,) * 2)
+    assert multi_bleu(hyp_file, *refs) == score
+    assert multi_bleu(hyp_file, *refs, lowercase=False)["bleu"] < cased_score["bleu"]
+
+    empty = write_lines(tmp_path / "empty.txt", [""] * len(HYPOTHESES))
+    score = multi_bleu(empty, *refs)
+    assert score["bleu"] == score["bp"] == 0
+    assert format_bleu(None) == "no data"
+
+
+@pytest.fixture
+def chrf_files(tmp_path):
+    """The hypothesis file and the *#-separated references of `chrf++.py -H hyp -R ref`."""
+    refs = write_lines(tmp_path / "test.target_eval_crf", ["*#".join(refs) for refs in zip(*REFERENCES)])
+    return write_lines(tmp_path / "hyp.txt", HYPOTHESES), refs
+
+
+def test_chrf_matches_chrf_plus_plus(chrf_files, tmp_path):
+    # the expected values are the report lines of utils/chrf++.py on the same files
+    hyp_file, refs = chrf_files
+    score = chrf(hyp_file, refs, processes=1)
+    assert format_chrf(score, sep="\n") == "c6+w2-F2\t71.0435\nc6+w2-avgF2\t68.9571"
+    assert score["chrf"] == pytest.approx(71.0435, abs=5e-5)
+    assert chrf(HYPOTHESES, refs, processes=1) == score
+
+    # with the first reference only
+    single = write_lines(tmp_path / "test.target_eval", REFERENCES[0])
+    assert format_chrf(chrf(hyp_file, single, processes=1)) == "c6+w2-F2\t63.8963 c6+w2-avgF2\t64.5347"
+
+    # a sentence that no reference matches adds the n-gram counts of the last matched sentence again, as chrf++.py does
+    unmatched = HYPOTHESES[:3] + ["qqq"] + HYPOTHESES[4:]
+    assert format_chrf(chrf(unmatched, refs, processes=1)) == "c6+w2-F2\t68.0576 c6+w2-avgF2\t56.5551"
+
+
+def test_chrf_is_the_same_in_parallel(chrf_files, monkeypatch):
+    hyp_file, refs = chrf_files
+    score = chrf(hyp_file, refs, processes=1)
+    monkeypatch.setattr(utils_graph2text, "CHRF_CHUNK_SIZE", 2)
+    assert chrf(hyp_file, refs, processes=1) == score
+    assert chrf(hyp_file, refs, processes=3) == score
+
+
+def test_eval_chrf_writes_the_report(chrf_files, tmp_path):
+    hyp_file, refs = chrf_files
+    pred_file = write_lines(tmp_path / "test_predictions.txt", HYPOTHESES)
+    score = eval_chrf(refs, pred_file)
+    assert score == chrf(hyp_file, refs)
+    with open(tmp_path / "test_predictions.chrf") as f:
+        assert f.read() == "c6+w2-F2\t71.0435\nc6+w2-avgF2\t68.9571\n"
+    assert chrf([], refs) is None
+    assert format_chrf(None) == "no data"
@@ -1,13 +1,15 @@
+import hashlib
 import itertools
 import json
-import linecache
 import math
+import mmap
 import os
 import pickle
 import socket
+from glob import glob
 from logging import getLogger
 from pathlib import Path
-from typing import Callable, Dict, Iterable, List, Tuple, Union
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import git
 import numpy as np
@@ -16,23 +18,16 @@ import torch.distributed as dist
 from rouge_score import rouge_scorer, scoring
 from sacrebleu import corpus_bleu
 from torch import nn
-from torch.utils.data import Dataset, Sampler
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 
-from transformers import BartTokenizer, EvalPrediction, PreTrainedTokenizer, T5Tokenizer
+from transformers import AutoConfig, BartTokenizer, EvalPrediction, PreTrainedTokenizer, T5Tokenizer
 from transformers.file_utils import cached_property
 from transformers.modeling_bart import shift_tokens_right
+from graph2text_common import T5_PREFIX, fast_batch_decode
 from utils_graph2text import convert_text, eval_bleu
 from pytorch_lightning.utilities import rank_zero_info
 
 
-try:
-    from fairseq.data.data_utils import batch_by_size
-
-    FAIRSEQ_AVAILABLE = True
-except (ImportError, ModuleNotFoundError):
-    FAIRSEQ_AVAILABLE = False
-
-
 def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=-100):
     """From fairseq"""
     if target.dim() == lprobs.dim() - 1:
@@ -54,6 +49,17 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=-100):
     return loss, nll_loss
 
 
+def example_label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=-100) -> torch.Tensor:
+    """The loss of label_smoothed_nll_loss summed over the tokens of each example (row of target) separately."""
+    nll_loss = -lprobs.gather(dim=-1, index=target.unsqueeze(-1)).squeeze(-1)
+    smooth_loss = -lprobs.sum(dim=-1)
+    pad_mask = target.eq(ignore_index)
+    nll_loss = nll_loss.masked_fill(pad_mask, 0.0).sum(1)
+    smooth_loss = smooth_loss.masked_fill(pad_mask, 0.0).sum(1)
+    eps_i = epsilon / lprobs.size(-1)
+    return (1.0 - epsilon) * nll_loss + eps_i * smooth_loss
+
+
 def lmap(f: Callable, x: Iterable) -> List:
     """list(map(f, x))"""
     return list(map(f, x))
@@ -116,72 +122,95 @@ class AbstractSeq2SeqDataset(Dataset):
         type_path="train",
         n_obs=None,
         prefix="",
+        pad_to_multiple_of=None,
         **dataset_kwargs
     ):
         super().__init__()
         self.src_file = Path(data_dir).joinpath(type_path + ".source")
         self.tgt_file = Path(data_dir).joinpath(type_path + ".target")
         self.len_file = Path(data_dir).joinpath(type_path + ".len")
-        if os.path.exists(self.len_file):
-            self.src_lens = pickle_load(self.len_file)
-            self.used_char_len = False
-        else:
-            self.src_lens = self.get_char_lens(self.src_file)
-            self.used_char_len = True
         self.max_source_length = max_source_length
         self.max_target_length = max_target_length
-        assert min(self.src_lens) > 0, f"found empty line in {self.src_file}"
         self.tokenizer = tokenizer
         self.prefix = prefix if prefix is not None else ""
-
-        if n_obs is not None:
-            self.src_lens = self.src_lens[:n_obs]
         self.pad_token_id = self.tokenizer.pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
         self.dataset_kwargs = dataset_kwargs
         dataset_kwargs.update({"add_prefix_space": True} if isinstance(self.tokenizer, BartTokenizer) else {})
 
+        self.src_lens, self.used_char_len = self.load_src_lens()
+        assert min(self.src_lens) > 0, f"found empty line in {self.src_file}"
+        if n_obs is not None:
+            self.src_lens = self.src_lens[:n_obs]
+
     def __len__(self):
         return len(self.src_lens)
 
+    def load_src_lens(self) -> Tuple[List[int], bool]:
+        """Source lengths used by the samplers, and whether they are character (not token) lengths."""
+        if os.path.exists(self.len_file):
+            return pickle_load(self.len_file), False
+        return self.get_char_lens(self.src_file), True
+
     @staticmethod
     def get_char_lens(data_file):
-        return [len(x) for x in Path(data_file).open().readlines()]
+        """Length of each line in bytes (including the newline), read from the line-offset index."""
+        return np.diff(LineOffsetReader(data_file).offsets).tolist()
+
+    @cached_property
+    def src_reader(self):
+        return LineOffsetReader(self.src_file)
+
+    @cached_property
+    def tgt_reader(self):
+        return LineOffsetReader(self.tgt_file)
 
     @cached_property
     def tgt_lens(self):
         """Length in characters of target documents"""
         return self.get_char_lens(self.tgt_file)
 
-    def make_sortish_sampler(self, batch_size, distributed=False, shuffle=True, **kwargs):
+    def make_sortish_sampler(self, batch_size, distributed=False, shuffle=True, seed=0, **kwargs):
         if distributed:
-            return DistributedSortishSampler(self, batch_size, shuffle=shuffle, **kwargs)
+            return DistributedSortishSampler(self, batch_size, shuffle=shuffle, seed=seed, **kwargs)
         else:
-            return SortishSampler(self.src_lens, batch_size, shuffle=shuffle)
+            return SortishSampler(self.src_lens, batch_size, shuffle=shuffle, seed=seed)
 
-    def make_dynamic_sampler(self, max_tokens_per_batch=1024, **kwargs):
-        assert FAIRSEQ_AVAILABLE, "Dynamic batch size requires `pip install fairseq`"
+    def make_dynamic_sampler(
+        self, max_tokens_per_batch=1024, distributed=False, shuffle=True, seed=0, required_batch_size_multiple=64
+    ):
         assert not self.used_char_len, "You must call  python make_len_file.py before calling make_dynamic_sampler"
-        sorted_indices = list(self.make_sortish_sampler(1024, shuffle=False))
-
-        def num_tokens_in_example(i):
-            return min(self.src_lens[i], self.max_target_length)
-
-        # call fairseq cython function
-        batch_sampler: List[List[int]] = batch_by_size(
-            sorted_indices,
-            num_tokens_fn=num_tokens_in_example,
-            max_tokens=max_tokens_per_batch,
-            required_batch_size_multiple=64,
+        src_lens = np.asarray(self.src_lens)
+        batches = token_budget_batches(
+            np.minimum(src_lens, self.max_target_length),
+            max_tokens_per_batch,
+            required_batch_size_multiple=required_batch_size_multiple,
         )
-        shuffled_batches = [batch_sampler[i] for i in np.random.permutation(range(len(batch_sampler)))]
-        # move the largest batch to the front to OOM quickly (uses an approximation for padding)
-        approximate_toks_per_batch = [max(self.src_lens[i] for i in batch) * len(batch) for batch in shuffled_batches]
-        largest_batch_idx = np.argmax(approximate_toks_per_batch)
-        shuffled_batches[0], shuffled_batches[largest_batch_idx] = (
-            shuffled_batches[largest_batch_idx],
-            shuffled_batches[0],
+        # padded size of each batch (uses the untruncated source lengths as an approximation)
+        sizes = np.array([len(batch) for batch in batches])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        batch_tokens = np.maximum.reduceat(src_lens[np.concatenate(batches)], starts) * sizes
+        num_replicas, rank = (None, None) if distributed else (1, 0)
+        return DynamicBatchSampler(
+            batches, batch_tokens, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed
         )
-        return shuffled_batches
+
+    def make_eval_batches(self, max_tokens, num_beams=1, max_gen_length=None, distributed=False):
+        """Longest-first generation batches whose num_beams * (source + max_gen_length) tokens fit max_tokens.
+
+        Use as a DataLoader batch_sampler. The batches are not in file order; the "ids" of each batch give it back.
+        With distributed, each rank gets a DynamicBatchSampler share of the batches, with about as many tokens.
+        """
+        assert not self.used_char_len, "You must call  python make_len_file.py before calling make_eval_batches"
+        max_gen_length = self.max_target_length if max_gen_length is None else max_gen_length
+        src_lens = np.minimum(np.asarray(self.src_lens), self.max_source_length)
+        num_tokens = num_beams * (src_lens + max_gen_length)
+        batches = token_budget_batches(num_tokens, max_tokens)
+        if distributed:
+            # the first example of each batch is its longest
+            batch_tokens = [num_tokens[batch[0]] * len(batch) for batch in batches]
+            return DynamicBatchSampler(batches, batch_tokens, shuffle=False)
+        return [batch.tolist() for batch in batches]
 
     def __getitem__(self, item):
         raise NotImplementedError("You must implement this")
@@ -190,26 +219,93 @@ class AbstractSeq2SeqDataset(Dataset):
         raise NotImplementedError("You must implement this")
 
 
+class LineOffsetReader:
+    """Random access to the lines of a text file by slicing an mmap, instead of linecache.
+
+    linecache reads the whole file into every DataLoader worker. This reader keeps a line-offset index in
+    ``{path}.offsets`` (int64, one more entry than lines), built once and memory-mapped like the file itself,
+    so each worker only touches the pages it reads.
+    """
+
+    def __init__(self, path, chunk_size=1 << 24):
+        self.path = Path(path)
+        self.index_path = self.path.with_name(self.path.name + ".offsets")
+        self.chunk_size = chunk_size
+        self._mmap = None
+        self.offsets = self.load_offsets()
+
+    def load_offsets(self) -> np.ndarray:
+        size = os.path.getsize(self.path)
+        if self.index_path.exists() and os.path.getmtime(self.index_path) >= os.path.getmtime(self.path):
+            offsets = np.memmap(self.index_path, dtype=np.int64, mode="r")
+            if len(offsets) > 0 and offsets[-1] == size:
+                return offsets
+        offsets = self.build_offsets()
+        try:
+            offsets.tofile(self.index_path)
+        except OSError:  # read-only data dir: keep the index in memory
+            return offsets
+        return np.memmap(self.index_path, dtype=np.int64, mode="r")
+
+    def build_offsets(self) -> np.ndarray:
+        """Start offset of every line plus the file size, scanning the file in chunks for newlines."""
+        line_starts = [np.zeros(1, dtype=np.int64)]
+        size = 0
+        with self.path.open("rb") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+                line_starts.append(newlines.astype(np.int64) + size + 1)
+                size += len(chunk)
+        offsets = np.concatenate(line_starts)
+        if offsets[-1] != size:  # last line without a trailing newline
+            offsets = np.append(offsets, size)
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index) -> str:
+        if self._mmap is None:
+            with self.path.open("rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self._mmap[start:end].decode("utf-8").rstrip("\n")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mmap"] = None  # each worker maps the file itself
+        if isinstance(self.offsets, np.memmap):
+            state["offsets"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.offsets is None:
+            self.offsets = np.memmap(self.index_path, dtype=np.int64, mode="r")
+
+
 class LegacySeq2SeqDataset(AbstractSeq2SeqDataset):
     def __getitem__(self, index) -> Dict[str, torch.Tensor]:
         """Call tokenizer on src and tgt_lines"""
 
 
-        index = index + 1  # linecache starts at 1
-        source_line = self.prefix + linecache.getline(str(self.src_file), index).rstrip("\n")
-        tgt_line = linecache.getline(str(self.tgt_file), index).rstrip("\n")
+        source_line = self.prefix + self.src_reader[index]
+        tgt_line = self.tgt_reader[index]
         assert source_line, f"empty source line for index {index}"
         assert tgt_line, f"empty tgt line for index {index}"
-        source_inputs = self.encode_line(self.tokenizer, source_line, self.max_source_length)
-        target_inputs = self.encode_line(self.tokenizer, tgt_line, self.max_target_length)
-
-        source_ids = source_inputs["input_ids"].squeeze()
-        target_ids = target_inputs["input_ids"].squeeze()
-        src_mask = source_inputs["attention_mask"].squeeze()
+        source_inputs = self.encode_line(
+            self.tokenizer, source_line, self.max_source_length, pad_to_max_length=False, return_tensors=None
+        )
+        target_inputs = self.encode_line(
+            self.tokenizer, tgt_line, self.max_target_length, pad_to_max_length=False, return_tensors=None
+        )
         return {
-            "input_ids": source_ids,
-            "attention_mask": src_mask,
-            "labels": target_ids,
+            "input_ids": source_inputs["input_ids"][0],
+            "labels": target_inputs["input_ids"][0],
+            "id": index,
         }
 
     def encode_line(self, tokenizer, line, max_length, pad_to_max_length=True, return_tensors="pt"):
@@ -217,25 +313,26 @@ class LegacySeq2SeqDataset(AbstractSeq2SeqDataset):
         return tokenizer(
             [line],
             max_length=max_length,
-            padding="max_length" if pad_to_max_length else None,
+            padding="max_length" if pad_to_max_length else False,
             truncation=True,
             return_tensors=return_tensors,
             **self.dataset_kwargs,
         )
 
     def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
-        input_ids = torch.stack([x["input_ids"] for x in batch])
-        masks = torch.stack([x["attention_mask"] for x in batch])
-        target_ids = torch.stack([x["labels"] for x in batch])
-        pad_token_id = self.pad_token_id
-        y = trim_batch(target_ids, pad_token_id)
-        source_ids, source_mask = trim_batch(input_ids, pad_token_id, attention_mask=masks)
-        batch = {
-            "input_ids": source_ids,
-            "attention_mask": source_mask,
-            "labels": y,
+        """Pad the unpadded id lists once, to the longest example (rounded up to pad_to_multiple_of)."""
+        input_ids, attention_mask = pad_token_ids(
+            [x["input_ids"] for x in batch], self.pad_token_id, pad_to_multiple_of=self.pad_to_multiple_of
+        )
+        labels, _ = pad_token_ids(
+            [x["labels"] for x in batch], self.pad_token_id, pad_to_multiple_of=self.pad_to_multiple_of
+        )
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+            "ids": torch.tensor([x["id"] for x in batch]),
         }
-        return batch
 
 
 class Seq2SeqDataset(AbstractSeq2SeqDataset):
@@ -249,12 +346,11 @@ class Seq2SeqDataset(AbstractSeq2SeqDataset):
         #     print('aac')
         #     exit()
 
-        index = index + 1  # linecache starts at 1
-        source_line = self.prefix + linecache.getline(str(self.src_file), index).rstrip("\n")
-        tgt_line = linecache.getline(str(self.tgt_file), index).rstrip("\n")
+        source_line = self.prefix + self.src_reader[index]
+        tgt_line = self.tgt_reader[index]
         assert source_line, f"empty source line for index {index}"
         assert tgt_line, f"empty tgt line for index {index}"
-        return {"tgt_texts": tgt_line, "src_texts": source_line, "id": index - 1}
+        return {"tgt_texts": tgt_line, "src_texts": source_line, "id": index}
 
     def collate_fn(self, batch):
         """Call prepare_seq2seq_batch."""
@@ -272,6 +368,468 @@ class Seq2SeqDataset(AbstractSeq2SeqDataset):
 
         return batch_encoding
 
+    def pack_collate_fn(self, batch):
+        """Tokenize without padding and pack the examples into as few rows as possible (see pack_examples)."""
+        encoding = self.tokenizer.prepare_seq2seq_batch(
+            [x["src_texts"] for x in batch],
+            tgt_texts=[x["tgt_texts"] for x in batch],
+            max_length=self.max_source_length,
+            max_target_length=self.max_target_length,
+            padding=False,
+            return_tensors=None,
+            **self.dataset_kwargs,
+        )
+        return pack_examples(
+            encoding["input_ids"],
+            encoding["labels"],
+            self.max_source_length,
+            self.max_target_length,
+            self.pad_token_id,
+        )
+
+
+class StreamingSeq2SeqDataset(IterableDataset):
+    """Stream examples from sharded corpora, mixed by weight, without loading or listing the examples.
+
+    Each corpus is a glob of ``{shard}.source`` files with a matching ``{shard}.target`` next to each one.
+    Shards are split between DDP ranks and DataLoader workers without overlap: whole shards when there are at
+    least as many shards as readers, every n-th line of each shard otherwise. At every step a corpus is drawn
+    with probability proportional to its weight; a corpus that runs out restarts with a new shard order. An
+    epoch is ``epoch_size`` examples, by default the total number of lines of all corpora.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        corpora: List[Tuple[str, float]],
+        max_source_length,
+        max_target_length,
+        prefix="",
+        epoch_size=None,
+        shuffle_buffer_size=1000,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+        **dataset_kwargs
+    ):
+        super().__init__()
+        self.shards = []
+        for pattern, _ in corpora:
+            shards = sorted(glob(pattern))
+            assert shards, f"no shards match {pattern}"
+            for shard in shards:
+                assert os.path.exists(self.target_file(shard)), f"missing {self.target_file(shard)}"
+            self.shards.append(shards)
+        weights = np.array([weight for _, weight in corpora], dtype=np.float64)
+        self.weights = weights / weights.sum()
+        self.tokenizer = tokenizer
+        self.max_source_length = max_source_length
+        self.max_target_length = max_target_length
+        self.prefix = prefix if prefix is not None else ""
+        self.epoch_size = epoch_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.pad_token_id = self.tokenizer.pad_token_id
+        self.dataset_kwargs = dataset_kwargs
+        dataset_kwargs.update({"add_prefix_space": True} if isinstance(self.tokenizer, BartTokenizer) else {})
+
+    @staticmethod
+    def target_file(source_file):
+        return str(source_file)[: -len(".source")] + ".target"
+
+    def __len__(self):
+        if self.epoch_size is None:
+            self.epoch_size = sum(len(LineOffsetReader(shard)) for shards in self.shards for shard in shards)
+        return self.epoch_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def reader_slot(self) -> Tuple[int, int]:
+        """(index of this reader, number of readers) over all ranks and DataLoader workers."""
+        worker_info = get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        return self.rank * num_workers + worker_id, self.num_replicas * num_workers
+
+    def corpus_stream(self, shards, slot, num_slots, rng) -> Iterable[Dict[str, str]]:
+        """Endless examples of one corpus for this reader, with a new shard order on every pass."""
+        while True:
+            if len(shards) >= num_slots:
+                jobs = [(shards[i], 0, 1) for i in rng.permutation(len(shards)) if i % num_slots == slot]
+            else:
+                jobs = [(shards[i], slot, num_slots) for i in rng.permutation(len(shards))]
+            num_read = 0
+            for shard, start, step in jobs:
+                with open(shard) as src_f, open(self.target_file(shard)) as tgt_f:
+                    for src_line, tgt_line in itertools.islice(zip(src_f, tgt_f), start, None, step):
+                        num_read += 1
+                        yield {"src_texts": self.prefix + src_line.rstrip("\n"), "tgt_texts": tgt_line.rstrip("\n")}
+            assert num_read > 0, f"reader {slot} of {num_slots} got no examples from {shards[0]} and its siblings"
+
+    def __iter__(self):
+        slot, num_slots = self.reader_slot()
+        rng = np.random.RandomState([self.seed, self.epoch, slot])
+        streams = [self.corpus_stream(shards, slot, num_slots, rng) for shards in self.shards]
+        buffer = []
+        for _ in range(int(math.ceil(len(self) / num_slots))):
+            buffer.append(next(streams[rng.choice(len(streams), p=self.weights)]))
+            if len(buffer) >= self.shuffle_buffer_size:
+                i = rng.randint(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def collate_fn(self, batch):
+        """Call prepare_seq2seq_batch."""
+        return self.tokenizer.prepare_seq2seq_batch(
+            [x["src_texts"] for x in batch],
+            tgt_texts=[x["tgt_texts"] for x in batch],
+            max_length=self.max_source_length,
+            max_target_length=self.max_target_length,
+            return_tensors="pt",
+            **self.dataset_kwargs,
+        ).data
+
+
+def parse_corpora(specs: List[str]) -> List[Tuple[str, float]]:
+    """Parse ``GLOB[:WEIGHT]`` strings, e.g. ``data/amr-silver/*.source:0.3``; the weight defaults to 1."""
+    corpora = []
+    for spec in specs:
+        pattern, _, weight = spec.rpartition(":")
+        try:
+            corpora.append((pattern, float(weight)))
+        except ValueError:
+            corpora.append((spec, 1.0))
+    return corpora
+
+
+def find_tokenizer_mismatch(fast_tokenizer, slow_tokenizer, lines: List[str], **slow_kwargs):
+    """First line whose ids (or decoded text) differ between the two tokenizers, as a tuple, or None."""
+    fast_ids = fast_tokenizer(lines)["input_ids"]
+    slow_ids = slow_tokenizer(lines, **slow_kwargs)["input_ids"]
+    fast_text = fast_batch_decode(fast_tokenizer, slow_ids)
+    slow_text = slow_tokenizer.batch_decode(slow_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+    for line, fast, slow, fast_decoded, slow_decoded in zip(lines, fast_ids, slow_ids, fast_text, slow_text):
+        if fast != slow or fast_decoded.strip() != slow_decoded.strip():
+            return line, fast, slow
+    return None
+
+
+BINARIZED_SIDES = ("src", "tgt")
+
+
+def get_graph2text_prefix(model_name_or_path, cache_dir=None) -> str:
+    """The source prefix SummarizationModule uses for this model, without loading the model."""
+    if "t5" in model_name_or_path:
+        return T5_PREFIX
+    return AutoConfig.from_pretrained(model_name_or_path, cache_dir=cache_dir).prefix or ""
+
+
+def pad_token_ids(
+    sequences: List, pad_token_id: int, pad_to_multiple_of: Optional[int] = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Right-pad variable-length id sequences into a (bs, max_len) LongTensor and its attention mask.
+
+    The output is allocated once at its final size and filled with a single masked copy of the concatenated
+    ids. With pad_to_multiple_of, max_len is rounded up to a multiple of it so that batch shapes repeat.
+    """
+    lens = np.array([len(s) for s in sequences], dtype=np.int64)
+    max_len = int(lens.max())
+    if pad_to_multiple_of:
+        max_len = -(-max_len // pad_to_multiple_of) * pad_to_multiple_of
+    mask = torch.from_numpy(np.arange(max_len) < lens[:, None])
+    input_ids = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.long)
+    input_ids[mask] = torch.from_numpy(np.concatenate(sequences).astype(np.int64, copy=False))
+    return input_ids, mask.long()
+
+
+def pack_examples(
+    src_ids: List,
+    tgt_ids: List,
+    max_source_length: int,
+    max_target_length: int,
+    pad_token_id: int,
+    decoder_start_token_id: Optional[int] = None,
+) -> Dict[str, torch.Tensor]:
+    """Concatenate consecutive examples into rows of at most max_source_length / max_target_length tokens.
+
+    Besides input_ids and labels, returns decoder_input_ids shifted within each example, and block-diagonal
+    masks so that no position sees another example: attention_mask (src x src), decoder_attention_mask
+    (tgt x tgt, causal) and cross_attention_mask (tgt x src). Positions after the last example of a row are
+    labelled pad, so the loss ignores them. Only valid for models with relative positions (T5).
+    """
+    decoder_start_token_id = pad_token_id if decoder_start_token_id is None else decoder_start_token_id
+    rows = []
+    src_used = tgt_used = 0
+    for i, (src, tgt) in enumerate(zip(src_ids, tgt_ids)):
+        if rows and src_used + len(src) <= max_source_length and tgt_used + len(tgt) <= max_target_length:
+            rows[-1].append(i)
+            src_used, tgt_used = src_used + len(src), tgt_used + len(tgt)
+        else:
+            rows.append([i])
+            src_used, tgt_used = len(src), len(tgt)
+
+    src_width = max(sum(len(src_ids[i]) for i in row) for row in rows)
+    tgt_width = max(sum(len(tgt_ids[i]) for i in row) for row in rows)
+    input_ids = torch.full((len(rows), src_width), pad_token_id, dtype=torch.long)
+    labels = torch.full((len(rows), tgt_width), pad_token_id, dtype=torch.long)
+    decoder_input_ids = torch.full((len(rows), tgt_width), pad_token_id, dtype=torch.long)
+    # 1-based example number of every position in its row, 0 for padding
+    src_segments = torch.zeros((len(rows), src_width), dtype=torch.long)
+    tgt_segments = torch.zeros((len(rows), tgt_width), dtype=torch.long)
+    for r, row in enumerate(rows):
+        src_start = tgt_start = 0
+        for segment, i in enumerate(row, start=1):
+            src = torch.tensor(src_ids[i], dtype=torch.long)
+            tgt = torch.tensor(tgt_ids[i], dtype=torch.long)
+            src_end, tgt_end = src_start + len(src), tgt_start + len(tgt)
+            input_ids[r, src_start:src_end] = src
+            labels[r, tgt_start:tgt_end] = tgt
+            decoder_input_ids[r, tgt_start] = decoder_start_token_id
+            decoder_input_ids[r, tgt_start + 1 : tgt_end] = tgt[:-1]
+            src_segments[r, src_start:src_end] = segment
+            tgt_segments[r, tgt_start:tgt_end] = segment
+            src_start, tgt_start = src_end, tgt_end
+
+    def same_example(query, key):
+        return (query[:, :, None] == key[:, None, :]) & (query[:, :, None] > 0)
+
+    causal = torch.ones((tgt_width, tgt_width), dtype=torch.long).tril().bool()
+    return {
+        "input_ids": input_ids,
+        "attention_mask": same_example(src_segments, src_segments).long(),
+        "decoder_input_ids": decoder_input_ids,
+        "decoder_attention_mask": (same_example(tgt_segments, tgt_segments) & causal).long(),
+        "cross_attention_mask": same_example(tgt_segments, src_segments).long(),
+        "labels": labels,
+    }
+
+
+def binarized_cache_prefix(
+    data_dir, type_path, model_name_or_path, tokenizer, prefix, max_source_length, max_target_length
+) -> str:
+    """Path prefix of a binarized split, keyed by everything that changes the token ids."""
+    key = json.dumps(
+        {
+            "tokenizer": tokenizer.__class__.__name__,
+            "vocab_size": len(tokenizer),
+            "additional_special_tokens": tokenizer.additional_special_tokens,
+            "prefix": prefix or "",
+        },
+        sort_keys=True,
+    )
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()[:10]
+    model_name = list(filter(None, model_name_or_path.split("/"))).pop()
+    return os.path.join(
+        data_dir, f"cached_{type_path}_{model_name}_{max_source_length}_{max_target_length}_{digest}"
+    )
+
+
+def binarize_split(
+    tokenizer,
+    src_file,
+    tgt_file,
+    cache_prefix,
+    max_source_length,
+    max_target_length,
+    prefix="",
+    chunk_size=1000,
+    **dataset_kwargs
+) -> int:
+    """Tokenize a split once and write flat token-id arrays plus offsets that np.memmap can read.
+
+    For each side this writes ``{cache_prefix}.{side}.bin`` (ids) and ``{cache_prefix}.{side}.idx`` (int64
+    offsets, one more than the number of examples). ``{cache_prefix}.json`` is written last and marks the
+    cache as complete. Returns the number of examples.
+
+    Every file is written under a name of its own process and then renamed, so processes that binarize the same
+    split at once each put complete files in place, and a reader never maps a file that is still being written.
+    """
+    dtype = np.uint16 if len(tokenizer) < np.iinfo(np.uint16).max else np.int32
+    lengths = {side: [] for side in BINARIZED_SIDES}
+    suffix = f"{socket.gethostname()}.{os.getpid()}.tmp"
+    tmp = {side: f"{cache_prefix}.{side}.bin.{suffix}" for side in BINARIZED_SIDES}
+    writers = {side: open(tmp[side], "wb") for side in BINARIZED_SIDES}
+    try:
+        with Path(src_file).open() as src_f, Path(tgt_file).open() as tgt_f:
+            while True:
+                src_lines = [prefix + x.rstrip("\n") for x in itertools.islice(src_f, chunk_size)]
+                tgt_lines = [x.rstrip("\n") for x in itertools.islice(tgt_f, chunk_size)]
+                if not src_lines:
+                    break
+                assert len(src_lines) == len(tgt_lines), f"{src_file} and {tgt_file} have different lengths"
+                encoding = tokenizer.prepare_seq2seq_batch(
+                    src_lines,
+                    tgt_texts=tgt_lines,
+                    max_length=max_source_length,
+                    max_target_length=max_target_length,
+                    padding=False,
+                    return_tensors=None,
+                    **dataset_kwargs,
+                )
+                for side, key in zip(BINARIZED_SIDES, ["input_ids", "labels"]):
+                    for ids in encoding[key]:
+                        assert len(ids) > 0, f"empty {side} line in {src_file if side == 'src' else tgt_file}"
+                        writers[side].write(np.asarray(ids, dtype=dtype).tobytes())
+                        lengths[side].append(len(ids))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for side in BINARIZED_SIDES:
+        offsets = np.zeros(len(lengths[side]) + 1, dtype=np.int64)
+        np.cumsum(lengths[side], out=offsets[1:])
+        offsets.tofile(f"{cache_prefix}.{side}.idx.{suffix}")
+        os.replace(f"{cache_prefix}.{side}.idx.{suffix}", f"{cache_prefix}.{side}.idx")
+        os.replace(tmp[side], f"{cache_prefix}.{side}.bin")
+    num_examples = len(lengths["src"])
+    save_json({"dtype": np.dtype(dtype).name, "num_examples": num_examples}, f"{cache_prefix}.json.{suffix}")
+    os.replace(f"{cache_prefix}.json.{suffix}", f"{cache_prefix}.json")
+    return num_examples
+
+
+class BinarizedSeq2SeqDataset(AbstractSeq2SeqDataset):
+    """A dataset that reads token ids tokenized once by binarize_split through np.memmap.
+
+    The cache is built on first use if ``{cache_prefix}.json`` is missing; SummarizationModule.prepare_data builds
+    it before the DDP processes start. Lengths used by the samplers are true token lengths, so make_dynamic_sampler
+    works without a .len file.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        data_dir,
+        max_source_length,
+        max_target_length,
+        type_path="train",
+        n_obs=None,
+        prefix="",
+        cache_prefix=None,
+        **dataset_kwargs
+    ):
+        self.cache_prefix = cache_prefix or binarized_cache_prefix(
+            data_dir, type_path, tokenizer.__class__.__name__, tokenizer, prefix, max_source_length, max_target_length
+        )
+        self._memmaps = None
+        super().__init__(
+            tokenizer,
+            data_dir,
+            max_source_length,
+            max_target_length,
+            type_path=type_path,
+            n_obs=n_obs,
+            prefix=prefix,
+            **dataset_kwargs,
+        )
+
+    def load_src_lens(self) -> Tuple[List[int], bool]:
+        if not os.path.exists(f"{self.cache_prefix}.json"):
+            rank_zero_info("Binarizing %s into %s", self.src_file, self.cache_prefix)
+            binarize_split(
+                self.tokenizer,
+                self.src_file,
+                self.tgt_file,
+                self.cache_prefix,
+                self.max_source_length,
+                self.max_target_length,
+                prefix=self.prefix,
+                **self.dataset_kwargs,
+            )
+        return np.diff(self.memmaps["src"][1]).tolist(), False
+
+    @property
+    def memmaps(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """(ids, offsets) per side, opened lazily so that each DataLoader worker maps the files itself."""
+        if self._memmaps is None:
+            dtype = load_json(f"{self.cache_prefix}.json")["dtype"]
+            self._memmaps = {
+                side: (
+                    np.memmap(f"{self.cache_prefix}.{side}.bin", dtype=dtype, mode="r"),
+                    np.memmap(f"{self.cache_prefix}.{side}.idx", dtype=np.int64, mode="r"),
+                )
+                for side in BINARIZED_SIDES
+            }
+        return self._memmaps
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_memmaps"] = None  # pickling a memmap would copy the whole array
+        return state
+
+    @cached_property
+    def tgt_lens(self):
+        """Length in tokens of target documents"""
+        return np.diff(self.memmaps["tgt"][1]).tolist()
+
+    def __getitem__(self, index) -> Dict[str, np.ndarray]:
+        (src_ids, src_offsets), (tgt_ids, tgt_offsets) = self.memmaps["src"], self.memmaps["tgt"]
+        return {
+            "input_ids": src_ids[src_offsets[index] : src_offsets[index + 1]],
+            "labels": tgt_ids[tgt_offsets[index] : tgt_offsets[index + 1]],
+            "id": index,
+        }
+
+    def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
+        input_ids, attention_mask = pad_token_ids(
+            [x["input_ids"] for x in batch], self.pad_token_id, pad_to_multiple_of=self.pad_to_multiple_of
+        )
+        labels, _ = pad_token_ids(
+            [x["labels"] for x in batch], self.pad_token_id, pad_to_multiple_of=self.pad_to_multiple_of
+        )
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+            "ids": torch.tensor([x["id"] for x in batch]),
+        }
+
+
+class DedupSeq2SeqDataset(Dataset):
+    """The unique (source, target) pairs of several splits of the same data, e.g. test_seen and test_unseen, which
+    are subsets of test_both, so that each graph is generated once.
+
+    ``split_indices[k][i]`` is the index in this dataset of example i of ``datasets[k]``; the "id" of an example is
+    its index here.
+    """
+
+    def __init__(self, datasets: List[AbstractSeq2SeqDataset]):
+        super().__init__()
+        self.datasets = datasets
+        self.examples: List[Tuple[int, int]] = []  # (split, index in split) of each unique pair
+        self.split_indices: List[List[int]] = []
+        index_of_pair = {}
+        for k, dataset in enumerate(datasets):
+            indices = []
+            for i in range(len(dataset)):
+                pair = (dataset.src_reader[i], dataset.tgt_reader[i])
+                if pair not in index_of_pair:
+                    index_of_pair[pair] = len(self.examples)
+                    self.examples.append((k, i))
+                indices.append(index_of_pair[pair])
+            self.split_indices.append(indices)
+        self.max_source_length = datasets[0].max_source_length
+        self.max_target_length = datasets[0].max_target_length
+        self.src_lens = [datasets[k].src_lens[i] for k, i in self.examples]
+        self.used_char_len = any(dataset.used_char_len for dataset in datasets)
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, index):
+        k, i = self.examples[index]
+        item = self.datasets[k][i]
+        item["id"] = index
+        return item
+
+    def collate_fn(self, batch):
+        return self.datasets[0].collate_fn(batch)
+
+    make_eval_batches = AbstractSeq2SeqDataset.make_eval_batches
 
 
 class Seq2SeqDataCollator:
@@ -341,41 +899,113 @@ class Seq2SeqDataCollator:
 class SortishSampler(Sampler):
     "Go through the text data by order of src length with a bit of randomness. From fastai repo."
 
-    def __init__(self, data, batch_size, shuffle=True):
+    def __init__(self, data, batch_size, shuffle=True, seed=0):
         self.data, self.bs, self.shuffle = data, batch_size, shuffle
+        self.seed = seed
+        self.epoch = 0
 
     def __len__(self) -> int:
         return len(self.data)
 
     def __iter__(self):
-        return iter(sortish_sampler_indices(self.data, self.bs, shuffle=self.shuffle))
+        rng = np.random.RandomState([self.seed, self.epoch])
+        return iter(sortish_sampler_indices(self.data, self.bs, shuffle=self.shuffle, rng=rng).tolist())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
 
-def sortish_sampler_indices(data: List, bs: int, shuffle=True) -> np.array:
+def sortish_sampler_indices(data: List, bs: int, shuffle=True, rng: np.random.RandomState = None) -> np.array:
     "Go through the text data by order of src length with a bit of randomness. From fastai repo."
+    data = np.asarray(data)
     if not shuffle:
-        return np.argsort(np.array(data) * -1)
+        return np.argsort(data * -1)
+    if rng is None:
+        rng = np.random
+
+    idxs = rng.permutation(len(data))
+    # sort chunks of 50 batches by decreasing length (lexsort is stable, like sorted(..., reverse=True))
+    chunk_ids = np.arange(len(idxs)) // (bs * 50)
+    sort_idx = idxs[np.lexsort((-data[idxs], chunk_ids))]
+    num_batches = int(math.ceil(len(sort_idx) / bs))
+    batch_order = np.arange(num_batches)
+    max_ck = np.argmax(data[sort_idx[::bs]])  # find the chunk with the largest key,
+    batch_order[0], batch_order[max_ck] = max_ck, 0  # then make sure it goes first.
+    batch_order[1:] = batch_order[1:][rng.permutation(num_batches - 1)]
+    # expand the batch order back to positions in sort_idx
+    starts = batch_order * bs
+    batch_lens = np.minimum(bs, len(sort_idx) - starts)
+    offsets = np.cumsum(batch_lens) - batch_lens
+    return sort_idx[np.repeat(starts - offsets, batch_lens) + np.arange(len(sort_idx))]
+
+
+def token_budget_batches(num_tokens, max_tokens, required_batch_size_multiple=1) -> List[np.ndarray]:
+    """Group example indices, longest first, into batches whose padded size stays within max_tokens.
+
+    Native replacement for fairseq's batch_by_size: sorting makes the first example of every batch its longest,
+    so each batch size is max_tokens // (length of its first example), rounded down to a multiple of
+    required_batch_size_multiple when the batch is at least that large.
+    """
+    num_tokens = np.asarray(num_tokens)
+    order = np.argsort(-num_tokens, kind="stable")
+    sizes = max_tokens // np.maximum(num_tokens[order], 1)
+    batches = []
+    start = 0
+    while start < len(order):
+        bsz = max(int(sizes[start]), 1)
+        if bsz >= required_batch_size_multiple:
+            bsz -= bsz % required_batch_size_multiple
+        batches.append(order[start : start + bsz])
+        start += bsz
+    return batches
+
+
+class DynamicBatchSampler(Sampler):
+    """Yield token-budget batches, reshuffled each epoch, with the largest batches first to OOM quickly.
+
+    With several replicas, batches of similar padded size are grouped so that every rank gets roughly the same
+    number of tokens at each step, and all ranks get the same number of batches.
+    """
+
+    def __init__(self, batches, batch_tokens, num_replicas=None, rank=None, shuffle=True, seed=0):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+        self.batches = batches
+        self.batch_tokens = np.asarray(batch_tokens)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return int(math.ceil(len(self.batches) / self.num_replicas))
 
-    def key_fn(i):
-        return data[i]
+    def __iter__(self):
+        by_size = np.argsort(-self.batch_tokens, kind="stable")
+        by_size = np.resize(by_size, len(self) * self.num_replicas)  # repeat batches so all ranks get len(self)
+        steps = by_size.reshape(len(self), self.num_replicas)
+        if self.shuffle:
+            rng = np.random.RandomState([self.seed, self.epoch])
+            steps = np.concatenate([steps[:1], steps[1:][rng.permutation(len(steps) - 1)]])
+        return iter(self.batches[i].tolist() for i in steps[:, self.rank])
 
-    idxs = np.random.permutation(len(data))
-    sz = bs * 50
-    ck_idx = [idxs[i : i + sz] for i in range(0, len(idxs), sz)]
-    sort_idx = np.concatenate([sorted(s, key=key_fn, reverse=True) for s in ck_idx])
-    sz = bs
-    ck_idx = [sort_idx[i : i + sz] for i in range(0, len(sort_idx), sz)]
-    max_ck = np.argmax([key_fn(ck[0]) for ck in ck_idx])  # find the chunk with the largest key,
-    ck_idx[0], ck_idx[max_ck] = ck_idx[max_ck], ck_idx[0]  # then make sure it goes first.
-    sort_idx = np.concatenate(np.random.permutation(ck_idx[1:])) if len(ck_idx) > 1 else np.array([], dtype=np.int)
-    sort_idx = np.concatenate((ck_idx[0], sort_idx))
-    return sort_idx
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
 
 class DistributedSortishSampler(Sampler):
     """Copied from torch DistributedSampler"""
 
-    def __init__(self, dataset, batch_size, num_replicas=None, rank=None, add_extra_examples=True, shuffle=True):
+    def __init__(
+        self, dataset, batch_size, num_replicas=None, rank=None, add_extra_examples=True, shuffle=True, seed=0
+    ):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -397,14 +1027,15 @@ class DistributedSortishSampler(Sampler):
         self.batch_size = batch_size
         self.add_extra_examples = add_extra_examples
         self.shuffle = shuffle
+        self.seed = seed
 
     def __iter__(self) -> Iterable:
-        g = torch.Generator()
-        g.manual_seed(self.epoch)
-
-        sortish_data = [self.dataset.src_lens[i] for i in self.available_indices]
-        sortish_indices = sortish_sampler_indices(sortish_data, self.batch_size, shuffle=self.shuffle)
-        indices = [self.available_indices[i] for i in sortish_indices]
+        # every rank seeds with the same (seed, epoch), so orders are reproducible and change every epoch
+        rng = np.random.RandomState([self.seed, self.epoch])
+        available_indices = np.asarray(self.available_indices)
+        sortish_data = np.asarray(self.dataset.src_lens)[available_indices]
+        sortish_indices = sortish_sampler_indices(sortish_data, self.batch_size, shuffle=self.shuffle, rng=rng)
+        indices = available_indices[sortish_indices].tolist()
         assert len(indices) == self.num_samples
         return iter(indices)
 
@@ -454,6 +1085,26 @@ def flatten_list(summary_ids: List[List]):
     return [x for x in itertools.chain.from_iterable(summary_ids)]
 
 
+def all_gather_objects(obj) -> list:
+    """obj of every rank, in rank order; [obj] outside torch.distributed. Like torch>=1.8's all_gather_object.
+
+    obj must not hold CUDA tensors, which would be unpickled on the device of the rank that sent them.
+    """
+    if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+        return [obj]
+    device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+    data = torch.from_numpy(np.frombuffer(pickle.dumps(obj), dtype=np.uint8).copy()).to(device)
+    size = torch.tensor([data.numel()], device=device)
+    sizes = [torch.zeros_like(size) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, size)
+    # all_gather needs tensors of one size
+    padded = torch.zeros(int(max(sizes)), dtype=torch.uint8, device=device)
+    padded[: data.numel()] = data
+    gathered = [torch.zeros_like(padded) for _ in sizes]
+    dist.all_gather(gathered, padded)
+    return [pickle.loads(t[: int(n)].cpu().numpy().tobytes()) for t, n in zip(gathered, sizes)]
+
+
 def save_git_info(folder_path: str) -> None:
     """Save git information to output_dir/git_log.json"""
     repo_infos = get_git_info()
@@ -627,6 +1278,15 @@ def write_txt_file(ordered_tgt, path):
         f.flush()
 
 
+def write_lines_atomic(lines: Iterable[str], path):
+    """Write lines to a temporary file renamed to path, so that no reader sees it half written (with several GPUs,
+    every rank writes the same gathered predictions and may be scoring them)."""
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(line + "\n" for line in lines)
+    os.replace(tmp_path, path)
+
+
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
@@ -1,5 +1,9 @@
+import math
+import multiprocessing
 import re
 import os
+import string
+from collections import Counter
 
 def convert_text(text):
     #return text
@@ -8,6 +12,254 @@ def convert_text(text):
     text = ' '.join(text.split())
     return text
 
+
+# multi-bleu.perl, in process. Like perl without `use utf8`, it works on bytes: only ASCII letters are lowercased and
+# only ASCII whitespace splits words.
+
+BLEU_MAX_ORDER = 4
+_bleu_references = {}  # (reference files, lowercase) -> (their mtimes, per-sentence n-gram counts and lengths)
+
+
+def _perl_lines(data):
+    """The lines of `data` after perl's chop, which also drops the last character of an unterminated last line."""
+    lines = data.split(b"\n")
+    last = lines.pop()
+    return lines + ([last[:-1]] if last else [])
+
+
+def _ngram_counts(words):
+    return Counter(
+        tuple(words[start:start + n]) for n in range(1, BLEU_MAX_ORDER + 1) for start in range(len(words) - n + 1)
+    )
+
+
+def bleu_reference_files(stem, *others):
+    """The files multi-bleu.perl reads for `multi-bleu.perl stem others...`: stem0, stem1, ... and stem (or
+    stem.ref0, ...), then the others that exist."""
+    if not os.path.exists(stem) and not os.path.exists(stem + "0") and os.path.exists(stem + ".ref0"):
+        stem += ".ref"
+    files = []
+    while os.path.exists(stem + str(len(files))):
+        files.append(stem + str(len(files)))
+    if os.path.exists(stem):
+        files.append(stem)
+    return files, [f for f in others if os.path.exists(f)]
+
+
+def bleu_references(stem, *others, lowercase=True):
+    """Per sentence, the clipping count of each reference n-gram (its most frequent in one reference) and the lengths
+    of the references. Computed once per set of reference files, until one of them changes."""
+    files, other_files = bleu_reference_files(stem, *others)
+    key = (tuple(files + other_files), lowercase)
+    mtimes = [os.path.getmtime(f) for f in key[0]]
+    if key in _bleu_references and _bleu_references[key][0] == mtimes:
+        return _bleu_references[key][1]
+    if not files:
+        raise FileNotFoundError(f"could not find reference file {stem}")
+    references = []
+    for i, path in enumerate(key[0]):
+        with open(path, "rb") as f:
+            lines = _perl_lines(f.read())
+        for s, line in enumerate(lines):
+            if s == len(references):
+                references.append((Counter(), []))
+            words = (line.lower() if lowercase else line).split()
+            max_counts, lengths = references[s]
+            max_counts |= _ngram_counts(words)
+            lengths.append(len(words))
+        if i == len(files) - 1 and not references:
+            raise FileNotFoundError(f"could not find reference file {stem}")
+    _bleu_references[key] = (mtimes, references)
+    return references
+
+
+def multi_bleu(hypotheses, stem, *others, lowercase=True):
+    """The score of `multi-bleu.perl [-lc] stem others... < hypotheses`, for hypotheses given as lines or as the path
+    of a file. Where the script dies, with no hypothesis word, the brevity penalty and BLEU are 0."""
+    if isinstance(hypotheses, str):
+        with open(hypotheses, "rb") as f:
+            hypotheses = _perl_lines(f.read())
+    else:
+        hypotheses = [h.encode("utf-8") for h in hypotheses]
+    references = bleu_references(stem, *others, lowercase=lowercase)
+    correct = [0] * (BLEU_MAX_ORDER + 1)
+    total = [0] * (BLEU_MAX_ORDER + 1)
+    hyp_len = ref_len = 0
+    for s, line in enumerate(hypotheses):
+        words = (line.lower() if lowercase else line).split()
+        max_counts, lengths = references[s] if s < len(references) else (Counter(), [])
+        closest_diff, closest_length = 9999, 9999
+        for length in lengths:
+            diff = abs(len(words) - length)
+            if diff < closest_diff or (diff == closest_diff and length < closest_length):
+                closest_diff, closest_length = diff, length
+        hyp_len += len(words)
+        ref_len += closest_length
+        for ngram, count in _ngram_counts(words).items():
+            total[len(ngram)] += count
+            correct[len(ngram)] += min(count, max_counts[ngram])
+    precisions = [correct[n] / total[n] if total[n] else 0 for n in range(1, BLEU_MAX_ORDER + 1)]
+    score = dict(bleu=0.0, precisions=[0.0] * BLEU_MAX_ORDER, bp=0.0, ratio=0.0, hyp_len=hyp_len, ref_len=ref_len)
+    if ref_len == 0:
+        return score
+    if hyp_len == 0:
+        bp = 0.0
+    else:
+        bp = math.exp(1 - ref_len / hyp_len) if hyp_len < ref_len else 1
+    bleu = bp * math.exp(sum(math.log(p) if p else -9999999999 for p in precisions) / BLEU_MAX_ORDER)
+    score.update(bleu=100 * bleu, precisions=[100 * p for p in precisions], bp=bp, ratio=hyp_len / ref_len)
+    return score
+
+
+def format_bleu(score):
+    """The report line of multi-bleu.perl."""
+    if score is None:
+        return "no data"
+    if score["ref_len"] == 0:
+        return "BLEU = 0, 0/0/0/0 (BP=0, ratio=0, hyp_len=0, ref_len=0)"
+    return "BLEU = %.2f, %s (BP=%.3f, ratio=%.3f, hyp_len=%d, ref_len=%d)" % (
+        score["bleu"],
+        "/".join("%.1f" % p for p in score["precisions"]),
+        score["bp"],
+        score["ratio"],
+        score["hyp_len"],
+        score["ref_len"],
+    )
+
+
+# chrF++ of utils/chrf++.py (c6+w2-F2 by default), in process. The reference n-grams of a file are counted once, and
+# the sentences are scored in a process pool; the sums are taken in the script's order, so the scores are identical.
+
+CHRF_CHUNK_SIZE = 256
+_chrf_references = {}  # (reference file, word order, character order) -> (its mtime, per-line n-gram counts)
+
+
+def _chrf_words(line):
+    """separate_punctuation of chrf++.py: the words, with a leading or trailing punctuation mark split off."""
+    words = []
+    for word in line.strip().split():
+        if len(word) > 1 and word[-1] in string.punctuation:
+            words += [word[:-1], word[-1]]
+        elif len(word) > 1 and word[0] in string.punctuation:
+            words += [word[0], word[1:]]
+        else:
+            words.append(word)
+    return words
+
+
+def _chrf_ngrams(items, order):
+    """Counters of the n-grams of a string or tuple, as slices of it, for n up to order."""
+    return [Counter(items[i:i + n] for i in range(len(items) - n + 1)) for n in range(1, order + 1)]
+
+
+def _chrf_stats(line, nworder, ncorder):
+    """Character then word n-gram counts of `line`, each as a list of Counters and a list of totals, by order."""
+    chars = line.strip().replace(" ", "")
+    words = tuple(_chrf_words(line))
+    return [
+        (_chrf_ngrams(chars, ncorder), [max(len(chars) - n, 0) for n in range(ncorder)]),
+        (_chrf_ngrams(words, nworder), [max(len(words) - n, 0) for n in range(nworder)]),
+    ]
+
+
+def chrf_references(reference_file, nworder=2, ncorder=6):
+    """The n-gram counts of every *#-separated reference of every line, until the file changes."""
+    key = (reference_file, nworder, ncorder)
+    mtime = os.path.getmtime(reference_file)
+    if key not in _chrf_references or _chrf_references[key][0] != mtime:
+        with open(reference_file) as f:
+            references = [[_chrf_stats(ref, nworder, ncorder) for ref in line.split("*#")] for line in f]
+        _chrf_references[key] = (mtime, references)
+    return _chrf_references[key][1]
+
+
+def _chrf_prf(matching, ref_total, hyp_total, factor):
+    """Precision, recall and F of one n-gram order, as ngram_precrecf of chrf++.py."""
+    precision = matching / hyp_total if hyp_total > 0 else 1e-16
+    recall = matching / ref_total if ref_total > 0 else 1e-16
+    denom = factor * precision + recall
+    return precision, recall, (1 + factor) * precision * recall / denom if denom > 0 else 1e-16
+
+
+def _chrf_sentence(hypothesis, references, nworder, ncorder, beta):
+    """The best sentence F over the references, with the (matching, reference, hypothesis) n-gram totals by order
+    behind it, or None if no reference beats 0."""
+    factor = beta ** 2
+    hyp = _chrf_stats(hypothesis, nworder, ncorder)
+    max_f, best = 0.0, None
+    for ref in references:
+        sums, counts = [], []
+        for (hyp_ngrams, hyp_totals), (ref_ngrams, ref_totals) in zip(hyp, ref):
+            matching = [
+                sum(min(count, r[ngram]) for ngram, count in h.items() if ngram in r)
+                for h, r in zip(hyp_ngrams, ref_ngrams)
+            ]
+            # chrf++.py only counts the hypothesis n-grams of the orders the reference has
+            hyp_totals = [h if r else 0 for h, r in zip(hyp_totals, ref_totals)]
+            sums.append(sum(_chrf_prf(m, r, h, factor)[2] for m, r, h in zip(matching, ref_totals, hyp_totals) if m))
+            counts.append((matching, ref_totals, hyp_totals))
+        sent_f = (sums[0] + sums[1]) / float(nworder + ncorder)
+        if sent_f > max_f:
+            max_f, best = sent_f, counts
+    return max_f, best
+
+
+def _chrf_chunk(args):
+    reference_file, hypotheses, start, nworder, ncorder, beta = args
+    references = chrf_references(reference_file, nworder, ncorder)
+    return [
+        _chrf_sentence(hypothesis, refs, nworder, ncorder, beta)
+        for hypothesis, refs in zip(hypotheses, references[start:])
+    ]
+
+
+def chrf(hypotheses, reference_file, nworder=2, ncorder=6, beta=2.0, processes=None):
+    """The scores of `chrf++.py -H hypotheses -R reference_file`, for hypotheses given as lines or as the path of a
+    file: c6+w2-F2 as `chrf`, c6+w2-avgF2 as `avg_f`, and `precision` and `recall`, all in percent. None without
+    sentences. `processes` (default: one per CPU) score chunks of CHRF_CHUNK_SIZE sentences in parallel."""
+    if isinstance(hypotheses, str):
+        with open(hypotheses) as f:
+            hypotheses = f.readlines()
+    n = min(len(hypotheses), len(chrf_references(reference_file, nworder, ncorder)))
+    if n == 0:
+        return None
+    chunks = [
+        (reference_file, hypotheses[start:min(start + CHRF_CHUNK_SIZE, n)], start, nworder, ncorder, beta)
+        for start in range(0, n, CHRF_CHUNK_SIZE)
+    ]
+    processes = min(processes or os.cpu_count() or 1, len(chunks))
+    if processes > 1:
+        # forked workers inherit the reference counts of the parent
+        with multiprocessing.Pool(processes) as pool:
+            results = [result for chunk in pool.map(_chrf_chunk, chunks) for result in chunk]
+    else:
+        results = [result for chunk in chunks for result in _chrf_chunk(chunk)]
+
+    totals = [[[0] * order for _ in range(3)] for order in (ncorder, nworder)]
+    average_f = 0.0
+    best = None
+    for sent_f, counts in results:
+        # like chrf++.py, a sentence that no reference matches adds the counts of the last one that did
+        best = counts or best
+        for total, count in zip(totals, best or []):
+            for total_order, count_order in zip(total, count):
+                for order, value in enumerate(count_order):
+                    total_order[order] += value
+        average_f += sent_f
+
+    factor = beta ** 2
+    sums = [[sum(values) for values in zip(*[_chrf_prf(*order, factor) for order in zip(*total)])] for total in totals]
+    precision, recall, f = [(chars + words) / float(nworder + ncorder) for chars, words in zip(*sums)]
+    return dict(chrf=100 * f, avg_f=100 * (average_f / n), precision=100 * precision, recall=100 * recall)
+
+
+def format_chrf(score, nworder=2, ncorder=6, beta=2.0, sep=" "):
+    """The two score lines of chrf++.py, joined by sep."""
+    if score is None:
+        return "no data"
+    name = "c%i+w%i-" % (ncorder, nworder)
+    return "%sF%i\t%.4f%s%savgF%i\t%.4f" % (name, beta, score["chrf"], sep, name, beta, score["avg_f"])
+
 def eval_meteor_test_webnlg(folder_data, pred_file, dataset):
 
     dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -24,35 +276,23 @@ def eval_meteor_test_webnlg(folder_data, pred_file, dataset):
 
 
 def eval_chrf_test_webnlg(folder_data, pred_file, dataset):
+    """chrF++ of pred_file against the *#-separated references of dataset, also written to the .chrf file."""
 
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    folder_data_before = dir_path + "/../utils"
-
-    cmd_string = "python " + folder_data_before + "/chrf++.py -H " + pred_file + " -R " \
-                  + folder_data + "/" + dataset + ".target_eval_crf > " + pred_file.replace("txt", "chrf")
-
-    os.system(cmd_string)
-
-    chrf_info_1 = open(pred_file.replace("txt", "chrf"), 'r').readlines()[1].strip()
-    chrf_info_2 = open(pred_file.replace("txt", "chrf"), 'r').readlines()[2].strip()
-
-    return chrf_info_1 + " " + chrf_info_2
+    return eval_chrf(folder_data + "/" + dataset + ".target_eval_crf", pred_file)
 
 def eval_bleu(folder_data, pred_file, dataset):
+    """multi-bleu.perl -lc of pred_file against the three references of dataset, also written to the .bleu file.
+    None without references."""
 
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    folder_data_before = dir_path + "/data/"
-
-    cmd_string = "perl " + folder_data_before + "/multi-bleu.perl -lc " + folder_data + "/" + dataset + ".target_eval " \
-                  + folder_data + "/" + dataset + ".target2_eval " + folder_data + "/" + dataset + ".target3_eval < " \
-                  + pred_file + " > " + pred_file.replace("txt", "bleu")
-
-    os.system(cmd_string)
+    refs = [folder_data + "/" + dataset + suffix for suffix in (".target_eval", ".target2_eval", ".target3_eval")]
 
     try:
-        bleu_info = open(pred_file.replace("txt", "bleu"), 'r').readlines()[0].strip()
-    except:
-        bleu_info = -1
+        bleu_info = multi_bleu(pred_file, *refs)
+    except FileNotFoundError:
+        return None
+
+    with open(pred_file.replace("txt", "bleu"), 'w') as f:
+        f.write(format_bleu(bleu_info) + "\n")
 
     return bleu_info
 
@@ -66,14 +306,13 @@ def eval_bleu_sents_tok(pred_file, folder_data, dataset):
                  pred_file + "_tok"
     os.system(cmd_string)
 
-    cmd_string = "perl " + folder_data_before + "/multi-bleu.perl -lc " + folder_data + "/" + dataset + ".target.tok"\
-                 + " < " + pred_file + "_tok" + " > " + pred_file.replace("txt", "bleu_data")
-    os.system(cmd_string)
-
     try:
-        bleu_info_data = open(pred_file.replace("txt", "bleu_data"), 'r').readlines()[0].strip()
-    except:
-        bleu_info_data = 'no data'
+        bleu_info_data = multi_bleu(pred_file + "_tok", folder_data + "/" + dataset + ".target.tok")
+    except FileNotFoundError:
+        return None
+
+    with open(pred_file.replace("txt", "bleu_data"), 'w') as f:
+        f.write(format_bleu(bleu_info_data) + "\n")
 
     return bleu_info_data
 
@@ -94,21 +333,14 @@ def eval_meteor(ref_file, pred_file):
 
 
 def eval_chrf(ref_file, pred_file):
-
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    folder_data_before = dir_path + "/../utils"
-
-    cmd_string = "python " + folder_data_before + "/chrf++.py -H " + pred_file + " -R " \
-                  + ref_file + " > " + pred_file.replace("txt", "chrf")
-
-    os.system(cmd_string)
+    """chrF++ of pred_file against ref_file, also written to the .chrf file. None without predictions."""
 
     try:
-        chrf_info_1 = open(pred_file.replace("txt", "chrf"), 'r').readlines()[1].strip()
-        chrf_info_2 = open(pred_file.replace("txt", "chrf"), 'r').readlines()[2].strip()
-        chrf_data = chrf_info_1 + " " + chrf_info_2
-    except:
-        chrf_data = "no data"
+        chrf_data = chrf(pred_file, ref_file)
+    except FileNotFoundError:
+        return None
 
+    with open(pred_file.replace("txt", "chrf"), 'w') as f:
+        f.write(format_chrf(chrf_data, sep="\n") + "\n")
 
-    return chrf_data
\ No newline at end of file
+    return chrf_data